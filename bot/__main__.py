@@ -1,45 +1,77 @@
+import sys
+
+from bot.startup import StartupProfile
+
+# Created before the imports below, so that they are part of the profile
+startup_profile = StartupProfile()
+if "--profile-startup" in sys.argv:
+    startup_profile.track_imports()
+
+import argparse
 import asyncio
-import pytz
+from sys import stdout
 import structlog
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.storage.redis import RedisStorage
 from structlog.typing import FilteringBoundLogger
 
-from bot.config_reader import LogConfig, get_config, BotConfig, FSMMode, RedisConfig, GameConfig, ChatRestrictionsConfig, AIConfig, ReportsConfig
-from bot.db import Database
-from bot.fluent_loader import get_fluent_localization
+from bot.config_reader import LogConfig, get_config, BotConfig, FSMMode, RedisConfig, GameConfig, ChatRestrictionsConfig, AIConfig, ReportsConfig, DatabaseConfig, UpdatesMode, WebhookConfig, OutboundConfig, GroupTrackingConfig, ThrottlingConfig, ThrottlingBackend, ThrottleRule, MetricsConfig
+from bot.storage import Database, create_database
+from bot.fluent_loader import get_localizations
+from bot.localization import Localizations
 from bot.handlers import default_commands, spin, group_games, transfer, ai_credit
-from bot.logs import get_structlog_config
+from bot.logs import QueuedStream, get_structlog_config
+from bot.metrics import BACKGROUND_PENDING, LOG_RECORDS_DROPPED, instrument_database, start_metrics_server
 from bot.middlewares.throttling import ThrottlingMiddleware
 from bot.middlewares.restrictions import ChatRestrictionMiddleware
 from bot.middlewares.tracker import GroupTrackerMiddleware
 from bot.middlewares.logging import LoggingMiddleware
+from bot.middlewares.locale import LocaleMiddleware
+from bot.middlewares.metrics import HandlerMetricsMiddleware, TelegramMetricsMiddleware, UpdateMetricsMiddleware
+from bot.middlewares.user_lock import UserLockMiddleware
 from bot.services.ai import AIClient
 from bot.services.backfill import backfill_usernames
-from bot.services.daily_stats import DailyStatsService
+from bot.services.credit_sessions import CreditSessionRegistry
+from bot.services.delayed_actions import DelayedActions
+from bot.services.group_tracker import GroupTracker
+from bot.services.outbound import OutboundQueue
+from bot.services.throttling import MemoryThrottleStorage
 from bot.ui_commands import set_bot_commands
 
 
 async def main():
+    startup_profile.phase("config")
     log_config = get_config(model=LogConfig, root_key="logs")
-    structlog.configure(**get_structlog_config(log_config))
+    # Records are written to stdout by a background thread
+    log_stream = QueuedStream(stdout, log_config.queue_size)
+    LOG_RECORDS_DROPPED.set_function(lambda: log_stream.dropped)
+    structlog.configure(**get_structlog_config(log_config, log_stream))
+
+    database_config = get_config(model=DatabaseConfig, root_key="database")
+    reports_config = get_config(model=ReportsConfig, root_key="reports")
+    db = create_database(database_config, reports_config.timezone)
+    if get_config(model=MetricsConfig, root_key="metrics").enabled:
+        instrument_database(db)
+    try:
+        await run_bot(db, reports_config)
+    finally:
+        # Pooled connections must be closed even if startup fails:
+        # their worker threads would keep the process alive otherwise
+        await db.close()
+
 
-    db = Database()
+async def run_bot(db: Database, reports_config: ReportsConfig):
+    startup_profile.phase("database")
+    await db.connect()
     await db.create_tables()
     
-    # Terminate any active AI sessions from previous run
-    await db.terminate_all_active_sessions()
-    
-    # --- MIGRATION START ---
-    # Uncomment to run stats backfill once, then comment out or remove
-    #await db.run_stats_backfill()
-    await db.run_bankruptcy_backfill()
-    # --- MIGRATION END ---
+    # Terminate AI sessions left by a previous run (on Postgres, only the expired ones)
+    ai_config = get_config(model=AIConfig, root_key="ai")
+    await db.terminate_all_active_sessions(ai_config.session_timeout_minutes)
 
+    startup_profile.phase("services")
     bot_config = get_config(model=BotConfig, root_key="bot")
     bot = Bot(
         token=bot_config.token.get_secret_value(),
@@ -49,6 +81,7 @@ async def main():
     )
 
     if bot_config.fsm_mode == FSMMode.REDIS:
+        from aiogram.fsm.storage.redis import RedisStorage
         redis_config = get_config(model=RedisConfig, root_key="redis")
         storage = RedisStorage.from_url(
             url=str(redis_config.dsn),
@@ -58,28 +91,65 @@ async def main():
         storage = MemoryStorage()
 
     # Loading localization for bot
-    l10n = get_fluent_localization()
+    locales = get_localizations(bot_config.default_locale)
 
     game_config = get_config(model=GameConfig, root_key="game_config")
     chat_restrictions_config = get_config(model=ChatRestrictionsConfig, root_key="chat_restrictions")
-    ai_config = get_config(model=AIConfig, root_key="ai")
-    reports_config = get_config(model=ReportsConfig, root_key="reports")
-    
+
     ai_client = AIClient(ai_config)
+    credit_sessions = CreditSessionRegistry(db, ai_config.session_timeout_minutes)
+    credit_sessions.start()
+    outbox = OutboundQueue(bot, get_config(model=OutboundConfig, root_key="outbound"))
+    outbox.start()
+    delayed_actions = DelayedActions(bot, db)
+    await delayed_actions.start()
+    group_tracker = GroupTracker(db, get_config(model=GroupTrackingConfig, root_key="group_tracking"))
+    await group_tracker.start()
 
+    startup_profile.phase("dispatcher")
     # Creating dispatcher with some dependencies
     dp = Dispatcher(
         storage=storage,
-        l10n=l10n,
+        # Replaced with the user's locale by LocaleMiddleware
+        l10n=locales.default,
+        locales=locales,
         game_config=game_config,
         db=db,
         ai_client=ai_client,
-        ai_config=ai_config
+        ai_config=ai_config,
+        credit_sessions=credit_sessions,
+        outbox=outbox,
+        delayed_actions=delayed_actions
     )
     
+    # Maintenance runs once the bot receives updates, see run_maintenance
+    maintenance = None
+
+    async def start_maintenance(*args, **kwargs):
+        nonlocal maintenance
+        await startup_profile.finish()
+        maintenance = asyncio.create_task(run_maintenance(bot, db, locales, reports_config, chat_restrictions_config))
+
+    async def stop_maintenance(*args, **kwargs):
+        if maintenance is not None:
+            maintenance.cancel()
+            await asyncio.gather(maintenance, return_exceptions=True)
+
+    dp.startup.register(start_maintenance)
+    # Stop maintenance, save delayed actions, send queued replies, write group activity and pending session changes,
+    # then close pooled DB connections when the bot stops
+    dp.shutdown.register(stop_maintenance)
+    dp.shutdown.register(delayed_actions.close)
+    dp.shutdown.register(outbox.close)
+    dp.shutdown.register(group_tracker.close)
+    dp.shutdown.register(credit_sessions.close)
+    dp.shutdown.register(db.close)
+
     # Register middleware
-    dp.update.outer_middleware(LoggingMiddleware())
-    dp.message.outer_middleware(GroupTrackerMiddleware())
+    log_config = get_config(model=LogConfig, root_key="logs")
+    dp.update.outer_middleware(LoggingMiddleware(log_config.sample_rate, log_config.slow_update_ms, log_config.trace_db_actions))
+    dp.update.outer_middleware(LocaleMiddleware(locales))
+    dp.message.outer_middleware(GroupTrackerMiddleware(group_tracker))
     dp.message.middleware(ChatRestrictionMiddleware(chat_restrictions_config))
 
     # Make bot work only in PM (one-on-one chats) with bot
@@ -92,20 +162,65 @@ async def main():
     dp.include_router(transfer.router)
     dp.include_router(ai_credit.router)
 
+    # Metrics (see [metrics]); handler latency includes throttling and the user lock registered below
+    metrics_config = get_config(model=MetricsConfig, root_key="metrics")
+    if metrics_config.enabled:
+        bot.session.middleware(TelegramMetricsMiddleware())
+        dp.update.outer_middleware(UpdateMetricsMiddleware())
+        dp.message.middleware(HandlerMetricsMiddleware())
+        BACKGROUND_PENDING.set_function(lambda: {
+            ("outbound",): outbox.pending,
+            ("delayed_actions",): delayed_actions.pending,
+            ("credit_session_writes",): credit_sessions.pending_writes,
+            ("db_events",): db.pending_events,
+        })
+        metrics_runner = await start_metrics_server(metrics_config)
+        dp.shutdown.register(metrics_runner.cleanup)
+
     # Register throttling middleware
-    dp.message.middleware(
-        ThrottlingMiddleware(game_config.throttle_time_spin, game_config.throttle_time_other)
-    )
+    throttling_config = get_config(model=ThrottlingConfig, root_key="throttling")
+    if throttling_config.backend == ThrottlingBackend.REDIS:
+        from redis.asyncio import Redis
+        from bot.services.redis_throttling import RedisThrottleStorage
+        redis_config = get_config(model=RedisConfig, root_key="redis")
+        throttle_storage = RedisThrottleStorage(Redis.from_url(str(redis_config.dsn)), throttling_config.key_prefix)
+    else:
+        throttle_storage = MemoryThrottleStorage()
+    dp.shutdown.register(throttle_storage.close)
+    throttle_rules = {
+        "spin": ThrottleRule.per_user_interval(game_config.throttle_time_spin),
+        "default": ThrottleRule.per_user_interval(game_config.throttle_time_other),
+        **throttling_config.rules,
+    }
+    dp.message.middleware(ThrottlingMiddleware(throttle_storage, throttle_rules))
+    # Serialize economy handlers per user (registered after throttling, so dropped spam doesn't wait)
+    dp.message.middleware(UserLockMiddleware())
+
+    startup_profile.phase("start")
+    logger: FilteringBoundLogger = structlog.get_logger()
+    if bot_config.updates_mode == UpdatesMode.WEBHOOK:
+        from bot.webhook import run_webhook
+        webhook_config = get_config(model=WebhookConfig, root_key="webhook")
+        await run_webhook(dp, bot, webhook_config)
+        return
+
+    await logger.ainfo("Starting polling...")
+    try:
+        # getUpdates doesn't work while a webhook is set (e.g. after switching back from webhook mode)
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        await bot.session.close()
 
-    # Set bot commands in the UI
-    await set_bot_commands(bot, l10n)
 
-    # Start username backfill in background
-    asyncio.create_task(backfill_usernames(bot, db))
+def start_scheduler(db: Database, bot: Bot, reports_config: ReportsConfig, chat_restrictions_config: ChatRestrictionsConfig):
+    # apscheduler and pytz are only needed here, after the bot has started
+    import pytz
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from bot.services.daily_stats import DailyStatsService
 
-    # Setup Scheduler
     scheduler = AsyncIOScheduler()
-    daily_stats_service = DailyStatsService(db, bot)
+    daily_stats_service = DailyStatsService(db, bot, reports_config.timezone)
     timezone = pytz.timezone(reports_config.timezone)
 
     async def send_daily_reports():
@@ -131,16 +246,51 @@ async def main():
     
     # Schedule draft report at 23:30 UTC+5
     scheduler.add_job(send_draft_report, 'cron', hour=20, minute=19, timezone=timezone)
+
+    # Move old events to the monthly archive and prune old AI dialogues (see [database])
+    scheduler.add_job(db.run_archival, 'cron', hour=4, minute=0, timezone=timezone)
     
     scheduler.start()
+    return scheduler
+
 
+async def run_maintenance(
+        bot: Bot,
+        db: Database,
+        locales: Localizations,
+        reports_config: ReportsConfig,
+        chat_restrictions_config: ChatRestrictionsConfig,
+):
+    """
+    Startup work that updates don't have to wait for, started once the bot receives them.
+    Runs until the bot stops, then stops the scheduler.
+    """
     logger: FilteringBoundLogger = structlog.get_logger()
-    await logger.ainfo("Starting polling...")
+    scheduler = start_scheduler(db, bot, reports_config, chat_restrictions_config)
     try:
-        await dp.start_polling(bot)
+        try:
+            # Set bot commands in the UI
+            await set_bot_commands(bot, locales)
+
+            # One-time history backfills: they record completion and are skipped on later starts.
+            # Stats backfill can be run with `python -m bot.maintenance backfill-stats`
+            await db.run_bankruptcy_backfill()
+
+            await backfill_usernames(bot, db)
+        except Exception:
+            await logger.aexception("Startup maintenance failed")
+        await asyncio.Future()
     finally:
-        await bot.session.close()
+        scheduler.shutdown(wait=False)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m bot")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="Log the time of every startup phase and module import")
+    return parser
 
 
 if __name__ == '__main__':
+    get_parser().parse_args()
     asyncio.run(main())
@@ -1,10 +1,11 @@
+import re
 from enum import StrEnum, auto
 from functools import lru_cache
 from os import getenv
 from tomllib import load
 from typing import Type, TypeVar
 
-from pydantic import BaseModel, SecretStr, field_validator, RedisDsn
+from pydantic import BaseModel, SecretStr, field_validator, RedisDsn, PostgresDsn
 
 ConfigType = TypeVar("ConfigType", bound=BaseModel)
 
@@ -19,11 +20,29 @@ class FSMMode(StrEnum):
     REDIS = auto()
 
 
+class UpdatesMode(StrEnum):
+    POLLING = auto()
+    WEBHOOK = auto()
+
+
+class ThrottlingBackend(StrEnum):
+    MEMORY = auto()
+    REDIS = auto()
+
+
+class StorageBackend(StrEnum):
+    SQLITE = auto()
+    POSTGRES = auto()
+
+
 class BotConfig(BaseModel):
     token: SecretStr
     fsm_mode: FSMMode
+    updates_mode: UpdatesMode = UpdatesMode.POLLING
+    # Language for users whose language_code has no locale; None - the first one in bot/locale/current
+    default_locale: str | None = None
 
-    @field_validator('fsm_mode', mode="before")
+    @field_validator('fsm_mode', 'updates_mode', mode="before")
     @classmethod
     def fsm_mode_to_lower(cls, v: str):
         return v.lower()
@@ -38,6 +57,14 @@ class LogConfig(BaseModel):
     use_colors_in_console: bool
     renderer: LogRenderer
     allow_third_party_logs: bool
+    # Records waiting for the writer thread; when it's full, new records are dropped (and counted)
+    queue_size: int = 10000
+    # Log 1 in sample_rate successful updates handled faster than slow_update_ms.
+    # Errors and slow updates are always logged
+    sample_rate: int = 1
+    slow_update_ms: int = 1000
+    # Record the DB actions of each update (operation, table, params, duration, rows)
+    trace_db_actions: bool = True
 
     @field_validator('renderer', mode="before")
     @classmethod
@@ -45,6 +72,78 @@ class LogConfig(BaseModel):
         return v.lower()
 
 
+class WebhookConfig(BaseModel):
+    # Public HTTPS address Telegram sends updates to. If empty, the webhook isn't registered
+    # (e.g. it's managed elsewhere, or updates are POSTed by hand for local testing)
+    base_url: str = ""
+    path: str = "/webhook"
+    health_path: str = "/health"
+    host: str = "0.0.0.0"
+    port: int = 8080
+    secret_token: SecretStr | None = None
+    max_in_flight: int = 100
+    max_connections: int = 40
+    drop_pending_updates: bool = False
+
+    @field_validator('secret_token')
+    @classmethod
+    def secret_token_charset(cls, v: SecretStr | None):
+        # Telegram only accepts 1-256 characters A-Z, a-z, 0-9, _ and -
+        if v is not None and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", v.get_secret_value()):
+            raise ValueError("secret_token must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+        return v
+
+
+class OutboundConfig(BaseModel):
+    global_per_second: float = 30
+    group_per_minute: float = 20
+    group_burst: float = 3
+    private_per_second: float = 1
+    max_concurrent_sends: int = 10
+    routine_ttl_seconds: float = 30
+
+
+class ThrottleRule(BaseModel):
+    # Token buckets: *_per_second tokens are added up to *_burst, every message takes one.
+    # 0 per second disables the limit
+    user_per_second: float = 0
+    user_burst: float = 1
+    chat_per_second: float = 0
+    chat_burst: float = 1
+
+    @classmethod
+    def per_user_interval(cls, seconds: float) -> "ThrottleRule":
+        """One message per `seconds` per user (the old throttle_time_* behavior, but per user)."""
+        return cls(user_per_second=1 / seconds if seconds > 0 else 0)
+
+
+class ThrottlingConfig(BaseModel):
+    # "redis" shares the buckets between bot processes; uses the dsn from [redis]
+    backend: ThrottlingBackend = ThrottlingBackend.MEMORY
+    key_prefix: str = "throttle"
+    # By throttling_key handler flag ("spin", "default"). Keys without a rule here
+    # fall back to throttle_time_spin / throttle_time_other from [game_config]
+    rules: dict[str, ThrottleRule] = {}
+
+    @field_validator('backend', mode="before")
+    @classmethod
+    def backend_to_lower(cls, v: str):
+        return v.lower()
+
+
+class GroupTrackingConfig(BaseModel):
+    last_seen_granularity_minutes: int = 10
+    flush_interval_seconds: float = 5
+
+
+class MetricsConfig(BaseModel):
+    enabled: bool = False
+    # Keep it local: the endpoint has no authentication
+    host: str = "127.0.0.1"
+    port: int = 9101
+    path: str = "/metrics"
+
+
 class RedisConfig(BaseModel):
     dsn: RedisDsn
 
@@ -66,11 +165,37 @@ class ReportsConfig(BaseModel):
     admin_id: int = 0
 
 
+class DatabaseConfig(BaseModel):
+    backend: StorageBackend = StorageBackend.SQLITE
+    sqlite_path: str | None = None
+    postgres_dsn: PostgresDsn | None = None
+    pool_min_size: int = 2
+    pool_max_size: int = 10
+    read_connections: int = 3
+    busy_timeout_ms: int = 5000
+    cache_size_kib: int = 16384
+    mmap_size_mb: int = 256
+    event_write_behind: bool = False
+    event_batch_size: int = 200
+    event_flush_interval_ms: int = 50
+    event_max_pending: int = 5000
+    user_cache_size: int = 10000
+    archive_dir: str = "archive"
+    archive_keep_months: int = 0
+    dialogue_retention_days: int = 0
+
+    @field_validator('backend', mode="before")
+    @classmethod
+    def backend_to_lower(cls, v: str):
+        return v.lower()
+
+
 class AIConfig(BaseModel):
     provider: str = "mock"
     api_key: str = "dummy"
     model: str = "gpt-4o-mini"
     credit_cooldown_minutes: int = 60
+    session_timeout_minutes: int = 30
 
 @lru_cache
 def parse_config_file() -> dict:
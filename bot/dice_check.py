@@ -1,11 +1,9 @@
 # Source: https://gist.github.com/MasterGroosha/963c0a82df348419788065ab229094ac
 
 from functools import lru_cache
-from typing import List, Tuple
+from typing import Callable, List, Tuple
 import random
 
-from fluent.runtime import FluentLocalization
-
 
 @lru_cache(maxsize=64)
 def get_score_change(dice_value: int) -> int:
@@ -53,17 +51,17 @@ def get_combo_parts(dice_value: int) -> List[str]:
     return result
 
 
-@lru_cache(maxsize=64)
-def get_combo_text(dice_value: int, l10n: FluentLocalization) -> str:
+def get_combo_text(dice_value: int, translate: Callable[[str], str]) -> str:
     """
-    Returns localized string with dice result
+    Returns localized string with dice result.
+    Called once per locale and value at startup, see Locale.combo_text
     :param dice_value: dice value (1-64)
-    :param l10n: Fluent localization object
+    :param translate: function returning the translation of an icon key
     :return: string with localized result
     """
     parts: list[str] = get_combo_parts(dice_value)
     for i in range(len(parts)):
-        parts[i] = l10n.format_value(parts[i])
+        parts[i] = translate(parts[i])
     return ", ".join(parts)
 
 
@@ -1,8 +1,11 @@
 from aiogram.filters import BaseFilter
 from aiogram.types import Message
-from fluent.runtime import FluentLocalization
+
+from bot.localization import Localizations
 
 
 class SpinTextFilter(BaseFilter):
-    async def __call__(self, message: Message, l10n: FluentLocalization) -> bool:
-        return message.text == l10n.format_value("spin-button-text")
+    """Matches the spin button text of any locale, a set lookup per message."""
+
+    async def __call__(self, message: Message, locales: Localizations) -> bool:
+        return message.text in locales.spin_button_texts
@@ -1,25 +1,44 @@
 from pathlib import Path
 
-from fluent.runtime import FluentLocalization, FluentResourceLoader
+from fluent.runtime import FluentBundle, FluentResource
+from fluent.syntax import ast as FTL
 
+from bot.localization import Locale, Localizations
 
-def get_fluent_localization() -> FluentLocalization:
+
+def _load_bundle(language_dir: Path) -> tuple[FluentBundle, list[str]]:
+    # Find all .ftl files inside the language directory
+    ftl_files = sorted(f for f in language_dir.iterdir() if f.is_file() and f.suffix == ".ftl")
+    if len(ftl_files) == 0:
+        raise RuntimeError(f"No .ftl files found in the {language_dir.name} directory.")
+
+    # Same options as FluentLocalization
+    bundle = FluentBundle([language_dir.name], use_isolating=False)
+    message_ids = []
+    for ftl_file in ftl_files:
+        resource = FluentResource(ftl_file.read_text(encoding="utf-8"))
+        bundle.add_resource(resource)
+        message_ids.extend(item.id.name for item in resource.body if isinstance(item, FTL.Message))
+    return bundle, message_ids
+
+
+def get_localizations(default_locale: str | None = None) -> Localizations:
     # Access "locale/current" dir
     real_locale_dir = Path(__file__).parent.joinpath("locale", "current")
-    # Find all subdirectories.
-    real_languages_subdirs: list = [d for d in real_locale_dir.iterdir() if d.is_dir()]
-    # There must be at least one subdirectory inside. Ideally – only one.
-    if len(real_languages_subdirs) == 0:
+    # Every subdirectory is a language, named by its code ("en", "ru")
+    languages = {d.name.lower(): d for d in sorted(real_locale_dir.iterdir()) if d.is_dir()}
+    if len(languages) == 0:
         raise RuntimeError("No languages found in the 'current' directory.")
-    # Select the first subdir if there are multiple subdirectories inside.
-    selected_language_dir = real_languages_subdirs[0]
-
-    # Find all .ftl files inside the selected language directory
-    ftl_files = [f.name for f in selected_language_dir.iterdir() if f.is_file() and f.suffix == ".ftl"]
-    if len(ftl_files) == 0:
-        raise RuntimeError(f"No .ftl files found in the {selected_language_dir.name} directory.")
+    # The first language is the default, unless set in the config
+    default = default_locale.lower() if default_locale else next(iter(languages))
+    if default not in languages:
+        raise RuntimeError(f"Default locale {default} not found in the 'current' directory.")
 
-    # Now form Fluent-compatible path and create Fluent objects.
-    locale_dir = real_locale_dir.joinpath("{locale}")
-    loader = FluentResourceLoader(str(locale_dir.absolute()))
-    return FluentLocalization([selected_language_dir.name], ftl_files, loader)
+    bundles = {code: _load_bundle(language_dir) for code, language_dir in languages.items()}
+    default_bundle, default_ids = bundles[default]
+    locales = {}
+    for code, (bundle, message_ids) in bundles.items():
+        # Messages missing in a language are taken from the default one
+        chain = [bundle] if code == default else [bundle, default_bundle]
+        locales[code] = Locale(code, chain, dict.fromkeys(message_ids + default_ids))
+    return Localizations(locales, default)
@@ -2,10 +2,11 @@ from aiogram import Router
 from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, ReplyKeyboardRemove
-from fluent.runtime import FluentLocalization
 
 from bot.config_reader import GameConfig
-from bot.db import Database
+from bot.localization import Locale
+from bot.storage import Database
+from bot.services.outbound import OutboundQueue
 from bot.keyboards import get_spin_keyboard
 
 flags = {"throttling_key": "default"}
@@ -16,9 +17,10 @@ router = Router()
 async def cmd_start(
         message: Message,
         state: FSMContext,
-        l10n: FluentLocalization,
+        l10n: Locale,
         game_config: GameConfig,
         db: Database,
+        outbox: OutboundQueue,
 ):
     # Register user in DB to ensure they can be found by nickname
     if message.from_user.username:
@@ -33,47 +35,47 @@ async def cmd_start(
 
     start_text = l10n.format_value("start-text", {"points": balance})
 
-    await message.answer(start_text, reply_markup=get_spin_keyboard(l10n))
+    outbox.send(message.answer(start_text, reply_markup=get_spin_keyboard(l10n)))
 
 
 @router.message(Command("stop"), flags=flags)
-async def cmd_stop(message: Message, l10n: FluentLocalization):
-    await message.answer(
+async def cmd_stop(message: Message, l10n: Locale, outbox: OutboundQueue):
+    outbox.send(message.answer(
         l10n.format_value("stop-text"),
         reply_markup=ReplyKeyboardRemove()
-    )
+    ))
 
 
 @router.message(Command("help"), flags=flags)
-async def cmd_help(message: Message, l10n: FluentLocalization):
-    await message.answer(
+async def cmd_help(message: Message, l10n: Locale, outbox: OutboundQueue):
+    outbox.send(message.answer(
         l10n.format_value("help-text"),
         disable_web_page_preview=True
-    )
+    ))
 
 
-@router.message(Command("bid"), flags=flags)
-async def cmd_bid(message: Message, command: CommandObject, db: Database, game_config: GameConfig):
+@router.message(Command("bid"), flags={**flags, "user_lock": True})
+async def cmd_bid(message: Message, command: CommandObject, db: Database, game_config: GameConfig, outbox: OutboundQueue):
     user_id = message.from_user.id
     if not command.args:
         current_bid = await db.get_bid(user_id)
-        await message.reply(f"Ваша текущая ставка: {current_bid}")
+        outbox.send(message.reply(f"Ваша текущая ставка: {current_bid}"))
         return
 
     try:
         bid_amount = int(command.args)
         if bid_amount <= 0:
-            await message.reply("Ставка должна быть положительным числом.")
+            outbox.send(message.reply("Ставка должна быть положительным числом."))
             return
         
         current_balance = await db.get_balance(user_id, game_config.starting_points)
         if bid_amount > current_balance:
             # Если ставка больше баланса, идем ва-банк
             await db.update_bid(user_id, current_balance)
-            await message.reply(f"Недостаточно средств для ставки {bid_amount}. Вы пошли ва-банк! Ставка установлена в размере: {current_balance}")
+            outbox.send(message.reply(f"Недостаточно средств для ставки {bid_amount}. Вы пошли ва-банк! Ставка установлена в размере: {current_balance}"))
             return
             
         await db.update_bid(user_id, bid_amount)
-        await message.reply(f"Ваша ставка обновлена: {bid_amount}")
+        outbox.send(message.reply(f"Ваша ставка обновлена: {bid_amount}"))
     except ValueError:
-        await message.reply("Пожалуйста, укажите целое число.")
+        outbox.send(message.reply("Пожалуйста, укажите целое число."))
@@ -1,7 +1,4 @@
-import uuid
-import json
 import html
-import asyncio
 import random
 from contextlib import suppress
 from aiogram import Router, F
@@ -10,20 +7,19 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import Message
 from bot.dice_check import get_score_change, get_super_jackpot
-from bot.db import Database
+from bot.storage import Database
 from bot.config_reader import GameConfig
+from bot.services.delayed_actions import DelayedActions
+from bot.services.outbound import OutboundQueue, Priority
 
 router = Router()
 
-async def delete_message_later(message: Message, delay: int = 60):
-    """Удаляет сообщение через delay секунд."""
-    await asyncio.sleep(delay)
-    with suppress(TelegramBadRequest):
-        await message.delete()
+# Через сколько секунд удалять проигрышный бросок
+LOSING_SPIN_DELETE_DELAY = 60
 
 # Обработчик команды /balance
 @router.message(Command("balance"))
-async def cmd_balance(message: Message, db: Database, game_config: GameConfig):
+async def cmd_balance(message: Message, db: Database, game_config: GameConfig, outbox: OutboundQueue):
     if not message.from_user:
         return
     user_id = message.from_user.id
@@ -33,19 +29,19 @@ async def cmd_balance(message: Message, db: Database, game_config: GameConfig):
 
     # Получаем баланс (или начальный, если пользователя нет)
     balance = await db.get_balance(user_id, game_config.starting_points)
-    await message.reply(f"Ваш баланс: {balance}")
+    outbox.send(message.reply(f"Ваш баланс: {balance}"))
 
 # Обработчик команды /stats
 @router.message(Command("stats"))
-async def cmd_stats(message: Message, db: Database):
+async def cmd_stats(message: Message, db: Database, outbox: OutboundQueue):
     if message.chat.type not in ("group", "supergroup"):
-        await message.reply("Эта команда работает только в группах.")
+        outbox.send(message.reply("Эта команда работает только в группах."))
         return
 
     top_users = await db.get_top_users_in_group(message.chat.id, limit=30)
     
     if not top_users:
-        await message.reply("В этом чате пока нет активных игроков.")
+        outbox.send(message.reply("В этом чате пока нет активных игроков."))
         return
 
     chat_title = html.escape(message.chat.title or "Unknown Group")
@@ -72,11 +68,17 @@ async def cmd_stats(message: Message, db: Database):
         else:
             text.append(f"{idx}. <b>{safe_nickname}</b> — {balance} очков\n")
         
-    await message.reply("\n".join(text))
+    outbox.send(message.reply("\n".join(text)))
 
 # Обработчик броска кубика
-@router.message(F.content_type == ContentType.DICE, F.dice.emoji == DiceEmoji.SLOT_MACHINE)
-async def on_dice_roll(message: Message, db: Database, game_config: GameConfig):
+@router.message(F.content_type == ContentType.DICE, F.dice.emoji == DiceEmoji.SLOT_MACHINE, flags={"user_lock": True})
+async def on_dice_roll(
+        message: Message,
+        db: Database,
+        game_config: GameConfig,
+        outbox: OutboundQueue,
+        delayed_actions: DelayedActions,
+):
     # Check if forwarded
     if message.forward_date or message.forward_from or message.forward_from_chat or getattr(message, 'forward_origin', None):
         return
@@ -86,27 +88,6 @@ async def on_dice_roll(message: Message, db: Database, game_config: GameConfig):
         return
 
     user_id = message.from_user.id
-    
-    if message.from_user.username:
-        await db.register_user(user_id, message.from_user.username)
-    
-    # Получаем текущий баланс
-    current_balance = await db.get_balance(user_id, game_config.starting_points)
-    
-    # ПРОВЕРКА НА БАНКРОТА: Если баланс <= 0, удаляем сообщение
-    if current_balance <= 0:
-        with suppress(TelegramBadRequest):
-            await message.delete()
-        return
-
-    # Получаем ставку пользователя
-    user_bid = await db.get_bid(user_id)
-
-    # Проверяем, хватает ли денег на ставку
-    if current_balance < user_bid:
-        await message.reply(f"Ваш баланс ({current_balance}) меньше текущей ставки ({user_bid}). Снизьте ставку командой /bid или пополните баланс.")
-        return
-
     dice_value = message.dice.value
     
     # Считаем изменение очков
@@ -117,32 +98,31 @@ async def on_dice_roll(message: Message, db: Database, game_config: GameConfig):
     jackpot_name = None
     if score_change > 0:
         super_multiplier, jackpot_name = get_super_jackpot()
-        
-    actual_change = score_change * user_bid * super_multiplier
-    new_balance = current_balance + actual_change
-    
-    # Обновляем баланс в БД
-    await db.set_balance(user_id, new_balance)
 
-    # Логируем событие
-    event_id = str(uuid.uuid4())
-    event_type = 'win' if actual_change > 0 else 'loss'
-    metadata_dict = {
-        "dice_value": dice_value, 
-        "bid": user_bid, 
-        "base_score_change": score_change,
-        "super_jackpot_multiplier": super_multiplier
-    }
-    metadata = json.dumps(metadata_dict)
-    await db.add_event(event_id, user_id, event_type, actual_change, metadata, chat_id=message.chat.id)
-    
-    # Обновляем статистику
-    is_bankruptcy = new_balance <= 0
-    await db.update_user_stats(user_id, actual_change, is_bankruptcy=is_bankruptcy)
+    # Проверка баланса, списание/начисление, лог и статистика — одной транзакцией
+    result = await db.settle_spin(
+        user_id,
+        message.from_user.username,
+        message.chat.id,
+        dice_value,
+        super_multiplier,
+        starting_balance=game_config.starting_points,
+    )
+    user_bid = result["bid"]
     
-    if is_bankruptcy:
-        # Record explicit bankruptcy event for daily stats
-        await db.add_event(str(uuid.uuid4()), user_id, 'bankruptcy', 0, chat_id=message.chat.id)
+    # ПРОВЕРКА НА БАНКРОТА: Если баланс <= 0, удаляем сообщение
+    if result["status"] == "bankrupt":
+        with suppress(TelegramBadRequest):
+            await message.delete()
+        return
+
+    # Проверяем, хватает ли денег на ставку
+    if result["status"] == "insufficient":
+        outbox.send(message.reply(f"Ваш баланс ({result['balance']}) меньше текущей ставки ({user_bid}). Снизьте ставку командой /bid или пополните баланс."))
+        return
+
+    actual_change = result["change"]
+    new_balance = result["balance"]
     
     # Логика отправки сообщений
     
@@ -166,11 +146,11 @@ async def on_dice_roll(message: Message, db: Database, game_config: GameConfig):
                 f"💸 Выигрыш: <b>{actual_change}</b> очков! (вместо {score_change * user_bid})\n"
                 f"🏦 Ваш баланс: {new_balance}"
             )
-            await message.reply(msg_text)
+            outbox.send(message.reply(msg_text), Priority.HIGH)
         else:
-            await message.reply(
+            outbox.send(message.reply(
                 f"Вы выиграли {actual_change} очков! Ваш баланс: {new_balance}"
-            )
+            ), Priority.LOW)
 
     # 2. Банкрот (баланс стал <= 0, но был > 0)
     elif new_balance <= 0:
@@ -191,9 +171,9 @@ async def on_dice_roll(message: Message, db: Database, game_config: GameConfig):
             "Друзья! Подкиньте нищему на додеп.",
             "Упс! Вы всё пролудили и вам пора работать."
         ]
-        await message.reply(random.choice(bankrupt_phrases))
+        outbox.send(message.reply(random.choice(bankrupt_phrases)), Priority.HIGH)
     
-    # 3. Обычный проигрыш - удаляем сообщение через минуту
+    # 3. Обычный проигрыш - удаляем сообщение через минуту (переживает перезапуск бота)
     else:
-        asyncio.create_task(delete_message_later(message))
+        delayed_actions.delete_message_later(message.chat.id, message.message_id, LOSING_SPIN_DELETE_DELAY)
 
@@ -1,76 +1,88 @@
-from asyncio import sleep
-from contextlib import suppress
-
 from aiogram import Router
 from aiogram.enums.dice_emoji import DiceEmoji
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message
-from fluent.runtime import FluentLocalization
 
 from bot.config_reader import GameConfig
-from bot.db import Database
-from bot.dice_check import get_combo_text, get_score_change
+from bot.localization import Locale
+from bot.storage import Database
+from bot.services.delayed_actions import DelayedActions
+from bot.services.outbound import OutboundQueue, Priority
 from bot.filters import SpinTextFilter
 from bot.keyboards import get_spin_keyboard
 
+
+# No user_lock: the spin is settled atomically by settle_spin, and holding the lock
+# across the dice send would make the user's other commands wait on the outbound queue
 flags = {"throttling_key": "spin"}
 router = Router()
 
 
+def send_zero_balance(message: Message, l10n: Locale, game_config: GameConfig, outbox: OutboundQueue):
+    if game_config.send_gameover_sticker:
+        # Failures (e.g. an invalid or missing sticker file_id) are logged by the queue
+        outbox.send(message.answer_sticker(l10n.format_value("zero-balance-sticker")))
+    outbox.send(message.answer(l10n.format_value("zero-balance")))
+
+
 @router.message(Command("spin"), flags=flags)
 @router.message(SpinTextFilter(), flags=flags)
 async def cmd_spin(
         message: Message,
         state: FSMContext,
-        l10n: FluentLocalization,
+        l10n: Locale,
         game_config: GameConfig,
         db: Database,
+        outbox: OutboundQueue,
+        delayed_actions: DelayedActions,
 ):
     user_id = message.from_user.id
-    if message.from_user.username:
-        await db.register_user(user_id, message.from_user.username)
 
-    # Get current score
-    user_score = await db.get_balance(user_id, game_config.starting_points)
-
-    if user_score == 0:
-        if game_config.send_gameover_sticker:
-            # In case sticker file_id is invalid or missing
-            with suppress(TelegramBadRequest):
-                await message.answer_sticker(l10n.format_value("zero-balance-sticker"))
-        await message.answer(l10n.format_value("zero-balance"))
+    # Early out before the dice is sent. Not authoritative: settle_spin checks the balance again
+    if await db.get_balance(user_id, game_config.starting_points) <= 0:
+        send_zero_balance(message, l10n, game_config, outbox)
         return
 
     # Send dice to user
-    msg = await message.answer_dice(emoji=DiceEmoji.SLOT_MACHINE, reply_markup=get_spin_keyboard(l10n))
+    msg = await outbox.send(message.answer_dice(emoji=DiceEmoji.SLOT_MACHINE, reply_markup=get_spin_keyboard(l10n)), Priority.HIGH)
 
-    # Check whether user won or not
-    score_change = get_score_change(msg.dice.value)
+    # Balance update, event log and stats in one transaction. Private spins play for 1, not the user's bid
+    result = await db.settle_spin(
+        user_id,
+        message.from_user.username,
+        None,
+        msg.dice.value,
+        starting_balance=game_config.starting_points,
+        bid=1,
+    )
+    if result["status"] != "ok":
+        # Went bankrupt meanwhile (e.g. a transfer or a group game)
+        send_zero_balance(message, l10n, game_config, outbox)
+        return
 
+    score_change = result["change"]
     if score_change < 0:
         win_or_lose_text = l10n.format_value("spin-fail")
     else:
         win_or_lose_text = l10n.format_value("spin-success", {"score-value": score_change})
 
-    # Updating score in DB and FSM
-    new_score = user_score + score_change
-    await db.set_balance(user_id, new_score)
+    new_score = result["balance"]
     await state.update_data(score=new_score)
 
     # This delay is roughly equivalent of animation duration
     # of slot machine. Depending on dice value,
-    # animation duration is different, but approx. 2 seconds
-    await sleep(2.0)
-    await msg.reply(
+    # animation duration is different, but approx. 2 seconds.
+    # The handler returns right away, the reply is sent by the timer wheel
+    reply = msg.reply(
         l10n.format_value(
             "after-spin",
             {
-                "combo_text": get_combo_text(msg.dice.value, l10n),
+                "combo_text": l10n.combo_text(msg.dice.value),
                 "dice_value": msg.dice.value,
                 "result_text": win_or_lose_text,
                 "score-value": new_score
             }
         )
     )
+    delayed_actions.call_later(2.0, lambda: outbox.send(reply))
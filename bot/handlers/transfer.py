@@ -1,16 +1,17 @@
 from aiogram import Router, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
-from bot.db import Database
+from bot.storage import Database
+from bot.services.outbound import OutboundQueue
 import uuid
 
 router = Router()
 
-@router.message(Command("give"))
-async def cmd_give(message: Message, command: CommandObject, db: Database):
+@router.message(Command("give"), flags={"user_lock": True})
+async def cmd_give(message: Message, command: CommandObject, db: Database, outbox: OutboundQueue):
     args = command.args
     if not args:
-        await message.answer("Использование: /give <сумма> <@username> или ответом на сообщение")
+        outbox.send(message.answer("Использование: /give <сумма> <@username> или ответом на сообщение"))
         return
 
     parts = args.split()
@@ -18,12 +19,12 @@ async def cmd_give(message: Message, command: CommandObject, db: Database):
     target_username = parts[1] if len(parts) > 1 else None
 
     if not amount_str.isdigit():
-        await message.answer("Сумма должна быть числом.")
+        outbox.send(message.answer("Сумма должна быть числом."))
         return
     
     amount = int(amount_str)
     if amount <= 0:
-        await message.answer("Сумма должна быть больше нуля.")
+        outbox.send(message.answer("Сумма должна быть больше нуля."))
         return
 
     from_user_id = message.from_user.id
@@ -41,17 +42,17 @@ async def cmd_give(message: Message, command: CommandObject, db: Database):
                 to_user_id = user["user_id"]
                 to_user_name = user["nickname"] or "Unknown"
             else:
-                await message.answer("Пользователь не найден.")
+                outbox.send(message.answer("Пользователь не найден."))
                 return
         else:
-             await message.answer("Укажите @username пользователя.")
+             outbox.send(message.answer("Укажите @username пользователя."))
              return
     else:
-        await message.answer("Укажите получателя.")
+        outbox.send(message.answer("Укажите получателя."))
         return
 
     if from_user_id == to_user_id:
-        await message.answer("Нельзя передать монеты самому себе.")
+        outbox.send(message.answer("Нельзя передать монеты самому себе."))
         return
 
     # Execute transfer
@@ -61,8 +62,8 @@ async def cmd_give(message: Message, command: CommandObject, db: Database):
     success = await db.transfer_money(from_user_id, to_user_id, amount, event_id_out, event_id_in, chat_id=message.chat.id)
     
     if success:
-        await message.answer(f"✅ Успешно передано {amount} монет пользователю {to_user_name}!")
+        outbox.send(message.answer(f"✅ Успешно передано {amount} монет пользователю {to_user_name}!"))
         # Optionally notify recipient? They might not be in context if using username.
     else:
-        await message.answer("❌ Недостаточно средств или ошибка транзакции.")
+        outbox.send(message.answer("❌ Недостаточно средств или ошибка транзакции."))
 
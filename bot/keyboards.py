@@ -1,11 +1,12 @@
 from functools import cache
 
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from fluent.runtime import FluentLocalization
+
+from bot.localization import Locale
 
 
 @cache
-def get_spin_keyboard(l10n: FluentLocalization):
+def get_spin_keyboard(l10n: Locale):
     keyboard = [
         [KeyboardButton(text=l10n.format_value("spin-button-text"))]
     ]
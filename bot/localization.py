@@ -0,0 +1,75 @@
+from typing import Any, Dict, Iterable, List
+
+from fluent.runtime import FluentBundle
+from fluent.syntax import ast as FTL
+
+from bot.dice_check import get_combo_text
+
+
+class Locale:
+    """
+    Message catalog of one language, compiled at startup.
+    Strings without variables and all 64 combo texts are formatted once and served
+    from dicts; messages with variables are formatted by Fluent on every call.
+    Messages missing in this language fall back to the following bundles.
+    """
+
+    def __init__(self, code: str, bundles: List[FluentBundle], message_ids: Iterable[str]):
+        self.code = code
+        self._bundles = bundles
+        self.strings: Dict[str, str] = {}
+        for msg_id in message_ids:
+            found = self._find(msg_id)
+            if found is None:
+                continue
+            bundle, pattern = found
+            value, errors = bundle.format_pattern(pattern, None)
+            # Errors here are references to variables that aren't passed
+            if not errors:
+                self.strings[msg_id] = value
+        # Indexed by dice value (1-64)
+        self.combo_texts = ("",) + tuple(get_combo_text(value, self.format_value) for value in range(1, 65))
+
+    def _find(self, msg_id: str) -> tuple[FluentBundle, FTL.Pattern] | None:
+        for bundle in self._bundles:
+            if bundle.has_message(msg_id):
+                message = bundle.get_message(msg_id)
+                if message.value:
+                    return bundle, message.value
+        return None
+
+    def format_value(self, msg_id: str, args: Dict[str, Any] | None = None) -> str:
+        """Same as FluentLocalization.format_value: returns msg_id for unknown messages."""
+        if not args:
+            text = self.strings.get(msg_id)
+            if text is not None:
+                return text
+        found = self._find(msg_id)
+        if found is None:
+            return msg_id
+        bundle, pattern = found
+        value, _errors = bundle.format_pattern(pattern, args)
+        return value
+
+    def combo_text(self, dice_value: int) -> str:
+        return self.combo_texts[dice_value]
+
+
+class Localizations:
+    """All locales of the bot, and the choice of one by the user's language_code."""
+
+    def __init__(self, locales: Dict[str, Locale], default: str):
+        self.locales = locales
+        self.default = locales[default]
+        # Text of the spin button in every language, for SpinTextFilter
+        self.spin_button_texts = frozenset(locale.format_value("spin-button-text") for locale in locales.values())
+        self._by_language_code: Dict[str | None, Locale] = {None: self.default}
+
+    def get(self, language_code: str | None) -> Locale:
+        locale = self._by_language_code.get(language_code)
+        if locale is None:
+            # "en-US" -> "en-us", then "en"
+            code = language_code.lower()
+            locale = self.locales.get(code) or self.locales.get(code.split("-")[0]) or self.default
+            self._by_language_code[language_code] = locale
+        return locale
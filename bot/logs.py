@@ -1,6 +1,11 @@
+import atexit
 import logging
+import queue
+import threading
+import time
 from json import dumps
 from sys import stdout
+from typing import TextIO
 
 import structlog
 from structlog import WriteLoggerFactory
@@ -20,6 +25,73 @@ class ProjectNameProcessor:
         return event_dict
 
 
+class QueuedStream:
+    """
+    File-like object that hands writes to a background thread, so the event loop never
+    blocks on stdout. When the queue is full, records are dropped; the writer reports how
+    many every DROP_REPORT_INTERVAL seconds and they're counted in `dropped`.
+    """
+
+    # Lines written to the real stream at once
+    BATCH_SIZE = 512
+    DROP_REPORT_INTERVAL = 10.0
+
+    def __init__(self, stream: TextIO, maxsize: int):
+        self.stream = stream
+        self.dropped = 0
+        self._reported = 0
+        self._queue: queue.Queue[str | None] = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, message: str):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        # The writer thread flushes after every batch
+        pass
+
+    def close(self, timeout: float = 5.0):
+        """Writes what's queued and stops the writer thread."""
+        if self._thread.is_alive():
+            # Blocks if the queue is full: the writer is draining it
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        next_report = time.monotonic() + self.DROP_REPORT_INTERVAL
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.DROP_REPORT_INTERVAL)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            lines = [line for line in batch if line is not None]
+            if time.monotonic() >= next_report or stop:
+                next_report = time.monotonic() + self.DROP_REPORT_INTERVAL
+                dropped, self._reported = self.dropped - self._reported, self.dropped
+                if dropped:
+                    # Plain line: rendering with structlog here could be dropped again
+                    lines.append(dumps({"level": "warning", "event": "Log records dropped", "count": dropped}) + "\n")
+            if lines:
+                try:
+                    self.stream.write("".join(lines))
+                    self.stream.flush()
+                except Exception:
+                    pass
+            if stop:
+                return
+
+
 class DropAiogramUpdateEvents:
     def __call__(
         self, logger: WrappedLogger, name: str, event_dict: EventDict
@@ -31,7 +103,9 @@ class DropAiogramUpdateEvents:
         return event_dict
 
 
-def get_structlog_config(log_config: LogConfig) -> dict:
+def get_structlog_config(log_config: LogConfig, stream: TextIO | None = None) -> dict:
+    """stream: where to write logs, stdout by default (pass a QueuedStream to write from a thread)."""
+    stream = stream or stdout
     if log_config.show_debug_logs is True:
         min_level = logging.DEBUG
     else:
@@ -39,7 +113,7 @@ def get_structlog_config(log_config: LogConfig) -> dict:
 
     if log_config.allow_third_party_logs:
         # Create handler for stdlib logging
-        standard_handler = logging.StreamHandler(stream=stdout)
+        standard_handler = logging.StreamHandler(stream=stream)
         standard_handler.setFormatter(
             structlog.stdlib.ProcessorFormatter(
                 processors=get_processors(log_config)
@@ -56,7 +130,7 @@ def get_structlog_config(log_config: LogConfig) -> dict:
         "processors": get_processors(log_config),
         "cache_logger_on_first_use": True,
         "wrapper_class": structlog.make_filtering_bound_logger(min_level),
-        "logger_factory": WriteLoggerFactory()
+        "logger_factory": WriteLoggerFactory(file=stream)
     }
 
 
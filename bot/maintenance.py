@@ -0,0 +1,112 @@
+"""
+Maintenance commands that operate on the bot database.
+Usage: python -m bot.maintenance <command> [options]
+"""
+import argparse
+import asyncio
+from datetime import date
+
+import structlog
+
+from bot.config_reader import get_config, LogConfig, DatabaseConfig, ReportsConfig, GameConfig
+from bot.storage import Database, create_database
+from bot.logs import get_structlog_config
+
+logger = structlog.get_logger()
+
+
+async def rebuild_daily_stats(db: Database, args: argparse.Namespace):
+    end_date = args.end or db.local_today()
+    days = await db.rebuild_daily_stats(args.start, end_date)
+    await logger.ainfo("Daily stats rebuilt", days=days, start=str(args.start), end=str(end_date))
+
+
+async def backfill_stats(db: Database, args: argparse.Namespace):
+    await db.run_stats_backfill(force=args.force, chunk_size=args.chunk_size)
+
+
+async def backfill_bankruptcies(db: Database, args: argparse.Namespace):
+    await db.run_bankruptcy_backfill(force=args.force, chunk_size=args.chunk_size)
+
+
+async def archive(db: Database, args: argparse.Namespace):
+    await db.run_archival()
+
+
+async def reconcile_ledger(db: Database, args: argparse.Namespace):
+    starting_balance = args.starting_balance
+    if starting_balance is None:
+        starting_balance = get_config(model=GameConfig, root_key="game_config").starting_points
+    divergent = await db.reconcile_ledger(starting_balance, chunk_size=args.chunk_size, full=args.full)
+    for report in divergent[:args.limit]:
+        await logger.awarning("Divergent user", **report)
+    if len(divergent) > args.limit:
+        await logger.awarning("More divergent users not shown", count=len(divergent) - args.limit)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m bot.maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser(
+        "rebuild-daily-stats",
+        help="Recompute the daily_user_stats rollup from event_history"
+    )
+    rebuild.add_argument("--from", dest="start", type=date.fromisoformat, required=True,
+                         help="First local date to rebuild (YYYY-MM-DD)")
+    rebuild.add_argument("--to", dest="end", type=date.fromisoformat, default=None,
+                         help="Last local date to rebuild (YYYY-MM-DD), defaults to today")
+    rebuild.set_defaults(func=rebuild_daily_stats)
+
+    for command, func, help_text in (
+        ("backfill-stats", backfill_stats, "Recompute users' game stats from event_history"),
+        ("backfill-bankruptcies", backfill_bankruptcies, "Recount bankruptcies and add missing bankruptcy events"),
+    ):
+        backfill = subparsers.add_parser(command, help=help_text)
+        backfill.add_argument("--force", action="store_true",
+                              help="Run even if already completed (only new events are processed)")
+        backfill.add_argument("--chunk-size", type=int, default=50_000,
+                              help="Events per transaction")
+        backfill.set_defaults(func=func)
+
+    archive_parser = subparsers.add_parser(
+        "archive",
+        help="Move old months of event_history to archive files and prune old AI dialogues"
+    )
+    archive_parser.set_defaults(func=archive)
+
+    reconcile = subparsers.add_parser(
+        "reconcile-ledger",
+        help="Check users' balances and game stats against event_history"
+    )
+    reconcile.add_argument("--full", action="store_true",
+                           help="Replay the whole history instead of only events since the previous run")
+    reconcile.add_argument("--chunk-size", type=int, default=1000,
+                           help="Users per transaction")
+    reconcile.add_argument("--starting-balance", type=int, default=None,
+                           help="Balance of a new user, defaults to [game_config] starting_points")
+    reconcile.add_argument("--limit", type=int, default=100,
+                           help="Max divergent users to print")
+    reconcile.set_defaults(func=reconcile_ledger)
+
+    return parser
+
+
+async def main():
+    args = get_parser().parse_args()
+
+    log_config = get_config(model=LogConfig, root_key="logs")
+    structlog.configure(**get_structlog_config(log_config))
+
+    database_config = get_config(model=DatabaseConfig, root_key="database")
+    reports_config = get_config(model=ReportsConfig, root_key="reports")
+    db = create_database(database_config, reports_config.timezone)
+    try:
+        await db.create_tables()
+        await args.func(db, args)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+import functools
+import inspect
+import time
+
+import structlog
+from aiohttp import web
+
+from bot.config_reader import MetricsConfig
+from bot.storage import Database
+from bot.utils.metrics import Counter, Histogram, Registry
+
+logger = structlog.get_logger()
+
+REGISTRY = Registry()
+
+UPDATES_IN_FLIGHT = REGISTRY.gauge(
+    "casino_updates_in_flight", "Updates being processed"
+)
+UPDATE_DURATION = REGISTRY.histogram(
+    "casino_update_duration_seconds", "Time to process an update", ["type"]
+)
+HANDLER_DURATION = REGISTRY.histogram(
+    "casino_handler_duration_seconds",
+    "Message handler latency, including throttling and waiting for the user lock",
+    ["handler", "status"],
+)
+DB_CALL_DURATION = REGISTRY.histogram(
+    "casino_db_call_duration_seconds", "Database method latency", ["method"]
+)
+DB_CALL_ERRORS = REGISTRY.counter(
+    "casino_db_call_errors_total", "Database method calls that raised", ["method"]
+)
+TELEGRAM_REQUEST_DURATION = REGISTRY.histogram(
+    "casino_telegram_request_duration_seconds", "Bot API request latency", ["method"]
+)
+TELEGRAM_REQUEST_ERRORS = REGISTRY.counter(
+    "casino_telegram_request_errors_total", "Failed Bot API requests", ["method", "error"]
+)
+AI_REQUEST_DURATION = REGISTRY.histogram(
+    "casino_ai_request_duration_seconds", "AI provider request latency", ["call"],
+    buckets=(0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0),
+)
+AI_REQUEST_ERRORS = REGISTRY.counter(
+    "casino_ai_request_errors_total", "Failed AI provider requests", ["call"]
+)
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    "casino_log_records_dropped_total", "Log records dropped because the log queue was full"
+)
+BACKGROUND_PENDING = REGISTRY.gauge(
+    "casino_background_pending", "Work queued in background tasks", ["queue"]
+)
+
+
+class observe_duration:
+    """
+    Times the block into histogram; exceptions are also counted in errors.
+    Usage: `with observe_duration(AI_REQUEST_DURATION, AI_REQUEST_ERRORS, "greeting"): ...`
+    """
+
+    __slots__ = ("histogram", "errors", "labels", "started")
+
+    def __init__(self, histogram: Histogram, errors: Counter | None, *labels: str):
+        self.histogram = histogram
+        self.errors = errors
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc(*self.labels)
+
+
+def _timed(method, name: str):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        with observe_duration(DB_CALL_DURATION, DB_CALL_ERRORS, name):
+            return await method(*args, **kwargs)
+    return wrapper
+
+
+def instrument_database(db: Database) -> Database:
+    """Wraps the instance's Database coroutine methods to record call counts and latency."""
+    for name in sorted(Database.__abstractmethods__):
+        method = getattr(db, name)
+        if inspect.iscoroutinefunction(method):
+            setattr(db, name, _timed(method, name))
+    return db
+
+
+async def start_metrics_server(config: MetricsConfig) -> web.AppRunner:
+    """Serves REGISTRY on config.host:config.port + config.path. Stop with runner.cleanup()."""
+
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get(config.path, metrics)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.host, config.port).start()
+    await logger.ainfo("Serving metrics", host=config.host, port=config.port, path=config.path)
+    return runner
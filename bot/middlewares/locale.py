@@ -0,0 +1,24 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from bot.localization import Localizations
+
+
+class LocaleMiddleware(BaseMiddleware):
+    """Outer update middleware: replaces l10n with the locale of the user's language_code."""
+
+    def __init__(self, locales: Localizations):
+        self.locales = locales
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is not None:
+            data["l10n"] = self.locales.get(user.language_code)
+        return await handler(event, data)
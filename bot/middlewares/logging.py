@@ -1,45 +1,57 @@
+import itertools
 import time
 from typing import Callable, Dict, Any, Awaitable
 
 import structlog
 from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject, Message, CallbackQuery
+from aiogram.types import TelegramObject, Message, CallbackQuery, Update
 
-from bot.utils.context import db_actions_ctx
+from bot.utils.context import db_actions_ctx, render_db_actions
 
 logger = structlog.get_logger()
 
+
+def describe_action(event: TelegramObject) -> str:
+    action = "Unknown"
+    if isinstance(event, Message):
+        if event.text:
+            action = f"Message: {event.text[:50]}"
+        elif event.caption:
+            action = f"Caption: {event.caption[:50]}"
+        elif event.dice:
+            action = f"Dice: {event.dice.emoji} ({event.dice.value})"
+        elif event.content_type:
+            action = f"Message ({event.content_type})"
+    elif isinstance(event, CallbackQuery):
+        action = f"Callback: {event.data}"
+    return action
+
+
 class LoggingMiddleware(BaseMiddleware):
+    """
+    One log line per update. Successful updates faster than slow_update_ms are sampled
+    (1 in sample_rate is logged, with sample_rate in the record); errors and slow updates
+    are always logged, with the full list of DB actions. The actions are kept as tuples
+    and rendered only for those records; with trace_db_actions off they aren't recorded.
+    """
+
+    def __init__(self, sample_rate: int = 1, slow_update_ms: int = 1000, trace_db_actions: bool = True):
+        self.sample_rate = max(sample_rate, 1)
+        self.slow_update_ms = slow_update_ms
+        self.trace_db_actions = trace_db_actions
+        self._updates = itertools.count()
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        start_time = time.time()
-        
-        # Extract user info
-        user = data.get("event_from_user")
-        nickname = f"@{user.username}" if user and user.username else (user.first_name if user else "Unknown")
-        user_id = user.id if user else None
-        
-        # Determine action
-        action = "Unknown"
-        if isinstance(event, Message):
-            if event.text:
-                action = f"Message: {event.text[:50]}"
-            elif event.caption:
-                action = f"Caption: {event.caption[:50]}"
-            elif event.dice:
-                action = f"Dice: {event.dice.emoji} ({event.dice.value})"
-            elif event.content_type:
-                action = f"Message ({event.content_type})"
-        elif isinstance(event, CallbackQuery):
-            action = f"Callback: {event.data}"
-            
+        start_time = time.perf_counter()
+
         # Initialize DB action tracking
-        token = db_actions_ctx.set([])
-        
+        token = db_actions_ctx.set([] if self.trace_db_actions else None)
+
         error = None
         try:
             result = await handler(event, data)
@@ -48,26 +60,39 @@ class LoggingMiddleware(BaseMiddleware):
             error = str(e)
             raise e
         finally:
-            duration = int((time.time() - start_time) * 1000)
-            db_actions = db_actions_ctx.get()
+            duration = int((time.perf_counter() - start_time) * 1000)
+            db_actions = db_actions_ctx.get() or []
             db_actions_ctx.reset(token)
-            
-            log_event = {
-                "event": "Update handled",
-                "update_id": event.update_id if hasattr(event, "update_id") else None,
-                "duration_ms": duration,
-                "user_id": user_id,
-                "nickname": nickname,
-                "action": action,
-                "db_actions": db_actions,
-                "error": error
-            }
-            
-            # We use 'info' even for errors here to keep the main log stream consistent, 
-            # but if error is present, maybe 'error' level is better? 
-            # The user just asked to see it in the line.
-            if error:
-                logger.error(**log_event)
-            else:
-                logger.info(**log_event)
 
+            notable = error is not None or duration >= self.slow_update_ms
+            # Skip building the record for updates that aren't sampled
+            if notable or next(self._updates) % self.sample_rate == 0:
+                # Extract user info
+                user = data.get("event_from_user")
+                nickname = f"@{user.username}" if user and user.username else (user.first_name if user else "Unknown")
+
+                log_event = {
+                    "event": "Update handled",
+                    "update_id": event.update_id if hasattr(event, "update_id") else None,
+                    "duration_ms": duration,
+                    "user_id": user.id if user else None,
+                    "nickname": nickname,
+                    "action": describe_action(event.event if isinstance(event, Update) else event),
+                    "error": error
+                }
+                if notable:
+                    log_event["db_actions"] = render_db_actions(db_actions)
+                else:
+                    log_event["db_actions_count"] = len(db_actions)
+                    if self.sample_rate > 1:
+                        log_event["sample_rate"] = self.sample_rate
+
+                # We use 'info' even for errors here to keep the main log stream consistent,
+                # but if error is present, maybe 'error' level is better?
+                # The user just asked to see it in the line.
+                if error:
+                    logger.error(**log_event)
+                elif duration >= self.slow_update_ms:
+                    logger.warning(**log_event)
+                else:
+                    logger.info(**log_event)
@@ -0,0 +1,74 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.types import TelegramObject, Update
+
+from bot.metrics import (
+    HANDLER_DURATION, TELEGRAM_REQUEST_DURATION, TELEGRAM_REQUEST_ERRORS, UPDATE_DURATION, UPDATES_IN_FLIGHT,
+)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer update middleware: in-flight updates and total processing time by update type."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        update_type = event.event_type if isinstance(event, Update) else type(event).__name__
+        UPDATES_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_DURATION.observe(time.perf_counter() - started, update_type)
+            UPDATES_IN_FLIGHT.dec()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner message middleware: latency per handler function. Registered before throttling
+    and the user lock, so dropped messages ("throttled") and lock waits are included.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        status = "error"
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+            status = "throttled" if data.get("throttled") else "ok"
+            return result
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, name, status)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware: Bot API request latency and errors by method."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot,
+        method: TelegramMethod,
+    ) -> Response:
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_REQUEST_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_REQUEST_DURATION.observe(time.perf_counter() - started, api_method)
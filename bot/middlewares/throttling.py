@@ -3,16 +3,20 @@ from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.dispatcher.flags import get_flag
 from aiogram.types import Message
-from cachetools import TTLCache
 
+from bot.config_reader import ThrottleRule
+from bot.services.throttling import ThrottleStorage
 
 
 class ThrottlingMiddleware(BaseMiddleware):
-    def __init__(self, throttle_time_spin: int, throttle_time_other: int):
-        self.caches = {
-            "spin": TTLCache(maxsize=10_000, ttl=throttle_time_spin),
-            "default": TTLCache(maxsize=10_000, ttl=throttle_time_other)
-        }
+    """
+    Drops messages of handlers with a throttling_key flag once the user's or the chat's
+    token bucket for that key is empty. One fast player no longer throttles the whole group.
+    """
+
+    def __init__(self, storage: ThrottleStorage, rules: Dict[str, ThrottleRule]):
+        self.storage = storage
+        self.rules = rules
 
     async def __call__(
             self,
@@ -21,9 +25,11 @@ class ThrottlingMiddleware(BaseMiddleware):
             data: Dict[str, Any],
     ) -> Any:
         throttling_key = get_flag(data, "throttling_key")
-        if throttling_key is not None and throttling_key in self.caches:
-            if event.chat.id in self.caches[throttling_key]:
+        rule = self.rules.get(throttling_key) if throttling_key is not None else None
+        if rule is not None:
+            user_id = event.from_user.id if event.from_user else None
+            if not await self.storage.allow(throttling_key, rule, user_id, event.chat.id):
+                # Seen by HandlerMetricsMiddleware
+                data["throttled"] = True
                 return
-            else:
-                self.caches[throttling_key][event.chat.id] = None
         return await handler(event, data)
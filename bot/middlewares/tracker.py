@@ -1,10 +1,12 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, TelegramObject
-from bot.services.group_tracker import save_group
-from bot.db import Database
+from bot.services.group_tracker import GroupTracker
 
 class GroupTrackerMiddleware(BaseMiddleware):
+    def __init__(self, tracker: GroupTracker):
+        self.tracker = tracker
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -16,14 +18,7 @@ class GroupTrackerMiddleware(BaseMiddleware):
             user = event.from_user
 
             if chat.type in ("group", "supergroup"):
-                # Fire and forget saving (don't await if we don't want to block, 
-                # but for file I/O await is better to ensure consistency)
-                await save_group(chat.id, chat.title or "Unknown Group")
-                
-                # Update user-group association
-                db: Database = data.get("db")
-                if db and user:
-                    await db.update_user_group(user.id, chat.id)
-        
-        return await handler(event, data)
+                # Only updates memory; GroupTracker writes changes to the DB in batches
+                self.tracker.seen(chat.id, chat.title or "Unknown Group", user.id if user else None)
 
+        return await handler(event, data)
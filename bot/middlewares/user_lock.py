@@ -0,0 +1,30 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject
+
+from bot.utils.keyed_lock import KeyedLock
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """
+    Runs handlers flagged with user_lock one at a time per user, so their
+    read-modify-write of the user's balance and bid can't interleave.
+    Different users are not blocked by each other.
+    """
+
+    def __init__(self):
+        self.locks = KeyedLock()
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or not get_flag(data, "user_lock"):
+            return await handler(event, data)
+        async with self.locks(user.id):
+            return await handler(event, data)
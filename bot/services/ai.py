@@ -3,9 +3,10 @@ import json
 import logging
 import random
 from typing import Optional, List, Dict, Any
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
 
+from bot.metrics import AI_REQUEST_DURATION, AI_REQUEST_ERRORS, observe_duration
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -24,15 +25,16 @@ class AIClient:
             if "/" not in self.model_name:
                 self.model_name = f"openai/{self.model_name}"
         
-        if base_url:
-            self.client = AsyncOpenAI(
-                base_url=base_url,
-                api_key=api_key,
-            )
-        else:
-            self.client = AsyncOpenAI(
-                api_key=api_key
-            )
+        self._client_kwargs = {"base_url": base_url, "api_key": api_key} if base_url else {"api_key": api_key}
+        self._client = None
+
+    @property
+    def client(self):
+        # openai takes a large part of the bot's import time, so it's imported on the first request
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(**self._client_kwargs)
+        return self._client
 
     async def generate_initial_greeting(self) -> str:
         try:
@@ -93,11 +95,12 @@ class AIClient:
                 "Твой ответ (только текст требования):"
             )
             
-            response = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "system", "content": prompt}],
-                temperature=0.6
-            )
+            with observe_duration(AI_REQUEST_DURATION, AI_REQUEST_ERRORS, "greeting"):
+                response = await self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=[{"role": "system", "content": prompt}],
+                    temperature=0.6
+                )
             content = response.choices[0].message.content.strip()
             # Fallback if empty
             if not content:
@@ -206,11 +209,12 @@ class AIClient:
                 {"role": "system", "content": system_prompt}
             ]
 
-            response = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=0.4
-            )
+            with observe_duration(AI_REQUEST_DURATION, AI_REQUEST_ERRORS, "response"):
+                response = await self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    temperature=0.4
+                )
 
             content = response.choices[0].message.content
             
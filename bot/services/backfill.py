@@ -1,8 +1,7 @@
 import asyncio
 import structlog
-import aiosqlite
 from aiogram import Bot
-from bot.db import Database
+from bot.storage import Database
 
 logger = structlog.get_logger()
 
@@ -17,11 +16,9 @@ async def backfill_usernames(bot: Bot, db: Database):
     users_to_update = []
     
     try:
-        # Read directly from DB to get all users
-        async with aiosqlite.connect(db.db_path) as db_conn:
-            async with db_conn.execute("SELECT user_id, nickname FROM users") as cursor:
-                async for row in cursor:
-                    users_to_update.append({"user_id": row[0], "current_nickname": row[1]})
+        # Read all users from DB
+        for user_id, nickname in await db.get_all_user_nicknames():
+            users_to_update.append({"user_id": user_id, "current_nickname": nickname})
         
         await logger.ainfo(f"Found {len(users_to_update)} users to check.")
         
@@ -0,0 +1,133 @@
+import asyncio
+import time
+import uuid
+from contextlib import suppress
+from dataclasses import dataclass, field
+
+import structlog
+
+from bot.storage import Database
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class CreditSession:
+    session_id: str
+    user_id: int
+    status: str = "active"  # active, processing
+    last_activity: float = field(default_factory=time.monotonic)
+
+
+class CreditSessionRegistry:
+    """
+    Open AI credit sessions, kept in memory.
+
+    The registry is the source of truth for sessions that are in progress: handlers
+    check and change them without touching the DB. Every transition is queued and
+    written to ai_credit_sessions / users.state in order by a background task.
+    Sessions without activity for idle_timeout_minutes are closed as 'expired'.
+    """
+
+    def __init__(self, db: Database, idle_timeout_minutes: int):
+        self.db = db
+        self.idle_timeout = idle_timeout_minutes * 60
+        self._sessions: dict[int, CreditSession] = {}
+        self._writes: asyncio.Queue[tuple] = asyncio.Queue()
+        self._persist_task: asyncio.Task | None = None
+        self._expire_task: asyncio.Task | None = None
+
+    def start(self):
+        """Starts the background persistence and expiry tasks."""
+        self._persist_task = asyncio.create_task(self._persist_loop())
+        if self.idle_timeout > 0:
+            self._expire_task = asyncio.create_task(self._expire_loop())
+
+    async def close(self):
+        """Stops expiry and writes all queued transitions. Registered as a Dispatcher shutdown hook."""
+        if self._expire_task is not None:
+            self._expire_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._expire_task
+            self._expire_task = None
+        if self._persist_task is not None:
+            await self._writes.join()
+            self._persist_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._persist_task
+            self._persist_task = None
+        # Not started (or already stopped): write leftovers inline
+        while not self._writes.empty():
+            await self._apply(*self._writes.get_nowait())
+            self._writes.task_done()
+
+    @property
+    def pending_writes(self) -> int:
+        return self._writes.qsize()
+
+    def in_dialogue(self, user_id: int) -> bool:
+        return user_id in self._sessions
+
+    def get(self, user_id: int) -> CreditSession | None:
+        return self._sessions.get(user_id)
+
+    def open_session(self, user_id: int) -> CreditSession:
+        session = CreditSession(session_id=str(uuid.uuid4()), user_id=user_id)
+        self._sessions[user_id] = session
+        self._persist(self.db.create_credit_session, session.session_id, user_id)
+        self._persist(self.db.update_user_state, user_id, "IN_DIALOGUE")
+        return session
+
+    def acquire(self, user_id: int) -> CreditSession | None:
+        """Marks the user's session as processing. Returns None if there is none or it's already busy."""
+        session = self._sessions.get(user_id)
+        if session is None or session.status != "active":
+            return None
+        session.status = "processing"
+        session.last_activity = time.monotonic()
+        self._persist(self.db.update_session_status, session.session_id, "processing")
+        return session
+
+    def release(self, user_id: int):
+        """Makes a processing session accept the next message."""
+        session = self._sessions.get(user_id)
+        if session is None or session.status != "processing":
+            return
+        session.status = "active"
+        session.last_activity = time.monotonic()
+        self._persist(self.db.update_session_status, session.session_id, "active")
+
+    def finish_session(self, user_id: int, status: str, score: int = 0, reward: int = 0):
+        session = self._sessions.pop(user_id, None)
+        if session is None:
+            return
+        self._persist(self.db.close_credit_session, session.session_id, status, score, reward)
+        self._persist(self.db.update_user_state, user_id, "IDLE")
+
+    def _persist(self, func, *args):
+        self._writes.put_nowait((func, args))
+
+    async def _apply(self, func, args):
+        try:
+            await func(*args)
+        except Exception as e:
+            await logger.aerror("Failed to persist credit session change", action=func.__name__, error=str(e))
+
+    async def _persist_loop(self):
+        while True:
+            func, args = await self._writes.get()
+            try:
+                await self._apply(func, args)
+            finally:
+                self._writes.task_done()
+
+    async def _expire_loop(self):
+        interval = min(60, max(1, self.idle_timeout // 2))
+        while True:
+            await asyncio.sleep(interval)
+            deadline = time.monotonic() - self.idle_timeout
+            expired = [user_id for user_id, session in self._sessions.items() if session.last_activity < deadline]
+            for user_id in expired:
+                self.finish_session(user_id, "expired")
+            if expired:
+                await logger.ainfo("Expired idle credit sessions", count=len(expired))
@@ -1,38 +1,27 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import pytz
 import uuid
-from bot.db import Database
+from bot.storage import Database
 from aiogram import Bot
 
 class DailyStatsService:
-    def __init__(self, db: Database, bot: Bot):
+    def __init__(self, db: Database, bot: Bot, timezone: str = 'Asia/Yekaterinburg'):
         self.db = db
         self.bot = bot
-        self.timezone = pytz.timezone('Asia/Yekaterinburg') # UTC+5
+        self.timezone = pytz.timezone(timezone)
 
-    def get_yesterday_range(self):
-        """Returns (start_utc_str, end_utc_str) for yesterday in UTC+5"""
+    def get_report_date(self, use_today: bool = False) -> date:
+        """Returns the local date to report on: yesterday, or today (so far) for drafts"""
         now = datetime.now(self.timezone)
-        yesterday = now - timedelta(days=1)
-        
-        # Start of yesterday (00:00:00 local)
-        start_local = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-        # End of yesterday (23:59:59 local)
-        end_local = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-        
-        # Convert to UTC for DB query
-        start_utc = start_local.astimezone(pytz.UTC)
-        end_utc = end_local.astimezone(pytz.UTC)
-        
-        return start_utc.strftime("%Y-%m-%d %H:%M:%S"), end_utc.strftime("%Y-%m-%d %H:%M:%S"), start_local.strftime("%d.%m.%Y")
+        if use_today:
+            return now.date()
+        return (now - timedelta(days=1)).date()
 
     async def generate_and_send_report(self, chat_id: int, is_dry_run: bool = False, use_today: bool = False):
-        if use_today:
-            start_utc, end_utc, date_str = self.get_today_range_so_far()
-        else:
-            start_utc, end_utc, date_str = self.get_yesterday_range()
+        report_date = self.get_report_date(use_today)
+        date_str = report_date.strftime("%d.%m.%Y")
         
-        stats = await self.db.get_daily_stats(start_utc, end_utc, chat_id)
+        stats = await self.db.get_daily_rollup(report_date, chat_id)
         
         if not stats:
             # No stats for yesterday
@@ -63,17 +52,8 @@ class DailyStatsService:
             games = row['games_played']
             row['luck_ratio'] = 0
             if games >= 5: # Minimum games threshold for Luck Rate to be statistically relevant
-                 # Luck = (won_games / total_games) * 100. 
-                 # But we don't have 'won_games' count in the query, we have 'total_won' sum.
-                 # To get exact win rate we need count of win events.
-                 # Let's adjust the query or estimate? 
-                 # Actually, in the SQL query we only aggregated total_won amount, not count.
-                 # Let's just use (total_won / (total_won + total_lost)) ratio as a proxy for "Money Luck"?
-                 # Or better: re-query or adjust SQL.
-                 # For now, let's stick to Money Ratio: Won / (Won + Lost)
-                 total_volume = row['total_won'] + row['total_lost']
-                 if total_volume > 0:
-                    row['luck_ratio'] = round((row['total_won'] / total_volume) * 100, 1)
+                 # Luck = (won_games / total_games) * 100
+                 row['luck_ratio'] = round((row['games_won'] / games) * 100, 1)
             
             if games < 5:
                 # Disqualify from boring if too few games
@@ -164,13 +144,3 @@ class DailyStatsService:
             await self.bot.send_message(chat_id, message_text)
         except Exception as e:
             print(f"Failed to send daily report to {chat_id}: {e}")
-
-    def get_today_range_so_far(self):
-        # Helper for testing: returns range from start of TODAY until NOW
-        now = datetime.now(self.timezone)
-        start_local = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        start_utc = start_local.astimezone(pytz.UTC)
-        end_utc = now.astimezone(pytz.UTC)
-        
-        return start_utc.strftime("%Y-%m-%d %H:%M:%S"), end_utc.strftime("%Y-%m-%d %H:%M:%S"), start_local.strftime("%d.%m.%Y")
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import math
+import time
+from collections import defaultdict
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import structlog
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from bot.storage import Database
+
+logger = structlog.get_logger()
+
+# Wheel resolution (seconds) and size: one revolution covers TICK_SECONDS * WHEEL_SLOTS seconds,
+# longer delays just stay in their slot for more revolutions
+TICK_SECONDS = 0.25
+WHEEL_SLOTS = 512
+# New and finished persisted actions are written to the DB in one batch this often (seconds)
+FLUSH_INTERVAL = 1.0
+# deleteMessages accepts up to 100 message ids
+DELETE_BATCH_SIZE = 100
+# Due deletions wait this long (seconds) for more deletions in the same chat, unless a full batch is collected
+DELETE_FLUSH_WINDOW = 1.5
+
+DELETE_MESSAGE = "delete_message"
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel. Timers are bucketed by expiry tick, so adding one is O(1)
+    and advancing a tick only looks at a single bucket, however many timers are pending.
+    """
+
+    def __init__(self, slots: int):
+        self._slots: list[list[tuple[int, Any]]] = [[] for _ in range(slots)]
+        self.tick = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, ticks: int, item: Any):
+        """Schedules item to be returned by advance() in `ticks` ticks (at least one)."""
+        expiry = self.tick + max(ticks, 1)
+        self._slots[expiry % len(self._slots)].append((expiry, item))
+        self._count += 1
+
+    def advance(self) -> list[Any]:
+        """Moves to the next tick and returns the items that expired on it."""
+        self.tick += 1
+        slot = self._slots[self.tick % len(self._slots)]
+        if not slot:
+            return []
+        due = [item for expiry, item in slot if expiry <= self.tick]
+        if due:
+            slot[:] = [entry for entry in slot if entry[0] > self.tick]
+            self._count -= len(due)
+        return due
+
+
+@dataclass
+class _Call:
+    callback: Callable[[], Any]
+
+
+@dataclass
+class _Deletion:
+    action_id: str
+    chat_id: int
+    message_id: int
+
+
+class DelayedActions:
+    """
+    Runs deferred actions from a single timer wheel instead of a sleeping task per action.
+
+    call_later() runs a callback in memory only (e.g. replying once the slot machine
+    animation ends). delete_message_later() is persisted in pending_actions, so messages
+    are still deleted after a restart. Due deletions are buffered per chat for
+    DELETE_FLUSH_WINDOW seconds (or until DELETE_BATCH_SIZE are collected) and sent
+    as a single deleteMessages call.
+    """
+
+    def __init__(self, bot: Bot, db: Database):
+        self.bot = bot
+        self.db = db
+        self._wheel = TimerWheel(WHEEL_SLOTS)
+        self._origin = time.monotonic()
+        # Persisted actions not written yet, and written ones that are done
+        self._unsaved: dict[str, tuple[str, str, int, int, str]] = {}
+        self._finished: list[str] = []
+        self._worker: asyncio.Task | None = None
+        self._deletes: set[asyncio.Task] = set()
+        # Due deletions per chat, and when each chat's buffer is sent (monotonic time)
+        self._delete_buffer: dict[int, list[_Deletion]] = defaultdict(list)
+        self._delete_deadlines: dict[int, float] = {}
+
+    async def start(self):
+        """Reloads persisted actions left by a previous run and starts the wheel."""
+        now = time.time()
+        for row in await self.db.get_pending_actions():
+            if row["kind"] == DELETE_MESSAGE:
+                payload = json.loads(row["payload"])
+                self._add(row["due_ts"] - now, _Deletion(row["action_id"], row["chat_id"], payload["message_id"]))
+        if len(self._wheel):
+            await logger.ainfo("Reloaded delayed actions", count=len(self._wheel))
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self):
+        """
+        Stops the wheel and writes outstanding changes; persisted actions that aren't due
+        yet run after the next start. Registered as a Dispatcher shutdown hook.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
+        # Don't wait out the flush window
+        for chat_id in list(self._delete_buffer):
+            self._send_deletions(chat_id)
+        if self._deletes:
+            await asyncio.gather(*self._deletes, return_exceptions=True)
+        await self._flush()
+
+    @property
+    def pending(self) -> int:
+        return len(self._wheel) + sum(len(items) for items in self._delete_buffer.values())
+
+    def call_later(self, delay: float, callback: Callable[[], Any]):
+        """Runs callback (a plain function) after delay seconds. Not persisted."""
+        self._add(delay, _Call(callback))
+
+    def delete_message_later(self, chat_id: int, message_id: int, delay: float):
+        action_id = f"{DELETE_MESSAGE}:{chat_id}:{message_id}"
+        self._unsaved[action_id] = (
+            action_id, DELETE_MESSAGE, chat_id, math.ceil(time.time() + delay), json.dumps({"message_id": message_id})
+        )
+        self._add(delay, _Deletion(action_id, chat_id, message_id))
+
+    def _add(self, delay: float, item: _Call | _Deletion):
+        expiry_tick = math.ceil((time.monotonic() + delay - self._origin) / TICK_SECONDS)
+        self._wheel.add(expiry_tick - self._wheel.tick, item)
+
+    def _finish(self, action_ids: list[str]):
+        for action_id in action_ids:
+            # Never written: nothing to delete
+            if self._unsaved.pop(action_id, None) is None:
+                self._finished.append(action_id)
+
+    async def _flush(self):
+        rows, self._unsaved = list(self._unsaved.values()), {}
+        finished, self._finished = self._finished, []
+        try:
+            if rows:
+                await self.db.save_pending_actions(rows)
+            if finished:
+                await self.db.delete_pending_actions(finished)
+        except Exception as e:
+            # Keep them for the next flush
+            self._unsaved.update((row[0], row) for row in rows)
+            self._finished.extend(finished)
+            await logger.aerror("Failed to save delayed actions", error=str(e))
+
+    async def _run(self):
+        next_flush = time.monotonic() + FLUSH_INTERVAL
+        while True:
+            await asyncio.sleep(max(0.0, self._origin + (self._wheel.tick + 1) * TICK_SECONDS - time.monotonic()))
+            now = time.monotonic()
+            # Catch up on ticks missed while the event loop was busy
+            due = []
+            while self._origin + (self._wheel.tick + 1) * TICK_SECONDS <= now:
+                due.extend(self._wheel.advance())
+            if due:
+                self._run_due(due)
+            for chat_id, deadline in list(self._delete_deadlines.items()):
+                if deadline <= now:
+                    self._send_deletions(chat_id)
+            if now >= next_flush:
+                await self._flush()
+                next_flush = now + FLUSH_INTERVAL
+
+    def _run_due(self, due: list[_Call | _Deletion]):
+        for item in due:
+            if isinstance(item, _Deletion):
+                self._buffer_deletion(item)
+                continue
+            try:
+                item.callback()
+            except Exception as e:
+                logger.error("Delayed callback failed", error=str(e))
+
+    def _buffer_deletion(self, item: _Deletion):
+        buffer = self._delete_buffer[item.chat_id]
+        if not buffer:
+            self._delete_deadlines[item.chat_id] = time.monotonic() + DELETE_FLUSH_WINDOW
+        buffer.append(item)
+        if len(buffer) >= DELETE_BATCH_SIZE:
+            self._send_deletions(item.chat_id)
+
+    def _send_deletions(self, chat_id: int):
+        items = self._delete_buffer.pop(chat_id)
+        del self._delete_deadlines[chat_id]
+        task = asyncio.create_task(self._delete_batch(chat_id, items))
+        self._deletes.add(task)
+        task.add_done_callback(self._deletes.discard)
+
+    async def _delete_batch(self, chat_id: int, items: list[_Deletion]):
+        try:
+            await self.bot.delete_messages(chat_id=chat_id, message_ids=[item.message_id for item in items])
+        except TelegramRetryAfter as e:
+            for item in items:
+                self._add(e.retry_after, item)
+            return
+        except TelegramBadRequest as e:
+            # None of the messages could be deleted (already gone, or older than 48 hours)
+            await logger.adebug("Delayed deletion skipped", chat_id=chat_id, error=str(e))
+        except Exception as e:
+            await logger.awarning("Delayed deletion failed", chat_id=chat_id, count=len(items), error=str(e))
+        self._finish([item.action_id for item in items])
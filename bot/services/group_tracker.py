@@ -1,32 +1,104 @@
-import json
 import asyncio
+import json
+import time
+from contextlib import suppress
 from pathlib import Path
-from typing import Dict
 
-GROUPS_FILE = Path("groups.json")
+import structlog
+
+from bot.config_reader import GroupTrackingConfig
+from bot.storage import Database
+
+logger = structlog.get_logger()
+
+# Chat titles used to be kept here; titles missing from the DB are imported on start
+LEGACY_GROUPS_FILE = Path("groups.json")
+
 
-def _read_groups_sync() -> Dict[str, str]:
-    if not GROUPS_FILE.exists():
+def _read_legacy_groups() -> dict[int, str]:
+    if not LEGACY_GROUPS_FILE.exists():
         return {}
     try:
-        with open(GROUPS_FILE, mode='r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(LEGACY_GROUPS_FILE, mode='r', encoding='utf-8') as f:
+            return {int(chat_id): title for chat_id, title in json.load(f).items()}
     except Exception:
         return {}
 
-def _save_group_sync(chat_id: int, title: str):
-    groups = _read_groups_sync()
-    str_id = str(chat_id)
-    
-    # Only write if new or title changed
-    if str_id not in groups or groups[str_id] != title:
-        groups[str_id] = title
-        with open(GROUPS_FILE, mode='w', encoding='utf-8') as f:
-            json.dump(groups, f, indent=2, ensure_ascii=False)
 
-async def load_groups() -> Dict[str, str]:
-    return await asyncio.to_thread(_read_groups_sync)
+class GroupTracker:
+    """
+    Known group chats and (user, chat) pairs, kept in memory.
+
+    seen() only changes memory. A chat is written when it's new or its title changed,
+    a pair when it's new or its last write was last_seen_granularity_minutes ago;
+    changes are saved in one transaction every flush_interval_seconds.
+    """
+
+    def __init__(self, db: Database, config: GroupTrackingConfig):
+        self.db = db
+        self.config = config
+        self._titles: dict[int, str] = {}
+        # (user_id, chat_id) -> unix time last_seen was last saved (or queued) with.
+        # Only pairs written within the granularity window: older ones are dropped on flush
+        self._last_seen: dict[tuple[int, int], int] = {}
+        self._dirty_chats: dict[int, str] = {}
+        self._dirty_pairs: dict[tuple[int, int], int] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    async def start(self):
+        """Loads known chats and starts the periodic flush."""
+        self._titles = await self.db.get_chat_titles()
+        legacy = await asyncio.to_thread(_read_legacy_groups)
+        for chat_id, title in legacy.items():
+            if chat_id not in self._titles:
+                self._titles[chat_id] = self._dirty_chats[chat_id] = title
+        if self._dirty_chats:
+            await logger.ainfo("Importing chat titles from groups.json", count=len(self._dirty_chats))
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stops the periodic flush and saves what's left. Registered as a Dispatcher shutdown hook."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+    def seen(self, chat_id: int, title: str, user_id: int | None):
+        if self._titles.get(chat_id) != title:
+            self._titles[chat_id] = self._dirty_chats[chat_id] = title
+        if user_id is None:
+            return
+        now = int(time.time())
+        key = (user_id, chat_id)
+        last = self._last_seen.get(key)
+        if last is None or now - last >= self.config.last_seen_granularity_minutes * 60:
+            self._last_seen[key] = self._dirty_pairs[key] = now
+
+    async def flush(self):
+        self._forget_old_pairs()
+        if not self._dirty_chats and not self._dirty_pairs:
+            return
+        chats, self._dirty_chats = self._dirty_chats, {}
+        pairs, self._dirty_pairs = self._dirty_pairs, {}
+        try:
+            await self.db.save_group_activity(
+                list(chats.items()),
+                [(user_id, chat_id, last_seen) for (user_id, chat_id), last_seen in pairs.items()],
+            )
+        except Exception as e:
+            # Retry with the next flush; newer changes win
+            self._dirty_chats = {**chats, **self._dirty_chats}
+            self._dirty_pairs = {**pairs, **self._dirty_pairs}
+            await logger.aerror("Failed to save group activity", error=str(e))
 
-async def save_group(chat_id: int, title: str):
-    await asyncio.to_thread(_save_group_sync, chat_id, title)
+    def _forget_old_pairs(self):
+        # A pair older than the window is written again on its next message anyway
+        cutoff = int(time.time()) - self.config.last_seen_granularity_minutes * 60
+        self._last_seen = {key: last for key, last in self._last_seen.items() if last > cutoff}
 
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.config.flush_interval_seconds)
+            await self.flush()
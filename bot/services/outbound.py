@@ -0,0 +1,268 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import suppress
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any
+
+import structlog
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from bot.config_reader import OutboundConfig
+from bot.utils.token_bucket import TokenBucket
+
+logger = structlog.get_logger()
+
+# A message that keeps getting 429 is given up after this many attempts
+MAX_SEND_ATTEMPTS = 5
+# Idle chats are forgotten once their bucket is full again; checked this often (seconds)
+SWEEP_INTERVAL = 60
+
+
+class Priority(IntEnum):
+    HIGH = 0  # jackpots, bankruptcies
+    NORMAL = 1  # command replies
+    LOW = 2  # routine win messages; dropped if they wait longer than routine_ttl_seconds
+
+
+@dataclass(order=True)
+class _Outgoing:
+    priority: int
+    seq: int
+    method: TelegramMethod = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+@dataclass
+class _ChatQueue:
+    bucket: TokenBucket
+    items: list[_Outgoing] = field(default_factory=list)  # heap
+    blocked_until: float = 0.0  # retry_after from Telegram
+    busy: bool = False  # a message to this chat is being sent
+    waiting: bool = False  # scheduled in OutboundQueue._waiting
+
+
+class OutboundQueue:
+    """
+    Sends bot messages in the background within Telegram's rate limits.
+
+    Every chat has its own token bucket (groups and private chats have different
+    limits) and all chats share a global one. Messages to one chat are sent one at
+    a time, highest priority first and in order within a priority; different chats
+    are sent concurrently. A 429 pauses the chat for retry_after and puts the
+    message back in front of its queue.
+
+    send() returns right away with a future of the method result; handlers that
+    don't need the result don't await it, failures are logged here.
+    """
+
+    def __init__(self, bot: Bot, config: OutboundConfig):
+        self.bot = bot
+        self.config = config
+        self._global = TokenBucket(config.global_per_second, config.global_per_second)
+        self._slots = asyncio.Semaphore(config.max_concurrent_sends)
+        self._chats: dict[int, _ChatQueue] = {}
+        # (priority, seq, chat_id) of chats that can send their head message; may hold stale entries
+        self._ready: list[tuple[int, int, int]] = []
+        # (monotonic time, chat_id) of chats waiting for a token or retry_after
+        self._waiting: list[tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+        self._seq = itertools.count()
+        self._worker: asyncio.Task | None = None
+        self._sends: set[asyncio.Task] = set()
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        """Starts the background sender."""
+        self._worker = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10.0):
+        """Waits up to timeout seconds for queued messages, then stops. Registered as a Dispatcher shutdown hook."""
+        if self._worker is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.pending or self._sends) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            await logger.awarning("Dropping unsent messages on shutdown", count=self.pending)
+        self._worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._worker
+        self._worker = None
+        for task in list(self._sends):
+            task.cancel()
+        for chat in self._chats.values():
+            for item in chat.items:
+                item.future.cancel()
+        self._chats.clear()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(chat.items) for chat in self._chats.values())
+
+    def stats(self) -> dict[str, Any]:
+        """Queue depth and counters."""
+        by_priority = {priority.name.lower(): 0 for priority in Priority}
+        for chat in self._chats.values():
+            for item in chat.items:
+                by_priority[Priority(item.priority).name.lower()] += 1
+        return {
+            "pending": sum(by_priority.values()),
+            "pending_by_priority": by_priority,
+            "chats": len(self._chats),
+            "in_flight": len(self._sends),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def send(self, method: TelegramMethod, priority: Priority = Priority.NORMAL) -> asyncio.Future:
+        """Queues a chat method (e.g. message.reply(...) without await) and returns a future of its result."""
+        future = asyncio.get_running_loop().create_future()
+        # Failures are logged by the sender; don't warn about futures nobody awaits
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if self._worker is None:
+            # Not started: send directly
+            task = asyncio.create_task(self.bot(method))
+            task.add_done_callback(lambda t: self._resolve(future, t))
+            return future
+
+        chat_id = method.chat_id
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatQueue(bucket=self._chat_bucket(chat_id))
+        heapq.heappush(chat.items, _Outgoing(priority, next(self._seq), method, future, time.monotonic()))
+        self._schedule(chat_id, chat)
+        return future
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        if isinstance(chat_id, int) and chat_id > 0:
+            return TokenBucket(self.config.private_per_second, self.config.private_per_second)
+        # Groups, supergroups and channels (@username)
+        return TokenBucket(self.config.group_per_minute / 60, self.config.group_burst)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, task: asyncio.Task):
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def _schedule(self, chat_id: int, chat: _ChatQueue):
+        if chat.items and not chat.busy and not chat.waiting:
+            head = chat.items[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+            self._wakeup.set()
+
+    def _pop_ready(self) -> tuple[int, _ChatQueue] | None:
+        while self._ready:
+            _, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            # Stale entry: the chat is busy, waiting, or got a higher priority message meanwhile
+            if chat is None or chat.busy or chat.waiting or not chat.items or chat.items[0].seq != seq:
+                continue
+            return chat_id, chat
+        return None
+
+    def _sweep(self, now: float):
+        for chat_id in [
+            chat_id for chat_id, chat in self._chats.items()
+            if not chat.items and not chat.busy and not chat.waiting and chat.bucket.full(now)
+        ]:
+            del self._chats[chat_id]
+
+    async def _run(self):
+        next_sweep = time.monotonic() + SWEEP_INTERVAL
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, chat_id = heapq.heappop(self._waiting)
+                chat = self._chats.get(chat_id)
+                if chat is not None:
+                    chat.waiting = False
+                    self._schedule(chat_id, chat)
+            if now >= next_sweep:
+                self._sweep(now)
+                next_sweep = now + SWEEP_INTERVAL
+
+            entry = self._pop_ready()
+            if entry is None:
+                self._wakeup.clear()
+                timeout = self._waiting[0][0] - now if self._waiting else SWEEP_INTERVAL
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                continue
+            chat_id, chat = entry
+
+            ttl = self.config.routine_ttl_seconds
+            head = chat.items[0]
+            if head.priority == Priority.LOW and ttl > 0 and now - head.enqueued_at > ttl:
+                heapq.heappop(chat.items)
+                if not head.future.done():
+                    head.future.set_result(None)
+                self.dropped += 1
+                self._schedule(chat_id, chat)
+                continue
+
+            wait = max(chat.blocked_until - now, chat.bucket.delay(now))
+            if wait > 0:
+                chat.waiting = True
+                heapq.heappush(self._waiting, (now + wait, chat_id))
+                continue
+
+            delay = self._global.delay(now)
+            if delay > 0:
+                self._schedule(chat_id, chat)
+                await asyncio.sleep(delay)
+                continue
+
+            await self._slots.acquire()
+            now = time.monotonic()
+            self._global.take(now)
+            chat.bucket.take(now)
+            chat.busy = True
+            task = asyncio.create_task(self._send(chat_id, chat, heapq.heappop(chat.items)))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, chat_id: int, chat: _ChatQueue, item: _Outgoing):
+        item.attempts += 1
+        try:
+            result = await self.bot(item.method)
+        except TelegramRetryAfter as e:
+            chat.blocked_until = time.monotonic() + e.retry_after
+            if item.attempts < MAX_SEND_ATTEMPTS:
+                # Same seq: back in front of its priority
+                heapq.heappush(chat.items, item)
+                self.retried += 1
+            else:
+                self.failed += 1
+                item.future.set_exception(e)
+                await logger.awarning("Giving up on message after repeated flood limits", chat_id=chat_id, method=item.method.__api_method__)
+        except Exception as e:
+            self.failed += 1
+            if not item.future.done():
+                item.future.set_exception(e)
+            await logger.awarning("Failed to send message", chat_id=chat_id, method=item.method.__api_method__, error=str(e))
+        else:
+            self.sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            chat.busy = False
+            self._slots.release()
+            self._schedule(chat_id, chat)
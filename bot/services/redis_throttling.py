@@ -0,0 +1,71 @@
+import structlog
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from bot.config_reader import ThrottleRule
+from bot.services.throttling import ThrottleStorage
+
+logger = structlog.get_logger()
+
+# KEYS: user bucket, chat bucket. ARGV: user rate, user burst, chat rate, chat burst.
+# Buckets with rate 0 aren't checked. A token is taken from every checked bucket only if all
+# of them have one, so a message dropped by the chat limit doesn't use up the user's tokens.
+# Server time keeps the buckets consistent however far apart the bot processes' clocks are.
+TAKE_TOKENS_LUA = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+for i = 1, 2 do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    if rate > 0 then
+        local burst = tonumber(ARGV[i * 2])
+        local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+        local level = burst
+        if state[1] then
+            level = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+        end
+        if level < 1 then
+            return 0
+        end
+        levels[i] = level
+    end
+end
+for i = 1, 2 do
+    if levels[i] then
+        local rate = tonumber(ARGV[i * 2 - 1])
+        local burst = tonumber(ARGV[i * 2])
+        redis.call('HSET', KEYS[i], 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+        -- A full bucket is the same as a missing one
+        redis.call('PEXPIRE', KEYS[i], math.ceil(burst / rate * 1000))
+    end
+end
+return 1
+"""
+
+
+class RedisThrottleStorage(ThrottleStorage):
+    """Buckets in Redis, shared by all bot processes; updated atomically by a Lua script."""
+
+    def __init__(self, redis: Redis, key_prefix: str):
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self._take_tokens = redis.register_script(TAKE_TOKENS_LUA)
+
+    async def allow(self, key: str, rule: ThrottleRule, user_id: int | None, chat_id: int) -> bool:
+        user_rate = rule.user_per_second if user_id is not None else 0
+        try:
+            allowed = await self._take_tokens(
+                keys=[
+                    f"{self.key_prefix}:{key}:user:{user_id or 0}",
+                    f"{self.key_prefix}:{key}:chat:{chat_id}",
+                ],
+                args=[user_rate, rule.user_burst, rule.chat_per_second, rule.chat_burst],
+            )
+        except RedisError as e:
+            # Better to let a message through than to drop everything while Redis is down
+            await logger.awarning("Throttling storage unavailable, not throttling", error=str(e))
+            return True
+        return bool(allowed)
+
+    async def close(self):
+        await self.redis.aclose()
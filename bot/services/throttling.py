@@ -0,0 +1,56 @@
+import time
+from abc import ABC, abstractmethod
+
+import structlog
+from cachetools import TTLCache
+
+from bot.config_reader import ThrottleRule
+from bot.utils.token_bucket import TokenBucket
+
+logger = structlog.get_logger()
+
+# Buckets kept per throttling key and scope; an evicted bucket is simply full again
+MEMORY_MAX_BUCKETS = 10_000
+
+
+class ThrottleStorage(ABC):
+    """Per-user and per-chat token buckets of the throttling middleware."""
+
+    @abstractmethod
+    async def allow(self, key: str, rule: ThrottleRule, user_id: int | None, chat_id: int) -> bool:
+        """Takes a token from the user's and the chat's bucket. False if either is empty."""
+
+    async def close(self):
+        pass
+
+
+class MemoryThrottleStorage(ThrottleStorage):
+    """Buckets in process memory: every bot process throttles on its own."""
+
+    def __init__(self):
+        self._caches: dict[tuple[str, str], TTLCache] = {}
+
+    def _bucket(self, key: str, scope: str, entity_id: int, rate: float, burst: float) -> TokenBucket:
+        cache = self._caches.get((key, scope))
+        if cache is None:
+            # Idle for burst / rate seconds: the bucket is full again and can be dropped
+            cache = self._caches[(key, scope)] = TTLCache(maxsize=MEMORY_MAX_BUCKETS, ttl=burst / rate)
+        bucket = cache.get(entity_id)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        # (Re)inserting restarts the TTL
+        cache[entity_id] = bucket
+        return bucket
+
+    async def allow(self, key: str, rule: ThrottleRule, user_id: int | None, chat_id: int) -> bool:
+        buckets = []
+        if rule.user_per_second > 0 and user_id is not None:
+            buckets.append(self._bucket(key, "user", user_id, rule.user_per_second, rule.user_burst))
+        if rule.chat_per_second > 0:
+            buckets.append(self._bucket(key, "chat", chat_id, rule.chat_per_second, rule.chat_burst))
+        now = time.monotonic()
+        if any(bucket.delay(now) > 0 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.take(now)
+        return True
@@ -0,0 +1,73 @@
+import builtins
+import sys
+import threading
+import time
+
+import structlog
+
+# Imports faster than this are left out of the report
+IMPORT_REPORT_THRESHOLD = 0.001
+
+
+class StartupProfile:
+    """
+    Time of each startup phase, from the import of this module (the first one of the bot)
+    until the bot is ready to receive updates. With track_imports, also the time of every
+    module import made meanwhile, like `python -X importtime` but split by phase.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self._phase = "imports"
+        self._phase_started = self.started
+        self._finished = False
+        # [phase, depth, module, seconds], in the order the imports started
+        self.imports: list[list] | None = None
+        self._import_depth = 0
+        self._original_import = builtins.__import__
+
+    def track_imports(self):
+        self.imports = []
+        main_thread = threading.get_ident()
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            # Only first imports take time; skip other threads, they'd break the nesting
+            if level or name in sys.modules or threading.get_ident() != main_thread:
+                return self._original_import(name, globals, locals, fromlist, level)
+            entry = [self._phase, self._import_depth, name, 0.0]
+            self.imports.append(entry)
+            self._import_depth += 1
+            started = time.perf_counter()
+            try:
+                return self._original_import(name, globals, locals, fromlist, level)
+            finally:
+                entry[3] = time.perf_counter() - started
+                self._import_depth -= 1
+
+        builtins.__import__ = timed_import
+
+    def phase(self, name: str):
+        """Ends the current phase and starts the next one."""
+        now = time.perf_counter()
+        self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._phase_started
+        self._phase = name
+        self._phase_started = now
+
+    async def finish(self):
+        """Ends the last phase and logs the profile. Only the first call has an effect."""
+        if self._finished:
+            return
+        self._finished = True
+        self.phase("running")
+        builtins.__import__ = self._original_import
+
+        logger = structlog.get_logger()
+        await logger.ainfo(
+            "Bot started",
+            startup_ms=round((time.perf_counter() - self.started) * 1000),
+            phases_ms={phase: round(seconds * 1000, 1) for phase, seconds in self.phases.items()},
+        )
+        for phase, depth, module, seconds in self.imports or ():
+            if seconds >= IMPORT_REPORT_THRESHOLD:
+                await logger.ainfo("Startup import", phase=phase, depth=depth, module=module, ms=round(seconds * 1000, 1))
@@ -0,0 +1,16 @@
+from bot.config_reader import DatabaseConfig, StorageBackend
+from bot.storage.base import Database
+
+
+def create_database(config: DatabaseConfig, report_timezone: str = "UTC") -> Database:
+    """Creates the storage backend selected in [database] settings."""
+    if config.backend == StorageBackend.POSTGRES:
+        # asyncpg is an optional dependency, only needed for this backend
+        from bot.storage.postgres import PostgresDatabase
+        return PostgresDatabase(config, report_timezone)
+
+    from bot.storage.sqlite import SqliteDatabase
+    return SqliteDatabase(config.sqlite_path, config, report_timezone)
+
+
+__all__ = ["Database", "create_database"]
@@ -0,0 +1,254 @@
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+import pytz
+import structlog
+
+from bot.config_reader import DatabaseConfig
+
+logger = structlog.get_logger()
+
+# users columns checked by the ledger reconciliation, each reported with an expected_<column> value
+RECONCILED_COLUMNS = ("balance", "games_played", "total_won", "total_lost", "bankruptcy_count")
+
+
+class Database(ABC):
+    """
+    Storage interface used by handlers and services (injected into them as `db`).
+    Implementations: SqliteDatabase (bot.storage.sqlite) and PostgresDatabase (bot.storage.postgres).
+    Use bot.storage.create_database to get the one selected in [database] settings.
+    """
+
+    def __init__(self, config: DatabaseConfig = None, report_timezone: str = "UTC"):
+        self.config = config or DatabaseConfig()
+        # Daily rollups are keyed by the date in the reports timezone
+        self.report_timezone = pytz.timezone(report_timezone)
+
+    def local_today(self) -> date:
+        return datetime.now(self.report_timezone).date()
+
+    @property
+    def pending_events(self) -> int:
+        """Events queued by add_event and not written yet (0 if the backend writes them right away)."""
+        return 0
+
+    # Lifecycle
+
+    @abstractmethod
+    async def connect(self):
+        """Opens connections. Safe to call more than once."""
+
+    @abstractmethod
+    async def close(self):
+        """Flushes pending writes and closes connections. Registered as a Dispatcher shutdown hook."""
+
+    @abstractmethod
+    async def create_tables(self):
+        """Creates or upgrades the schema by applying pending migrations."""
+
+    # Users
+
+    @abstractmethod
+    async def get_balance(self, user_id: int, default_balance: int = 0) -> int:
+        """Returns the user's balance, creating the user with default_balance if missing."""
+
+    @abstractmethod
+    async def update_balance(self, user_id: int, amount: int):
+        ...
+
+    @abstractmethod
+    async def get_bid(self, user_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def update_bid(self, user_id: int, new_bid: int):
+        ...
+
+    @abstractmethod
+    async def get_user_by_nickname(self, nickname: str) -> dict | None:
+        """
+        Resolves the current owner of a handle (case-insensitive, leading @ is ignored).
+        Returns a dict with user_id, balance, bid, state and nickname, or None.
+        """
+
+    @abstractmethod
+    async def get_user(self, user_id: int) -> dict | None:
+        ...
+
+    @abstractmethod
+    async def get_all_user_nicknames(self) -> list[tuple[int, str | None]]:
+        ...
+
+    @abstractmethod
+    async def register_user(self, user_id: int, nickname: str):
+        """Creates the user or updates the nickname, taking the handle away from its previous owner."""
+
+    @abstractmethod
+    async def update_user_state(self, user_id: int, state: str):
+        ...
+
+    # Ledger
+
+    @abstractmethod
+    async def add_event(self, event_id: str, user_id: int, event_type: str, amount: int, metadata: str = None, chat_id: int = None):
+        ...
+
+    @abstractmethod
+    async def flush_events(self):
+        """Writes events queued by add_event, if the backend queues them."""
+
+    @abstractmethod
+    async def settle_spin(
+            self,
+            user_id: int,
+            nickname: str | None,
+            chat_id: int | None,
+            dice_value: int,
+            multiplier: int = 1,
+            starting_balance: int = 50,
+            bid: int | None = None,
+    ) -> dict:
+        """
+        Settles one slot machine spin in a single transaction: user upsert, bid check,
+        balance update, event log, stats and bankruptcy.
+        bid is a fixed stake used instead of the user's bid (private spins play for 1).
+
+        Returns a dict with keys:
+        - status: 'ok', 'bankrupt' (balance was already <= 0) or 'insufficient' (balance < bid)
+        - balance: balance after the spin (or current balance if the spin was rejected)
+        - bid: the stake (user's bid unless given)
+        - change: applied balance change (0 if rejected)
+        """
+
+    @abstractmethod
+    async def transfer_money(self, from_user_id: int, to_user_id: int, amount: int, event_id_out: str, event_id_in: str, chat_id: int = None) -> bool:
+        """Moves coins between users. Returns False if the sender can't afford it."""
+
+    @abstractmethod
+    async def get_last_credit_event(self, user_id: int) -> dict | None:
+        """Returns created_at and ts (unix epoch) of the user's last credit grant."""
+
+    # AI credit sessions
+
+    @abstractmethod
+    async def create_credit_session(self, session_id: str, user_id: int):
+        ...
+
+    @abstractmethod
+    async def update_session_status(self, session_id: str, status: str):
+        ...
+
+    @abstractmethod
+    async def terminate_all_active_sessions(self, idle_timeout_minutes: int = 0):
+        """
+        Force closes open sessions left by a previous run and sets their users back to IDLE.
+        Backends shared by several bot processes only close sessions idle for longer than
+        idle_timeout_minutes (0: none), as newer ones may belong to another running process.
+        """
+
+    @abstractmethod
+    async def close_credit_session(self, session_id: str, status: str, score: int, reward: int):
+        ...
+
+    @abstractmethod
+    async def add_dialogue_message(self, session_id: str, role: str, content: str):
+        ...
+
+    @abstractmethod
+    async def get_dialogue_history(self, session_id: str, limit: int = 10) -> list[dict]:
+        """Last `limit` messages of the session in chronological order."""
+
+    # Delayed actions
+
+    @abstractmethod
+    async def save_pending_actions(self, actions: list[tuple[str, str, int, int, str]]):
+        """Upserts (action_id, kind, chat_id, due_ts, payload) rows."""
+
+    @abstractmethod
+    async def delete_pending_actions(self, action_ids: list[str]):
+        ...
+
+    @abstractmethod
+    async def get_pending_actions(self) -> list[dict]:
+        ...
+
+    # Groups and reports
+
+    @abstractmethod
+    async def save_group_activity(self, chats: list[tuple[int, str]], memberships: list[tuple[int, int, int]]):
+        """
+        Upserts (chat_id, title) rows into chats and (user_id, chat_id, last_seen) rows
+        (last_seen is unix epoch) into user_groups, in one transaction.
+        """
+
+    @abstractmethod
+    async def get_chat_titles(self) -> dict[int, str]:
+        ...
+
+    @abstractmethod
+    async def get_top_users_in_group(self, chat_id: int, limit: int = 30) -> list[dict]:
+        ...
+
+    @abstractmethod
+    async def get_daily_stats(self, start_ts: int, end_ts: int, chat_id: int = None) -> list[dict]:
+        """Aggregates per-user stats from the event history for [start_ts, end_ts) (unix epoch)."""
+
+    @abstractmethod
+    async def get_daily_rollup(self, local_date: date, chat_id: int = None) -> list[dict]:
+        """Per-user stats for one local day from the daily_user_stats rollup."""
+
+    @abstractmethod
+    async def rebuild_daily_stats(self, start_date: date, end_date: date) -> int:
+        """Recomputes daily_user_stats for [start_date, end_date]. Returns the number of days."""
+
+    # Maintenance
+
+    @abstractmethod
+    async def run_stats_backfill(self, force: bool = False, chunk_size: int = 50_000):
+        ...
+
+    @abstractmethod
+    async def run_bankruptcy_backfill(self, force: bool = False, chunk_size: int = 50_000, starting_balance: int = 50):
+        ...
+
+    @abstractmethod
+    async def reconcile_ledger(self, starting_balance: int = 50, chunk_size: int = 1000, full: bool = False) -> list[dict]:
+        """
+        Replays event_history per user and compares the result with users.balance and game stats.
+        Returns divergent users: their RECONCILED_COLUMNS with expected_* values and
+        first_divergent_event, the first event the replayed balance can't explain (or None).
+        Replayed totals are kept, so a rerun only reads new events; full starts over.
+        """
+
+    @staticmethod
+    def _divergence(row, events: dict[str, dict]) -> dict | None:
+        """Builds a reconciliation report entry from a compared row, or None if the user is consistent."""
+        report = dict(row)
+        event_id = report.pop("divergent_event_id")
+        balance_before = report.pop("divergent_balance")
+        if event_id is None and all(report[column] == report[f"expected_{column}"] for column in RECONCILED_COLUMNS):
+            return None
+        report["first_divergent_event"] = None
+        if event_id is not None:
+            # The event may have been archived since it was found
+            report["first_divergent_event"] = {
+                "event_id": event_id,
+                **events.get(event_id, {}),
+                "expected_balance_before": balance_before,
+            }
+        return report
+
+    @abstractmethod
+    async def archive_events(self) -> list[str]:
+        """Moves old events out of the hot event history. Returns the names of the archived months."""
+
+    @abstractmethod
+    async def prune_dialogues(self) -> int:
+        """Deletes old dialogues of finished credit sessions. Returns the number of deleted messages."""
+
+    async def run_archival(self):
+        """Archives old events and prunes old dialogues. Scheduled nightly; a no-op when both are disabled."""
+        months = await self.archive_events()
+        messages = await self.prune_dialogues()
+        if months or messages:
+            await logger.ainfo("Archival completed", months=months, dialogue_messages=messages)
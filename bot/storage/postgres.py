@@ -0,0 +1,894 @@
+import asyncio
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable
+
+import asyncpg
+import structlog
+
+from bot.config_reader import DatabaseConfig
+from bot.dice_check import get_score_change
+from bot.storage.base import Database
+from bot.storage.postgres_migrations import migrate
+from bot.utils.context import trace_db
+
+logger = structlog.get_logger()
+
+
+def _affected(status: str) -> int:
+    """Row count of a command status string such as "UPDATE 1"."""
+    return int(status.split()[-1])
+
+
+CHAT_STATS_UPSERT_SQL = """
+    INSERT INTO user_chat_stats AS s
+        (user_id, chat_id, games_played, total_won, total_lost, bankruptcy_count, last_played)
+    VALUES ($1, $2, $3, $4, $5, $6, CASE WHEN $3 > 0 THEN now() END)
+    ON CONFLICT (user_id, chat_id) DO UPDATE SET
+        games_played = s.games_played + EXCLUDED.games_played,
+        total_won = s.total_won + EXCLUDED.total_won,
+        total_lost = s.total_lost + EXCLUDED.total_lost,
+        bankruptcy_count = s.bankruptcy_count + EXCLUDED.bankruptcy_count,
+        last_played = COALESCE(EXCLUDED.last_played, s.last_played)
+"""
+
+DAILY_STATS_UPSERT_SQL = """
+    INSERT INTO daily_user_stats AS d
+        (local_date, chat_id, user_id, games_played, games_won, total_won, total_lost,
+         max_win_amount, bid_sum, total_given, bankruptcy_count)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    ON CONFLICT (local_date, chat_id, user_id) DO UPDATE SET
+        games_played = d.games_played + EXCLUDED.games_played,
+        games_won = d.games_won + EXCLUDED.games_won,
+        total_won = d.total_won + EXCLUDED.total_won,
+        total_lost = d.total_lost + EXCLUDED.total_lost,
+        max_win_amount = GREATEST(d.max_win_amount, EXCLUDED.max_win_amount),
+        bid_sum = d.bid_sum + EXCLUDED.bid_sum,
+        total_given = d.total_given + EXCLUDED.total_given,
+        bankruptcy_count = d.bankruptcy_count + EXCLUDED.bankruptcy_count
+"""
+
+# Takes a handle away from its previous owner (see SqliteDatabase._claim_nickname)
+CLAIM_NICKNAME_SQL = "UPDATE users SET nickname_lc = NULL WHERE nickname_lc = $1 AND user_id <> $2"
+
+# See RECONCILE_TOTALS_CTE in bot.storage.sqlite. Parameters: $1 first user_id, $2 last user_id, $3 ts bound
+RECONCILE_TOTALS_CTE = """
+    new_events AS (
+        SELECT
+            e.user_id,
+            e.event_id,
+            e.ts,
+            e.event_type,
+            e.bid,
+            COALESCE(e.amount, 0) AS amount,
+            (s.balance + SUM(COALESCE(e.amount, 0)) OVER (
+                PARTITION BY e.user_id ORDER BY e.ts, e.event_id ROWS UNBOUNDED PRECEDING
+            ) - COALESCE(e.amount, 0))::BIGINT AS balance_before
+        FROM ledger_reconcile_state s
+        JOIN event_history e ON e.user_id = s.user_id AND (e.ts, e.event_id) > (s.last_ts, s.last_event_id)
+        WHERE s.user_id BETWEEN $1 AND $2 AND e.ts < $3
+    ),
+    flagged AS (
+        SELECT *,
+            (event_type IN ('win', 'loss') AND bid IS NOT NULL AND (balance_before <= 0 OR balance_before < bid))
+            OR (event_type = 'transfer_out' AND balance_before < -amount) AS divergent
+        FROM new_events
+    ),
+    ranked AS (
+        SELECT *,
+            ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC, event_id DESC) AS from_last,
+            ROW_NUMBER() OVER (PARTITION BY user_id, divergent ORDER BY ts, event_id) AS divergent_rank
+        FROM flagged
+    ),
+    totals AS (
+        SELECT
+            user_id,
+            SUM(amount)::BIGINT AS amount,
+            COUNT(*) FILTER (WHERE event_type IN ('win', 'loss')) AS games,
+            SUM(CASE WHEN event_type IN ('win', 'loss') AND amount > 0 THEN amount ELSE 0 END)::BIGINT AS won,
+            SUM(CASE WHEN event_type IN ('win', 'loss') AND amount < 0 THEN -amount ELSE 0 END)::BIGINT AS lost,
+            COUNT(*) FILTER (WHERE event_type = 'bankruptcy') AS bankruptcies,
+            MAX(ts) FILTER (WHERE from_last = 1) AS last_ts,
+            MAX(event_id) FILTER (WHERE from_last = 1) AS last_event_id,
+            MAX(event_id) FILTER (WHERE divergent AND divergent_rank = 1) AS divergent_event_id,
+            MAX(balance_before) FILTER (WHERE divergent AND divergent_rank = 1) AS divergent_balance
+        FROM ranked
+        GROUP BY user_id
+    )
+"""
+
+# History passes leave the most recent events for the next run: with several writers,
+# transactions that started earlier may still commit events with a smaller ts
+HISTORY_PASS_LAG_SECONDS = 60
+
+
+class PostgresDatabase(Database):
+    """
+    PostgreSQL storage on an asyncpg connection pool, for running several bot
+    processes against one ledger. Balances are only changed by single
+    UPDATE ... RETURNING statements or under row locks, and nothing about users is
+    cached in the process. Queries run through asyncpg's per-connection cache of
+    prepared statements.
+    """
+
+    def __init__(self, config: DatabaseConfig = None, report_timezone: str = "UTC"):
+        super().__init__(config, report_timezone)
+        self._pool: asyncpg.Pool | None = None
+        self._connect_lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self._pool is not None:
+                return
+            if self.config.postgres_dsn is None:
+                raise ValueError("[database] postgres_dsn is required for the postgres backend")
+            self._pool = await asyncpg.create_pool(
+                str(self.config.postgres_dsn),
+                min_size=self.config.pool_min_size,
+                max_size=self.config.pool_max_size,
+            )
+
+    async def close(self):
+        async with self._connect_lock:
+            if self._pool is None:
+                return
+            await self._pool.close()
+            self._pool = None
+
+    @asynccontextmanager
+    async def _connection(self) -> AsyncIterator[asyncpg.Connection]:
+        """Borrow a connection from the pool."""
+        if self._pool is None:
+            await self.connect()
+        async with self._pool.acquire() as conn:
+            yield conn
+
+    async def create_tables(self):
+        async with self._connection() as conn:
+            applied = await migrate(conn)
+        if applied:
+            trace_db("migrate", "schema", "applied", (applied,))
+
+    async def _run_history_pass(
+            self,
+            name: str,
+            process_chunk: Callable[[asyncpg.Connection, tuple, tuple], Awaitable[None]],
+            finish: Callable[[asyncpg.Connection], Awaitable[None]],
+            force: bool,
+            chunk_size: int,
+    ) -> bool:
+        """
+        Same as SqliteDatabase._run_history_pass. Chunks run under an advisory lock,
+        so only one process works on a pass at a time, and events of the last
+        HISTORY_PASS_LAG_SECONDS are left for the next run.
+        """
+        cutoff_ts = int(time.time()) - HISTORY_PASS_LAG_SECONDS
+        while True:
+            async with self._connection() as conn, conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", name)
+                checkpoint = await conn.fetchrow(
+                    "SELECT last_ts, last_event_id, completed_at FROM maintenance_state WHERE name = $1", name
+                )
+                if checkpoint is not None and checkpoint["completed_at"] is not None and not force:
+                    return False
+                after = (checkpoint["last_ts"], checkpoint["last_event_id"]) if checkpoint else (-1, "")
+
+                # Upper bound of this chunk: chunk_size-th event after the watermark...
+                row = await conn.fetchrow(
+                    """SELECT ts, event_id FROM event_history
+                       WHERE (ts, event_id) > ($1, $2) AND ts < $3
+                       ORDER BY ts, event_id LIMIT 1 OFFSET $4""",
+                    *after, cutoff_ts, chunk_size - 1
+                )
+                done = row is None
+                if done:
+                    # ...or the last event before the cutoff
+                    row = await conn.fetchrow(
+                        """SELECT ts, event_id FROM event_history
+                           WHERE (ts, event_id) > ($1, $2) AND ts < $3
+                           ORDER BY ts DESC, event_id DESC LIMIT 1""",
+                        *after, cutoff_ts
+                    )
+                upper = (row["ts"], row["event_id"]) if row else after
+
+                if upper != after:
+                    await process_chunk(conn, after, upper)
+                if done:
+                    await finish(conn)
+                await conn.execute(
+                    """INSERT INTO maintenance_state (name, last_ts, last_event_id, completed_at) VALUES ($1, $2, $3, $4)
+                       ON CONFLICT (name) DO UPDATE SET
+                           last_ts = EXCLUDED.last_ts,
+                           last_event_id = EXCLUDED.last_event_id,
+                           completed_at = EXCLUDED.completed_at""",
+                    name, upper[0], upper[1], int(time.time()) if done else None
+                )
+            if done:
+                return True
+
+    async def run_stats_backfill(self, force: bool = False, chunk_size: int = 50_000):
+        async def process_chunk(conn: asyncpg.Connection, after: tuple, upper: tuple):
+            await conn.execute("""
+                INSERT INTO event_replay_state AS s (user_id, games_played, total_won, total_lost)
+                SELECT
+                    user_id,
+                    COUNT(*),
+                    SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+                    SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END)
+                FROM event_history
+                WHERE (ts, event_id) > ($1, $2) AND (ts, event_id) <= ($3, $4)
+                  AND user_id IS NOT NULL AND event_type IN ('win', 'loss')
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE SET
+                    games_played = s.games_played + EXCLUDED.games_played,
+                    total_won = s.total_won + EXCLUDED.total_won,
+                    total_lost = s.total_lost + EXCLUDED.total_lost
+            """, *after, *upper)
+
+        async def finish(conn: asyncpg.Connection):
+            await conn.execute("""
+                UPDATE users
+                SET games_played = s.games_played,
+                    total_won = s.total_won,
+                    total_lost = s.total_lost
+                FROM event_replay_state s
+                WHERE s.user_id = users.user_id
+            """)
+
+        if await self._run_history_pass("stats_backfill", process_chunk, finish, force, chunk_size):
+            await logger.ainfo("Stats backfill completed")
+
+    async def run_bankruptcy_backfill(self, force: bool = False, chunk_size: int = 50_000, starting_balance: int = 50):
+        async def process_chunk(conn: asyncpg.Connection, after: tuple, upper: tuple):
+            # See SqliteDatabase.run_bankruptcy_backfill
+            bankruptcies = await conn.fetch("""
+                WITH running AS (
+                    SELECT
+                        e.user_id,
+                        e.ts,
+                        e.event_id,
+                        e.created_at,
+                        COALESCE(s.balance, $1) AS start_balance,
+                        COALESCE(s.balance, $1) + SUM(COALESCE(e.amount, 0)) OVER (
+                            PARTITION BY e.user_id ORDER BY e.ts, e.event_id ROWS UNBOUNDED PRECEDING
+                        ) AS balance
+                    FROM event_history e
+                    LEFT JOIN event_replay_state s ON s.user_id = e.user_id
+                    WHERE (e.ts, e.event_id) > ($2, $3) AND (e.ts, e.event_id) <= ($4, $5)
+                      AND e.user_id IS NOT NULL AND e.event_type != 'bankruptcy'
+                ),
+                steps AS (
+                    SELECT *, LAG(balance, 1, start_balance) OVER (
+                        PARTITION BY user_id ORDER BY ts, event_id
+                    ) AS prev_balance
+                    FROM running
+                )
+                SELECT
+                    user_id,
+                    ts,
+                    created_at,
+                    EXISTS (
+                        SELECT 1 FROM event_history b
+                        WHERE b.user_id = steps.user_id AND b.event_type = 'bankruptcy' AND b.ts = steps.ts
+                    ) AS logged
+                FROM steps
+                WHERE balance <= 0 AND prev_balance > 0
+            """, starting_balance, *after, *upper)
+
+            await conn.execute("""
+                INSERT INTO event_replay_state (user_id, balance)
+                SELECT e.user_id, COALESCE(MAX(s.balance), $1) + SUM(COALESCE(e.amount, 0))
+                FROM event_history e
+                LEFT JOIN event_replay_state s ON s.user_id = e.user_id
+                WHERE (e.ts, e.event_id) > ($2, $3) AND (e.ts, e.event_id) <= ($4, $5)
+                  AND e.user_id IS NOT NULL AND e.event_type != 'bankruptcy'
+                GROUP BY e.user_id
+                ON CONFLICT (user_id) DO UPDATE SET balance = EXCLUDED.balance
+            """, starting_balance, *after, *upper)
+
+            counts = Counter(row["user_id"] for row in bankruptcies)
+            await conn.executemany(
+                "UPDATE event_replay_state SET bankruptcy_count = bankruptcy_count + $1 WHERE user_id = $2",
+                [(count, user_id) for user_id, count in counts.items()]
+            )
+
+            missing = {
+                (row["user_id"], row["ts"]): row["created_at"]
+                for row in bankruptcies if not row["logged"]
+            }
+            await conn.executemany(
+                "INSERT INTO event_history (event_id, user_id, event_type, amount, created_at, ts) VALUES ($1, $2, 'bankruptcy', 0, $3, $4)",
+                [(str(uuid.uuid4()), user_id, created_at, ts) for (user_id, ts), created_at in missing.items()]
+            )
+            if missing:
+                await logger.ainfo("Backfilled bankruptcy events", count=len(missing))
+
+        async def finish(conn: asyncpg.Connection):
+            await conn.execute("""
+                UPDATE users
+                SET bankruptcy_count = s.bankruptcy_count
+                FROM event_replay_state s
+                WHERE s.user_id = users.user_id AND s.bankruptcy_count > 0
+            """)
+
+        if await self._run_history_pass("bankruptcy_backfill", process_chunk, finish, force, chunk_size):
+            await logger.ainfo("Bankruptcy backfill completed")
+
+    async def reconcile_ledger(self, starting_balance: int = 50, chunk_size: int = 1000, full: bool = False) -> list[dict]:
+        """
+        Same as SqliteDatabase.reconcile_ledger. Each chunk reads one snapshot
+        (REPEATABLE READ), so balances and events are consistent within it.
+        """
+        if full:
+            async with self._connection() as conn:
+                await conn.execute("DELETE FROM ledger_reconcile_state")
+
+        divergent = []
+        checked = 0
+        last_user_id = -(2 ** 63)
+        while True:
+            async with self._connection() as conn, conn.transaction(isolation="repeatable_read"):
+                user_ids = [
+                    row["user_id"] for row in await conn.fetch(
+                        "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2", last_user_id, chunk_size
+                    )
+                ]
+                if not user_ids:
+                    break
+                first, last_user_id = user_ids[0], user_ids[-1]
+
+                # No archive on Postgres: users start from starting_balance
+                await conn.execute("""
+                    INSERT INTO ledger_reconcile_state (user_id, balance)
+                    SELECT user_id, $3::BIGINT FROM users WHERE user_id BETWEEN $1 AND $2
+                    ON CONFLICT (user_id) DO NOTHING
+                """, first, last_user_id, starting_balance)
+
+                # Fold settled events into the saved totals and move the watermarks
+                await conn.execute(f"""
+                    WITH {RECONCILE_TOTALS_CTE}
+                    UPDATE ledger_reconcile_state SET
+                        balance = ledger_reconcile_state.balance + t.amount,
+                        games_played = ledger_reconcile_state.games_played + t.games,
+                        total_won = ledger_reconcile_state.total_won + t.won,
+                        total_lost = ledger_reconcile_state.total_lost + t.lost,
+                        bankruptcy_count = ledger_reconcile_state.bankruptcy_count + t.bankruptcies,
+                        last_ts = t.last_ts,
+                        last_event_id = t.last_event_id,
+                        divergent_balance = CASE WHEN ledger_reconcile_state.divergent_event_id IS NULL
+                            THEN t.divergent_balance ELSE ledger_reconcile_state.divergent_balance END,
+                        divergent_event_id = COALESCE(ledger_reconcile_state.divergent_event_id, t.divergent_event_id)
+                    FROM totals t
+                    WHERE t.user_id = ledger_reconcile_state.user_id
+                """, first, last_user_id, int(time.time()) - HISTORY_PASS_LAG_SECONDS)
+
+                # Compare with the recent events on top
+                rows = await conn.fetch(f"""
+                    WITH {RECONCILE_TOTALS_CTE}
+                    SELECT
+                        s.user_id,
+                        u.nickname,
+                        u.balance,
+                        s.balance + COALESCE(t.amount, 0) AS expected_balance,
+                        u.games_played,
+                        s.games_played + COALESCE(t.games, 0) AS expected_games_played,
+                        u.total_won,
+                        s.total_won + COALESCE(t.won, 0) AS expected_total_won,
+                        u.total_lost,
+                        s.total_lost + COALESCE(t.lost, 0) AS expected_total_lost,
+                        u.bankruptcy_count,
+                        s.bankruptcy_count + COALESCE(t.bankruptcies, 0) AS expected_bankruptcy_count,
+                        COALESCE(s.divergent_event_id, t.divergent_event_id) AS divergent_event_id,
+                        CASE WHEN s.divergent_event_id IS NOT NULL THEN s.divergent_balance ELSE t.divergent_balance END AS divergent_balance
+                    FROM ledger_reconcile_state s
+                    JOIN users u ON u.user_id = s.user_id
+                    LEFT JOIN totals t ON t.user_id = s.user_id
+                    WHERE s.user_id BETWEEN $1 AND $2
+                """, first, last_user_id, 2 ** 63 - 1)
+
+                event_ids = [row["divergent_event_id"] for row in rows if row["divergent_event_id"] is not None]
+                events = {}
+                if event_ids:
+                    events = {
+                        row["event_id"]: dict(row) for row in await conn.fetch(
+                            "SELECT event_id, ts, event_type, amount, bid, chat_id FROM event_history WHERE event_id = ANY($1::TEXT[])",
+                            event_ids
+                        )
+                    }
+
+            checked += len(user_ids)
+            divergent.extend(report for row in rows if (report := self._divergence(row, events)) is not None)
+
+        await logger.ainfo("Ledger reconciliation completed", users=checked, divergent=len(divergent))
+        return divergent
+
+    async def get_balance(self, user_id: int, default_balance: int = 0) -> int:
+        async with self._connection() as conn:
+            balance = await conn.fetchval("SELECT balance FROM users WHERE user_id = $1", user_id)
+            if balance is not None:
+                return balance
+
+            # Если пользователя нет, создаем его
+            balance = await conn.fetchval(
+                "INSERT INTO users (user_id, balance, bid) VALUES ($1, $2, 1) ON CONFLICT (user_id) DO NOTHING RETURNING balance",
+                user_id, default_balance
+            )
+            if balance is None:
+                # Created by another process in the meantime
+                balance = await conn.fetchval("SELECT balance FROM users WHERE user_id = $1", user_id)
+            return balance
+
+    async def update_balance(self, user_id: int, amount: int):
+        started = time.perf_counter()
+        async with self._connection() as conn:
+            status = await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id = $2", amount, user_id)
+        trace_db("update_balance", "users", "user_id amount", (user_id, amount), started, _affected(status))
+
+    async def get_bid(self, user_id: int) -> int:
+        async with self._connection() as conn:
+            bid = await conn.fetchval("SELECT bid FROM users WHERE user_id = $1", user_id)
+        # Default bid is 1 if not set (though schema has default 1)
+        return bid if bid is not None else 1
+
+    async def update_bid(self, user_id: int, new_bid: int):
+        started = time.perf_counter()
+        async with self._connection() as conn:
+            status = await conn.execute("UPDATE users SET bid = $1 WHERE user_id = $2", new_bid, user_id)
+        trace_db("update_bid", "users", "user_id bid", (user_id, new_bid), started, _affected(status))
+
+    async def get_user_by_nickname(self, nickname: str) -> dict | None:
+        # Remove @ if present
+        nickname_lc = nickname.lstrip('@').lower()
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT user_id, balance, bid, state, nickname FROM users WHERE nickname_lc = $1", nickname_lc
+            )
+        return dict(row) if row else None
+
+    async def get_user(self, user_id: int) -> dict | None:
+        async with self._connection() as conn:
+            row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
+        return dict(row) if row else None
+
+    async def get_all_user_nicknames(self) -> list[tuple[int, str | None]]:
+        async with self._connection() as conn:
+            rows = await conn.fetch("SELECT user_id, nickname FROM users")
+        return [(row["user_id"], row["nickname"]) for row in rows]
+
+    async def register_user(self, user_id: int, nickname: str):
+        started = time.perf_counter()
+        nickname_lc = nickname.lower() if nickname else None
+        async with self._connection() as conn, conn.transaction():
+            if nickname_lc:
+                await conn.execute(CLAIM_NICKNAME_SQL, nickname_lc, user_id)
+            # The WHERE clause skips the row write when nothing changed
+            status = await conn.execute(
+                """INSERT INTO users AS u (user_id, nickname, nickname_lc, balance, bid) VALUES ($1, $2, $3, 50, 1)
+                   ON CONFLICT (user_id) DO UPDATE SET nickname = EXCLUDED.nickname, nickname_lc = EXCLUDED.nickname_lc
+                   WHERE u.nickname IS DISTINCT FROM EXCLUDED.nickname
+                      OR u.nickname_lc IS DISTINCT FROM EXCLUDED.nickname_lc""",
+                user_id, nickname, nickname_lc
+            )
+        trace_db("register_user", "users", "user_id nickname", (user_id, nickname), started, _affected(status))
+
+    async def update_user_state(self, user_id: int, state: str):
+        started = time.perf_counter()
+        async with self._connection() as conn:
+            status = await conn.execute("UPDATE users SET state = $1 WHERE user_id = $2", state, user_id)
+        trace_db("update_state", "users", "user_id state", (user_id, state), started, _affected(status))
+
+    async def add_event(self, event_id: str, user_id: int, event_type: str, amount: int, metadata: str = None, chat_id: int = None):
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        async with self._connection() as conn:
+            await conn.execute(
+                """INSERT INTO event_history (event_id, user_id, event_type, amount, metadata, chat_id, created_at, ts)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8)""",
+                event_id, user_id, event_type, amount, metadata, chat_id, now, int(now.timestamp())
+            )
+        trace_db("add_event", "event_history", "event_id user_id type amount chat_id", (event_id, user_id, event_type, amount, chat_id), started, rows=1)
+
+    async def flush_events(self):
+        # Events are written immediately ([database] event_write_behind is SQLite only)
+        pass
+
+    async def settle_spin(
+            self,
+            user_id: int,
+            nickname: str | None,
+            chat_id: int | None,
+            dice_value: int,
+            multiplier: int = 1,
+            starting_balance: int = 50,
+            bid: int | None = None,
+    ) -> dict:
+        started = time.perf_counter()
+        score_change = get_score_change(dice_value)
+        nickname_lc = nickname.lower() if nickname else None
+        async with self._connection() as conn, conn.transaction():
+            if nickname_lc:
+                await conn.execute(CLAIM_NICKNAME_SQL, nickname_lc, user_id)
+            # Keep the old nickname if the user has no username; don't rewrite an unchanged row
+            await conn.execute(
+                """INSERT INTO users AS u (user_id, nickname, nickname_lc, balance, bid) VALUES ($1, $2, $3, $4, 1)
+                   ON CONFLICT (user_id) DO UPDATE SET
+                       nickname = EXCLUDED.nickname,
+                       nickname_lc = EXCLUDED.nickname_lc
+                   WHERE EXCLUDED.nickname IS NOT NULL
+                     AND (u.nickname IS DISTINCT FROM EXCLUDED.nickname OR u.nickname_lc IS DISTINCT FROM EXCLUDED.nickname_lc)""",
+                user_id, nickname, nickname_lc, starting_balance
+            )
+
+            # Guarded update: only applies if the user can afford the bid. The row lock
+            # it takes serializes concurrent spins of the same user across processes
+            row = await conn.fetchrow(
+                """UPDATE users
+                   SET balance = balance + $1 * COALESCE($3::bigint, bid, 1)
+                   WHERE user_id = $2 AND balance > 0 AND balance >= COALESCE($3::bigint, bid, 1)
+                   RETURNING balance, COALESCE($3::bigint, bid, 1) AS bid""",
+                score_change * multiplier, user_id, bid
+            )
+            if row is None:
+                row = await conn.fetchrow(
+                    "SELECT balance, COALESCE($2::bigint, bid, 1) AS bid FROM users WHERE user_id = $1", user_id, bid
+                )
+                status = "bankrupt" if row["balance"] <= 0 else "insufficient"
+                return {"status": status, "balance": row["balance"], "bid": row["bid"], "change": 0}
+
+            new_balance, bid = row["balance"], row["bid"]
+            change = score_change * bid * multiplier
+            is_bankruptcy = new_balance <= 0
+
+            ts = int(time.time())
+            await conn.execute(
+                """INSERT INTO event_history
+                   (event_id, user_id, event_type, amount, chat_id, dice_value, bid, base_change, multiplier, ts)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)""",
+                str(uuid.uuid4()), user_id, 'win' if change > 0 else 'loss', change, chat_id,
+                dice_value, bid, score_change, multiplier, ts
+            )
+            await conn.execute("""
+                UPDATE users
+                SET games_played = games_played + 1,
+                    total_won = total_won + $1,
+                    total_lost = total_lost + $2,
+                    bankruptcy_count = bankruptcy_count + $3
+                WHERE user_id = $4
+            """, max(change, 0), max(-change, 0), 1 if is_bankruptcy else 0, user_id)
+            if is_bankruptcy:
+                # Explicit bankruptcy event for daily stats
+                await conn.execute(
+                    "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES ($1, $2, 'bankruptcy', 0, $3, $4)",
+                    str(uuid.uuid4()), user_id, chat_id, ts
+                )
+            await self._bump_stats(conn, user_id, chat_id, games=1, change=change, bid=bid, bankruptcies=int(is_bankruptcy))
+        trace_db("settle_spin", "users", "user_id chat_id change balance", (user_id, chat_id, change, new_balance), started, rows=1)
+        return {"status": "ok", "balance": new_balance, "bid": bid, "change": change}
+
+    async def _bump_stats(
+            self,
+            conn: asyncpg.Connection,
+            user_id: int,
+            chat_id: int | None,
+            games: int = 0,
+            change: int = 0,
+            bid: int = 0,
+            given: int = 0,
+            bankruptcies: int = 0,
+    ):
+        """
+        Updates user_chat_stats and daily_user_stats.
+        Must be called inside the transaction that logs the corresponding event.
+        """
+        if chat_id is None:
+            return
+        won = max(change, 0)
+        lost = max(-change, 0)
+        await conn.execute(CHAT_STATS_UPSERT_SQL, user_id, chat_id, games, won, lost, bankruptcies)
+        await conn.execute(
+            DAILY_STATS_UPSERT_SQL,
+            self.local_today(), chat_id, user_id,
+            games, 1 if won > 0 else 0, won, lost, won, bid * games, given, bankruptcies
+        )
+
+    async def get_last_credit_event(self, user_id: int) -> dict | None:
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT created_at, ts FROM event_history WHERE user_id = $1 AND event_type = 'credit_grant' ORDER BY ts DESC LIMIT 1",
+                user_id
+            )
+        return dict(row) if row else None
+
+    async def transfer_money(self, from_user_id: int, to_user_id: int, amount: int, event_id_out: str, event_id_in: str, chat_id: int = None) -> bool:
+        started = time.perf_counter()
+        try:
+            async with self._connection() as conn, conn.transaction():
+                # Lock both rows in a fixed order, so that opposite transfers can't deadlock
+                rows = await conn.fetch(
+                    "SELECT user_id, balance FROM users WHERE user_id = ANY($1::BIGINT[]) ORDER BY user_id FOR UPDATE",
+                    [from_user_id, to_user_id]
+                )
+                balance = next((row["balance"] for row in rows if row["user_id"] == from_user_id), None)
+                if balance is None or balance < amount:
+                    return False
+
+                ts = int(time.time())
+                await conn.execute("UPDATE users SET balance = balance - $1 WHERE user_id = $2", amount, from_user_id)
+                await conn.execute("UPDATE users SET balance = balance + $1 WHERE user_id = $2", amount, to_user_id)
+                await conn.executemany(
+                    "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES ($1, $2, $3, $4, $5, $6)",
+                    [
+                        (event_id_out, from_user_id, 'transfer_out', -amount, chat_id, ts),
+                        (event_id_in, to_user_id, 'transfer_in', amount, chat_id, ts),
+                    ]
+                )
+
+                # Check for bankruptcy for sender
+                bankruptcies = 0
+                if balance - amount <= 0:
+                    await conn.execute(
+                        "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES ($1, $2, 'bankruptcy', 0, $3, $4)",
+                        str(uuid.uuid4()), from_user_id, chat_id, ts
+                    )
+                    await conn.execute(
+                        "UPDATE users SET bankruptcy_count = bankruptcy_count + 1 WHERE user_id = $1", from_user_id
+                    )
+                    bankruptcies = 1
+                await self._bump_stats(conn, from_user_id, chat_id, given=amount, bankruptcies=bankruptcies)
+        except asyncpg.PostgresError as e:
+            await logger.aerror("Transfer failed", error=str(e))
+            return False
+        trace_db("transfer", "users", "from_user_id to_user_id amount chat_id", (from_user_id, to_user_id, amount, chat_id), started, rows=2)
+        return True
+
+    async def create_credit_session(self, session_id: str, user_id: int):
+        async with self._connection() as conn:
+            await conn.execute(
+                "INSERT INTO ai_credit_sessions (session_id, user_id, status) VALUES ($1, $2, 'active')",
+                session_id, user_id
+            )
+
+    async def update_session_status(self, session_id: str, status: str):
+        async with self._connection() as conn:
+            await conn.execute("UPDATE ai_credit_sessions SET status = $1 WHERE session_id = $2", status, session_id)
+
+    async def terminate_all_active_sessions(self, idle_timeout_minutes: int = 0):
+        # Open sessions live in the memory of the process that started them. Other bot processes
+        # share this database, so a recent open row may belong to a running process. Sessions idle
+        # for longer than the timeout would have expired there, so they were left by a dead process
+        if idle_timeout_minutes <= 0:
+            return
+        async with self._connection() as conn:
+            status = await conn.execute(
+                """WITH stale AS (
+                       UPDATE ai_credit_sessions s SET status = 'terminated', finished_at = now()
+                       WHERE s.status IN ('active', 'processing')
+                         AND s.started_at < now() - make_interval(mins => $1)
+                         AND NOT EXISTS (
+                             SELECT 1 FROM ai_dialogue_messages m
+                             WHERE m.session_id = s.session_id AND m.created_at >= now() - make_interval(mins => $1)
+                         )
+                       RETURNING s.session_id, s.user_id
+                   )
+                   UPDATE users u SET state = 'IDLE'
+                   WHERE u.state = 'IN_DIALOGUE'
+                     AND u.user_id IN (SELECT user_id FROM stale)
+                     AND NOT EXISTS (
+                         SELECT 1 FROM ai_credit_sessions o
+                         WHERE o.user_id = u.user_id AND o.status IN ('active', 'processing')
+                           AND o.session_id NOT IN (SELECT session_id FROM stale)
+                     )""",
+                idle_timeout_minutes
+            )
+        if _affected(status):
+            await logger.ainfo("Reset users left in stale AI credit sessions", count=_affected(status))
+
+    async def close_credit_session(self, session_id: str, status: str, score: int, reward: int):
+        async with self._connection() as conn:
+            await conn.execute(
+                """UPDATE ai_credit_sessions
+                   SET status = $1, ai_score = $2, reward_amount = $3, finished_at = now()
+                   WHERE session_id = $4""",
+                status, score, reward, session_id
+            )
+
+    async def add_dialogue_message(self, session_id: str, role: str, content: str):
+        async with self._connection() as conn:
+            await conn.execute(
+                "INSERT INTO ai_dialogue_messages (session_id, role, content) VALUES ($1, $2, $3)",
+                session_id, role, content
+            )
+
+    async def get_dialogue_history(self, session_id: str, limit: int = 10) -> list[dict]:
+        async with self._connection() as conn:
+            rows = await conn.fetch(
+                """SELECT role, content FROM (
+                       SELECT message_id, role, content FROM ai_dialogue_messages
+                       WHERE session_id = $1 ORDER BY message_id DESC LIMIT $2
+                   ) last_messages ORDER BY message_id ASC""",
+                session_id, limit
+            )
+        return [dict(row) for row in rows]
+
+    async def save_pending_actions(self, actions: list[tuple[str, str, int, int, str]]):
+        async with self._connection() as conn:
+            await conn.executemany(
+                """INSERT INTO pending_actions (action_id, kind, chat_id, due_ts, payload) VALUES ($1, $2, $3, $4, $5)
+                   ON CONFLICT (action_id) DO UPDATE SET due_ts = EXCLUDED.due_ts, payload = EXCLUDED.payload""",
+                actions
+            )
+
+    async def delete_pending_actions(self, action_ids: list[str]):
+        async with self._connection() as conn:
+            await conn.execute("DELETE FROM pending_actions WHERE action_id = ANY($1::TEXT[])", action_ids)
+
+    async def get_pending_actions(self) -> list[dict]:
+        async with self._connection() as conn:
+            rows = await conn.fetch("SELECT action_id, kind, chat_id, due_ts, payload FROM pending_actions ORDER BY due_ts")
+        return [dict(row) for row in rows]
+
+    async def save_group_activity(self, chats: list[tuple[int, str]], memberships: list[tuple[int, int, int]]):
+        async with self._connection() as conn, conn.transaction():
+            await conn.executemany(
+                """INSERT INTO chats (chat_id, title, updated_at) VALUES ($1, $2, now())
+                   ON CONFLICT (chat_id) DO UPDATE SET title = EXCLUDED.title, updated_at = EXCLUDED.updated_at""",
+                chats
+            )
+            # Several processes may write the same pair: keep the latest last_seen
+            await conn.executemany(
+                """INSERT INTO user_groups (user_id, chat_id, last_seen) VALUES ($1, $2, to_timestamp($3))
+                   ON CONFLICT (user_id, chat_id) DO UPDATE SET last_seen = GREATEST(user_groups.last_seen, EXCLUDED.last_seen)""",
+                memberships
+            )
+
+    async def get_chat_titles(self) -> dict[int, str]:
+        async with self._connection() as conn:
+            rows = await conn.fetch("SELECT chat_id, title FROM chats")
+        return {row["chat_id"]: row["title"] for row in rows}
+
+    async def get_top_users_in_group(self, chat_id: int, limit: int = 30) -> list[dict]:
+        async with self._connection() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT
+                    u.user_id,
+                    u.nickname,
+                    u.balance,
+                    COALESCE(stats.games_played, 0) as games_played,
+                    COALESCE(stats.total_won, 0) as total_won,
+                    COALESCE(stats.total_lost, 0) as total_lost,
+                    COALESCE(stats.bankruptcy_count, 0) as bankruptcy_count
+                FROM user_groups ug
+                JOIN users u ON u.user_id = ug.user_id
+                LEFT JOIN user_chat_stats stats ON stats.user_id = ug.user_id AND stats.chat_id = ug.chat_id
+                WHERE ug.chat_id = $1
+                ORDER BY u.balance DESC
+                LIMIT $2
+                """,
+                chat_id, limit
+            )
+        return [dict(row) for row in rows]
+
+    async def get_daily_stats(self, start_ts: int, end_ts: int, chat_id: int = None) -> list[dict]:
+        # SUM over BIGINT is NUMERIC in Postgres: cast back so callers get ints
+        query = """
+            SELECT
+                u.user_id,
+                u.nickname,
+                COUNT(*) FILTER (WHERE eh.event_type IN ('win', 'loss')) as games_played,
+                SUM(CASE WHEN eh.event_type = 'win' AND eh.amount > 0 THEN eh.amount ELSE 0 END)::BIGINT as total_won,
+                SUM(CASE WHEN eh.event_type = 'loss' AND eh.amount < 0 THEN ABS(eh.amount) ELSE 0 END)::BIGINT as total_lost,
+                COUNT(*) FILTER (WHERE eh.event_type = 'bankruptcy') as bankruptcy_count,
+                SUM(CASE WHEN eh.event_type = 'transfer_out' THEN ABS(eh.amount) ELSE 0 END)::BIGINT as total_given,
+                MAX(CASE WHEN eh.event_type = 'win' THEN eh.amount ELSE 0 END) as max_win_amount,
+                AVG(eh.bid) FILTER (WHERE eh.event_type IN ('win', 'loss'))::FLOAT8 as avg_bid
+            FROM users u
+            JOIN event_history eh ON u.user_id = eh.user_id
+            WHERE eh.ts >= $1 AND eh.ts < $2
+        """
+        params = [start_ts, end_ts]
+        if chat_id:
+            query += " AND eh.chat_id = $3"
+            params.append(chat_id)
+        query += " GROUP BY u.user_id, u.nickname"
+
+        async with self._connection() as conn:
+            rows = await conn.fetch(query, *params)
+        return [dict(row) for row in rows]
+
+    async def get_daily_rollup(self, local_date: date, chat_id: int = None) -> list[dict]:
+        query = """
+            SELECT
+                d.user_id,
+                u.nickname,
+                SUM(d.games_played)::BIGINT as games_played,
+                SUM(d.games_won)::BIGINT as games_won,
+                SUM(d.total_won)::BIGINT as total_won,
+                SUM(d.total_lost)::BIGINT as total_lost,
+                SUM(d.bankruptcy_count)::BIGINT as bankruptcy_count,
+                SUM(d.total_given)::BIGINT as total_given,
+                MAX(d.max_win_amount) as max_win_amount,
+                SUM(d.bid_sum)::FLOAT8 / NULLIF(SUM(d.games_played), 0) as avg_bid
+            FROM daily_user_stats d
+            JOIN users u ON u.user_id = d.user_id
+            WHERE d.local_date = $1
+        """
+        params = [local_date]
+        if chat_id:
+            query += " AND d.chat_id = $2"
+            params.append(chat_id)
+        query += " GROUP BY d.user_id, u.nickname"
+
+        async with self._connection() as conn:
+            rows = await conn.fetch(query, *params)
+        return [dict(row) for row in rows]
+
+    async def rebuild_daily_stats(self, start_date: date, end_date: date) -> int:
+        started = time.perf_counter()
+        days = 0
+        day = start_date
+        while day <= end_date:
+            # Local day boundaries as unix timestamps
+            start_ts = int(self.report_timezone.localize(datetime.combine(day, datetime.min.time())).timestamp())
+            end_ts = int(self.report_timezone.localize(datetime.combine(day + timedelta(days=1), datetime.min.time())).timestamp())
+
+            async with self._connection() as conn, conn.transaction():
+                # Live stats updates of other processes wait until the day is recounted.
+                # Their events are either committed already (and counted here) or not visible yet
+                # (and added by their own update after this commit)
+                await conn.execute("LOCK TABLE daily_user_stats IN SHARE ROW EXCLUSIVE MODE")
+                await conn.execute("DELETE FROM daily_user_stats WHERE local_date = $1", day)
+                await conn.execute("""
+                    INSERT INTO daily_user_stats
+                        (local_date, chat_id, user_id, games_played, games_won, total_won, total_lost,
+                         max_win_amount, bid_sum, total_given, bankruptcy_count)
+                    SELECT
+                        $1,
+                        chat_id,
+                        user_id,
+                        COUNT(*) FILTER (WHERE event_type IN ('win', 'loss')),
+                        COUNT(*) FILTER (WHERE event_type = 'win' AND amount > 0),
+                        SUM(CASE WHEN event_type = 'win' AND amount > 0 THEN amount ELSE 0 END),
+                        SUM(CASE WHEN event_type = 'loss' AND amount < 0 THEN ABS(amount) ELSE 0 END),
+                        MAX(CASE WHEN event_type = 'win' THEN amount ELSE 0 END),
+                        SUM(CASE WHEN event_type IN ('win', 'loss') THEN COALESCE(bid, 0) ELSE 0 END),
+                        SUM(CASE WHEN event_type = 'transfer_out' THEN ABS(amount) ELSE 0 END),
+                        COUNT(*) FILTER (WHERE event_type = 'bankruptcy')
+                    FROM event_history
+                    WHERE ts >= $2 AND ts < $3
+                      AND chat_id IS NOT NULL AND user_id IS NOT NULL
+                    GROUP BY chat_id, user_id
+                """, day, start_ts, end_ts)
+            days += 1
+            day += timedelta(days=1)
+        trace_db("rebuild_daily_stats", "daily_user_stats", "start_date end_date days", (start_date, end_date, days), started)
+        return days
+
+    async def archive_events(self) -> list[str]:
+        # Monthly archive files are a SQLite feature; on Postgres, partition event_history by ts instead
+        if self.config.archive_keep_months > 0:
+            await logger.awarning("Event archival is not supported by the postgres backend, skipping")
+        return []
+
+    async def prune_dialogues(self) -> int:
+        started = time.perf_counter()
+        retention_days = self.config.dialogue_retention_days
+        if retention_days <= 0:
+            return 0
+        async with self._connection() as conn:
+            result = await conn.execute("""
+                DELETE FROM ai_dialogue_messages
+                WHERE session_id IN (
+                    SELECT session_id FROM ai_credit_sessions
+                    WHERE status NOT IN ('active', 'processing')
+                      AND finished_at < now() - make_interval(days => $1)
+                )
+            """, retention_days)
+        # Status string is "DELETE <count>"
+        deleted = _affected(result)
+        if deleted:
+            trace_db("prune_dialogues", "ai_dialogue_messages", started=started, rows=deleted)
+        return deleted
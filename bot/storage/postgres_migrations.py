@@ -0,0 +1,221 @@
+"""
+Versioned schema migrations for the PostgreSQL backend.
+
+Same rules as bot.storage.sqlite_migrations: the version of a migration is its
+position in MIGRATIONS, append new ones and never edit released ones. The current
+version is stored in the schema_version table. Migrations take an advisory lock,
+so several bot processes can start against the same database at once.
+"""
+from typing import Awaitable, Callable
+
+import asyncpg
+import structlog
+
+logger = structlog.get_logger()
+
+# Key of the advisory lock held while migrating
+MIGRATION_LOCK_ID = 7_254_810_001
+
+
+async def _initial_schema(conn: asyncpg.Connection):
+    # Same tables as the SQLite schema at its version 8.
+    # No foreign keys: events may reference users that were never registered (e.g. /give by reply)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            nickname TEXT,
+            nickname_lc TEXT,
+            balance BIGINT NOT NULL DEFAULT 50,
+            bid BIGINT DEFAULT 1,
+            state TEXT DEFAULT 'IDLE',
+            created_at TIMESTAMPTZ DEFAULT now(),
+            games_played INTEGER DEFAULT 0,
+            total_won BIGINT DEFAULT 0,
+            total_lost BIGINT DEFAULT 0,
+            bankruptcy_count INTEGER DEFAULT 0
+        )
+    """)
+    await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_nickname_lc ON users (nickname_lc)")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_history (
+            event_id TEXT PRIMARY KEY,
+            user_id BIGINT,
+            event_type TEXT NOT NULL,
+            amount BIGINT DEFAULT 0,
+            metadata TEXT,
+            created_at TIMESTAMPTZ DEFAULT now(),
+            chat_id BIGINT,
+            dice_value INTEGER,
+            bid BIGINT,
+            base_change INTEGER,
+            multiplier INTEGER,
+            ts BIGINT NOT NULL DEFAULT extract(epoch FROM now())::BIGINT
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_events_user_type_ts ON event_history (user_id, event_type, ts)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts_chat ON event_history (ts, chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts_id ON event_history (ts, event_id)")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_credit_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id BIGINT,
+            status TEXT DEFAULT 'active',
+            started_at TIMESTAMPTZ DEFAULT now(),
+            finished_at TIMESTAMPTZ,
+            ai_score INTEGER,
+            reward_amount BIGINT
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_credit_sessions_user_status ON ai_credit_sessions (user_id, status)")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_dialogue_messages (
+            message_id BIGSERIAL PRIMARY KEY,
+            session_id TEXT,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_dialogue_session ON ai_dialogue_messages (session_id, message_id)")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_groups (
+            user_id BIGINT,
+            chat_id BIGINT,
+            last_seen TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_groups_chat ON user_groups (chat_id, user_id)")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_chat_stats (
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            total_won BIGINT NOT NULL DEFAULT 0,
+            total_lost BIGINT NOT NULL DEFAULT 0,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            last_played TIMESTAMPTZ,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            local_date DATE NOT NULL, -- in reports timezone
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            games_won INTEGER NOT NULL DEFAULT 0,
+            total_won BIGINT NOT NULL DEFAULT 0,
+            total_lost BIGINT NOT NULL DEFAULT 0,
+            max_win_amount BIGINT NOT NULL DEFAULT 0,
+            bid_sum BIGINT NOT NULL DEFAULT 0,
+            total_given BIGINT NOT NULL DEFAULT 0,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (local_date, chat_id, user_id)
+        )
+    """)
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            name TEXT PRIMARY KEY,
+            last_ts BIGINT NOT NULL DEFAULT -1,
+            last_event_id TEXT NOT NULL DEFAULT '',
+            completed_at BIGINT
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS event_replay_state (
+            user_id BIGINT PRIMARY KEY,
+            balance BIGINT,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            total_won BIGINT NOT NULL DEFAULT 0,
+            total_lost BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+
+
+async def _ledger_reconcile_state(conn: asyncpg.Connection):
+    # See bot.storage.sqlite_migrations._ledger_reconcile_state
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_reconcile_state (
+            user_id BIGINT PRIMARY KEY,
+            last_ts BIGINT NOT NULL DEFAULT -1,
+            last_event_id TEXT NOT NULL DEFAULT '',
+            archived_events BIGINT NOT NULL DEFAULT 0,
+            balance BIGINT NOT NULL,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            total_won BIGINT NOT NULL DEFAULT 0,
+            total_lost BIGINT NOT NULL DEFAULT 0,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            divergent_event_id TEXT,
+            divergent_balance BIGINT
+        )
+    """)
+
+
+async def _pending_actions(conn: asyncpg.Connection):
+    # See bot.storage.sqlite_migrations._pending_actions
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS pending_actions (
+            action_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            due_ts BIGINT NOT NULL,
+            payload TEXT NOT NULL
+        )
+    """)
+
+
+async def _chats(conn: asyncpg.Connection):
+    # See bot.storage.sqlite_migrations._chats
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+
+
+MIGRATIONS: list[Callable[[asyncpg.Connection], Awaitable[None]]] = [
+    _initial_schema,
+    _ledger_reconcile_state,
+    _pending_actions,
+    _chats,
+]
+
+
+async def get_schema_version(conn: asyncpg.Connection) -> int:
+    await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    version = await conn.fetchval("SELECT version FROM schema_version")
+    if version is None:
+        await conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+        return 0
+    return version
+
+
+async def migrate(conn: asyncpg.Connection) -> int:
+    """
+    Applies pending migrations, each one in its own transaction.
+    Returns the number of applied migrations.
+    """
+    applied = 0
+    while True:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            # Another process may have migrated while we waited for the lock
+            current = await get_schema_version(conn)
+            if current >= len(MIGRATIONS):
+                return applied
+            step = MIGRATIONS[current]
+            await step(conn)
+            await conn.execute("UPDATE schema_version SET version = $1", current + 1)
+        applied += 1
+        await logger.ainfo("Applied DB migration", version=current + 1, migration=step.__name__)
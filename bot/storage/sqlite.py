@@ -0,0 +1,1463 @@
+import asyncio
+import time
+import uuid
+from collections import Counter
+from contextlib import asynccontextmanager, suppress
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable
+
+import aiosqlite
+import structlog
+from cachetools import LRUCache
+
+from bot.config_reader import DatabaseConfig
+from bot.dice_check import get_score_change
+from bot.storage.base import Database
+from bot.storage.sqlite_migrations import get_schema_version, migrate
+from bot.utils.context import trace_db
+
+logger = structlog.get_logger()
+
+CHAT_STATS_UPSERT_SQL = """
+    INSERT INTO user_chat_stats
+        (user_id, chat_id, games_played, total_won, total_lost, bankruptcy_count, last_played)
+    VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? > 0 THEN CURRENT_TIMESTAMP END)
+    ON CONFLICT(user_id, chat_id) DO UPDATE SET
+        games_played = games_played + excluded.games_played,
+        total_won = total_won + excluded.total_won,
+        total_lost = total_lost + excluded.total_lost,
+        bankruptcy_count = bankruptcy_count + excluded.bankruptcy_count,
+        last_played = COALESCE(excluded.last_played, last_played)
+"""
+
+DAILY_STATS_UPSERT_SQL = """
+    INSERT INTO daily_user_stats
+        (local_date, chat_id, user_id, games_played, games_won, total_won, total_lost,
+         max_win_amount, bid_sum, total_given, bankruptcy_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(local_date, chat_id, user_id) DO UPDATE SET
+        games_played = games_played + excluded.games_played,
+        games_won = games_won + excluded.games_won,
+        total_won = total_won + excluded.total_won,
+        total_lost = total_lost + excluded.total_lost,
+        max_win_amount = MAX(max_win_amount, excluded.max_win_amount),
+        bid_sum = bid_sum + excluded.bid_sum,
+        total_given = total_given + excluded.total_given,
+        bankruptcy_count = bankruptcy_count + excluded.bankruptcy_count
+"""
+
+EVENT_INSERT_SQL = (
+    "INSERT INTO event_history (event_id, user_id, event_type, amount, metadata, chat_id, created_at, ts) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+# Column list shared by the main and archived event_history tables.
+# A migration that adds columns to event_history must add them here and to ARCHIVE_SCHEMA_SQL
+EVENT_COLUMNS = "event_id, user_id, event_type, amount, metadata, created_at, chat_id, dice_value, bid, base_change, multiplier, ts"
+
+ARCHIVE_SCHEMA_SQL = (
+    """CREATE TABLE IF NOT EXISTS archive.event_history (
+        event_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        event_type TEXT NOT NULL,
+        amount INTEGER DEFAULT 0,
+        metadata TEXT,
+        created_at DATETIME,
+        chat_id INTEGER,
+        dice_value INTEGER,
+        bid INTEGER,
+        base_change INTEGER,
+        multiplier INTEGER,
+        ts INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_events_ts_chat ON event_history (ts, chat_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_events_user_type_ts ON event_history (user_id, event_type, ts)",
+)
+
+# Fields of a users row kept in the profile cache
+USER_CACHE_FIELDS = ("balance", "bid", "state", "nickname")
+
+# Events after each user's reconciliation watermark, with the replayed balance before every event.
+# An event is divergent if it couldn't have been applied to that balance: a spin needs
+# balance > 0 and balance >= bid (see settle_spin), a transfer needs balance >= amount.
+# Parameters: first user_id, last user_id, ts upper bound (exclusive)
+RECONCILE_TOTALS_CTE = """
+    new_events AS (
+        SELECT
+            e.user_id,
+            e.event_id,
+            e.ts,
+            e.event_type,
+            e.bid,
+            COALESCE(e.amount, 0) AS amount,
+            s.balance + SUM(COALESCE(e.amount, 0)) OVER (
+                PARTITION BY e.user_id ORDER BY e.ts, e.event_id ROWS UNBOUNDED PRECEDING
+            ) - COALESCE(e.amount, 0) AS balance_before
+        FROM ledger_reconcile_state s
+        JOIN event_history e ON e.user_id = s.user_id AND (e.ts, e.event_id) > (s.last_ts, s.last_event_id)
+        WHERE s.user_id BETWEEN ? AND ? AND e.ts < ?
+    ),
+    flagged AS (
+        SELECT *,
+            (event_type IN ('win', 'loss') AND bid IS NOT NULL AND (balance_before <= 0 OR balance_before < bid))
+            OR (event_type = 'transfer_out' AND balance_before < -amount) AS divergent
+        FROM new_events
+    ),
+    ranked AS (
+        SELECT *,
+            ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC, event_id DESC) AS from_last,
+            ROW_NUMBER() OVER (PARTITION BY user_id, divergent ORDER BY ts, event_id) AS divergent_rank
+        FROM flagged
+    ),
+    totals AS (
+        SELECT
+            user_id,
+            SUM(amount) AS amount,
+            SUM(CASE WHEN event_type IN ('win', 'loss') THEN 1 ELSE 0 END) AS games,
+            SUM(CASE WHEN event_type IN ('win', 'loss') AND amount > 0 THEN amount ELSE 0 END) AS won,
+            SUM(CASE WHEN event_type IN ('win', 'loss') AND amount < 0 THEN -amount ELSE 0 END) AS lost,
+            SUM(CASE WHEN event_type = 'bankruptcy' THEN 1 ELSE 0 END) AS bankruptcies,
+            MAX(CASE WHEN from_last = 1 THEN ts END) AS last_ts,
+            MAX(CASE WHEN from_last = 1 THEN event_id END) AS last_event_id,
+            MAX(CASE WHEN divergent AND divergent_rank = 1 THEN event_id END) AS divergent_event_id,
+            MAX(CASE WHEN divergent AND divergent_rank = 1 THEN balance_before END) AS divergent_balance
+        FROM ranked
+        GROUP BY user_id
+    )
+"""
+
+# Events newer than this are compared but not folded into the saved totals: queued events
+# (see event_write_behind) may still be written with an earlier ts
+RECONCILE_LAG_SECONDS = 60
+
+# SQLite's default limit of attached databases
+MAX_ATTACHED_ARCHIVES = 10
+
+
+def _add_months(month: date, months: int) -> date:
+    """First day of the month that is `months` away from `month`."""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _month_ts(month: date) -> int:
+    """Unix timestamp of the start of the month (UTC)."""
+    return int(datetime(month.year, month.month, 1, tzinfo=timezone.utc).timestamp())
+
+
+class SqliteDatabase(Database):
+    def __init__(self, db_path: str = None, config: DatabaseConfig = None, report_timezone: str = "UTC"):
+        super().__init__(config, report_timezone)
+        if db_path is None:
+             self.db_path = str(Path(__file__).parent.parent / "casino.db")
+        else:
+             self.db_path = db_path
+
+        # Long-lived connections: one writer (SQLite allows a single writer anyway)
+        # and a small pool of readers. Opened lazily on first use or via connect().
+        self._writer: aiosqlite.Connection | None = None
+        self._readers: asyncio.Queue[aiosqlite.Connection] | None = None
+        self._reader_conns: list[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+
+        # Write-behind queue for event_history (see add_event)
+        self._pending_events: list[tuple] = []
+        self._events_queued = asyncio.Event()
+        self._events_batch_full = asyncio.Event()
+        self._event_flush_task: asyncio.Task | None = None
+
+        # Write-through cache of hot user fields (USER_CACHE_FIELDS). Entries are loaded and
+        # changed only under the writer lock, after the DB commit. Assumes this process is
+        # the only writer of these columns.
+        self._users: LRUCache | None = None
+        # Resolver cache for /give: normalized nickname -> user_id
+        self._nicknames: LRUCache | None = None
+        if self.config.user_cache_size > 0:
+            self._users = LRUCache(maxsize=self.config.user_cache_size)
+            self._nicknames = LRUCache(maxsize=self.config.user_cache_size)
+
+    async def _open_connection(self, read_only: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute(f"PRAGMA busy_timeout = {int(self.config.busy_timeout_ms)}")
+        # Negative value means size in KiB rather than in pages
+        await conn.execute(f"PRAGMA cache_size = -{int(self.config.cache_size_kib)}")
+        await conn.execute(f"PRAGMA mmap_size = {int(self.config.mmap_size_mb) * 1024 * 1024}")
+        if read_only:
+            await conn.execute("PRAGMA query_only = 1")
+        else:
+            # WAL is persistent in the file, but setting it is cheap and idempotent
+            await conn.execute("PRAGMA journal_mode = WAL")
+            await conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    @property
+    def pending_events(self) -> int:
+        return len(self._pending_events)
+
+    async def connect(self):
+        """Open the writer and reader connections. Safe to call more than once."""
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            # Writer goes first so that WAL mode is on before readers attach
+            writer = await self._open_connection(read_only=False)
+            readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+            reader_conns = []
+            for _ in range(max(1, self.config.read_connections)):
+                conn = await self._open_connection(read_only=True)
+                reader_conns.append(conn)
+                readers.put_nowait(conn)
+            self._writer = writer
+            self._readers = readers
+            self._reader_conns = reader_conns
+
+    async def close(self):
+        """
+        Flush queued events and close all pooled connections.
+        Registered as a Dispatcher shutdown hook.
+        """
+        if self._event_flush_task is not None:
+            self._event_flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._event_flush_task
+            self._event_flush_task = None
+        await self.flush_events()
+
+        async with self._connect_lock:
+            if self._writer is None:
+                return
+            async with self._write_lock:
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+                # Keeps planner statistics fresh as tables grow (cheap, only re-analyzes if needed)
+                with suppress(aiosqlite.Error):
+                    await self._writer.execute("PRAGMA optimize")
+                await self._writer.close()
+            for conn in self._reader_conns:
+                await conn.close()
+            self._writer = None
+            self._readers = None
+            self._reader_conns = []
+
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Exclusive access to the writer connection."""
+        if self._writer is None:
+            await self.connect()
+        async with self._write_lock:
+            try:
+                yield self._writer
+            finally:
+                # Never leave a half-done transaction on the shared connection
+                if self._writer.in_transaction:
+                    await self._writer.rollback()
+
+    @asynccontextmanager
+    async def _read(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a reader connection from the pool."""
+        if self._readers is None:
+            await self.connect()
+        readers = self._readers
+        conn = await readers.get()
+        try:
+            yield conn
+        finally:
+            readers.put_nowait(conn)
+
+    def _archive_dir(self) -> Path:
+        return Path(self.db_path).parent / self.config.archive_dir
+
+    @asynccontextmanager
+    async def _attach_archives(self, db: aiosqlite.Connection, start_ts: int, end_ts: int) -> AsyncIterator[str]:
+        """
+        Attaches the archive files that overlap [start_ts, end_ts) to the connection.
+        Yields a table expression to use in place of event_history: the table itself
+        if nothing is archived for the range, otherwise a UNION ALL over all of them.
+        Must be entered outside of a transaction.
+        """
+        archives = []
+        for path in sorted(self._archive_dir().glob("????-??.db")):
+            with suppress(ValueError):
+                month = date.fromisoformat(f"{path.stem}-01")
+                if _month_ts(month) < end_ts and _month_ts(_add_months(month, 1)) > start_ts:
+                    archives.append(path)
+        if len(archives) > MAX_ATTACHED_ARCHIVES:
+            raise ValueError(f"Range spans {len(archives)} archived months, at most {MAX_ATTACHED_ARCHIVES} can be read at once")
+
+        aliases = []
+        try:
+            for index, path in enumerate(archives):
+                alias = f"archive_{index}"
+                await db.execute(f"ATTACH DATABASE ? AS {alias}", (str(path),))
+                aliases.append(alias)
+            if not aliases:
+                yield "event_history"
+            else:
+                selects = [f"SELECT {EVENT_COLUMNS} FROM main.event_history"]
+                selects += [f"SELECT {EVENT_COLUMNS} FROM {alias}.event_history" for alias in aliases]
+                yield "(" + " UNION ALL ".join(selects) + ")"
+        finally:
+            # DETACH fails inside a transaction
+            if db.in_transaction:
+                await db.rollback()
+            for alias in aliases:
+                await db.execute(f"DETACH DATABASE {alias}")
+
+    def _cached_user(self, user_id: int) -> dict | None:
+        return self._users.get(user_id) if self._users is not None else None
+
+    def _store_user(self, user_id: int, row):
+        """Caches a users row. Must contain all USER_CACHE_FIELDS."""
+        if self._users is not None:
+            self._users[user_id] = {field: row[field] for field in USER_CACHE_FIELDS}
+
+    def _update_cached_user(self, user_id: int, **fields):
+        """Write-through for users that are already cached. Call after commit."""
+        cached = self._cached_user(user_id)
+        if cached is not None:
+            cached.update(fields)
+
+    def _forget_user(self, user_id: int):
+        if self._users is not None:
+            self._users.pop(user_id, None)
+
+    async def _claim_nickname(self, db: aiosqlite.Connection, user_id: int, nickname: str) -> str:
+        """
+        Takes the handle away from its previous owner (Telegram handles can be given up
+        and taken by someone else) and drops stale resolver entries.
+        Call inside the transaction that sets the user's nickname_lc.
+        Returns the normalized nickname.
+        """
+        nickname_lc = nickname.lower()
+        if self._nicknames is not None:
+            async with db.execute("SELECT nickname_lc FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row and row[0] and row[0] != nickname_lc:
+                self._nicknames.pop(row[0], None)
+        async with db.execute(
+            "UPDATE users SET nickname_lc = NULL WHERE nickname_lc = ? AND user_id != ? RETURNING user_id",
+            (nickname_lc, user_id)
+        ) as cursor:
+            previous_owners = await cursor.fetchall()
+        # The previous owner keeps its display nickname, but must not hit the
+        # register_user shortcut if it takes the handle back later
+        for row in previous_owners:
+            self._forget_user(row[0])
+        return nickname_lc
+
+    def _cache_nickname(self, nickname_lc: str, user_id: int):
+        if self._nicknames is not None:
+            self._nicknames[nickname_lc] = user_id
+
+    async def _load_user(self, db: aiosqlite.Connection, user_id: int) -> dict | None:
+        """Reads a user's cached fields through the writer connection and caches them."""
+        async with db.execute(
+            "SELECT balance, bid, state, nickname FROM users WHERE user_id = ?", (user_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        self._store_user(user_id, row)
+        return dict(row)
+
+    async def create_tables(self):
+        """Creates or upgrades the schema by applying pending migrations."""
+        async with self._write() as db:
+            version_before = await get_schema_version(db)
+            applied = await migrate(db)
+            if applied:
+                trace_db("migrate", "schema", "applied", (applied,))
+
+        # daily_user_stats was just created: seed the days that reports can still ask for.
+        # Older days can be rebuilt with `python -m bot.maintenance rebuild-daily-stats`
+        if version_before < 4 <= version_before + applied:
+            today = self.local_today()
+            await self.rebuild_daily_stats(today - timedelta(days=1), today)
+
+    async def _get_checkpoint(self, db: aiosqlite.Connection, name: str) -> dict:
+        async with db.execute(
+            "SELECT last_ts, last_event_id, completed_at FROM maintenance_state WHERE name = ?", (name,)
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return dict(row)
+            return {"last_ts": -1, "last_event_id": "", "completed_at": None}
+
+    async def _save_checkpoint(self, db: aiosqlite.Connection, name: str, last_key: tuple[int, str], completed: bool):
+        await db.execute(
+            """INSERT INTO maintenance_state (name, last_ts, last_event_id, completed_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT(name) DO UPDATE SET
+                   last_ts = excluded.last_ts,
+                   last_event_id = excluded.last_event_id,
+                   completed_at = excluded.completed_at""",
+            (name, last_key[0], last_key[1], int(time.time()) if completed else None)
+        )
+
+    async def _run_history_pass(
+            self,
+            name: str,
+            process_chunk: Callable[[aiosqlite.Connection, tuple, tuple], Awaitable[None]],
+            finish: Callable[[aiosqlite.Connection], Awaitable[None]],
+            force: bool,
+            chunk_size: int,
+            start: Callable[[aiosqlite.Connection], Awaitable[None]] | None = None,
+    ) -> bool:
+        """
+        Streams event_history in (ts, event_id) order, chunk_size events per transaction.
+        start(db) runs before the first chunk of a pass that has no progress yet
+        (archived events are older than any event left in event_history).
+        process_chunk(db, after_key, upper_key) handles events in (after_key, upper_key].
+        finish(db) runs in the same transaction as the last chunk.
+        Progress is saved after every chunk, so an interrupted pass resumes where it stopped
+        and a rerun only reads events that appeared after the previous one.
+        A completed pass is skipped unless force is set.
+        Returns True if the pass ran.
+        """
+        await self.flush_events()
+        while True:
+            async with self._write() as db:
+                checkpoint = await self._get_checkpoint(db, name)
+                if checkpoint["completed_at"] is not None and not force:
+                    return False
+                after = (checkpoint["last_ts"], checkpoint["last_event_id"])
+                if start is not None and after == (-1, ""):
+                    await start(db)
+
+                # Upper bound of this chunk: chunk_size-th event after the watermark...
+                async with db.execute(
+                    """SELECT ts, event_id FROM event_history WHERE (ts, event_id) > (?, ?)
+                       ORDER BY ts, event_id LIMIT 1 OFFSET ?""",
+                    (*after, chunk_size - 1)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                done = row is None
+                if done:
+                    # ...or the last event overall. Nothing can be appended meanwhile: we hold the writer
+                    async with db.execute(
+                        "SELECT ts, event_id FROM event_history WHERE (ts, event_id) > (?, ?) ORDER BY ts DESC, event_id DESC LIMIT 1",
+                        after
+                    ) as cursor:
+                        row = await cursor.fetchone()
+                upper = (row[0], row[1]) if row else after
+
+                if upper != after:
+                    await process_chunk(db, after, upper)
+                if done:
+                    await finish(db)
+                await self._save_checkpoint(db, name, upper, completed=done)
+                await db.commit()
+            if done:
+                return True
+
+    async def run_stats_backfill(self, force: bool = False, chunk_size: int = 50_000):
+        """
+        Populates users.games_played / total_won / total_lost from event_history.
+        Resumable: see _run_history_pass. Skipped if already completed, unless force is set.
+        """
+        async def process_chunk(db: aiosqlite.Connection, after: tuple, upper: tuple):
+            await db.execute("""
+                INSERT INTO event_replay_state (user_id, games_played, total_won, total_lost)
+                SELECT
+                    user_id,
+                    COUNT(*),
+                    SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+                    SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END)
+                FROM event_history
+                WHERE (ts, event_id) > (?, ?) AND (ts, event_id) <= (?, ?)
+                  AND user_id IS NOT NULL AND event_type IN ('win', 'loss')
+                GROUP BY user_id
+                ON CONFLICT(user_id) DO UPDATE SET
+                    games_played = games_played + excluded.games_played,
+                    total_won = total_won + excluded.total_won,
+                    total_lost = total_lost + excluded.total_lost
+            """, (*after, *upper))
+
+        async def start(db: aiosqlite.Connection):
+            # Totals of archived games
+            await db.execute("""
+                INSERT INTO event_replay_state (user_id, games_played, total_won, total_lost)
+                SELECT user_id, SUM(event_count), SUM(positive_sum), SUM(negative_sum)
+                FROM event_archive_summary
+                WHERE user_id != 0 AND event_type IN ('win', 'loss')
+                GROUP BY user_id
+                ON CONFLICT(user_id) DO UPDATE SET
+                    games_played = excluded.games_played,
+                    total_won = excluded.total_won,
+                    total_lost = excluded.total_lost
+            """)
+
+        async def finish(db: aiosqlite.Connection):
+            await db.execute("""
+                UPDATE users
+                SET games_played = s.games_played,
+                    total_won = s.total_won,
+                    total_lost = s.total_lost
+                FROM event_replay_state s
+                WHERE s.user_id = users.user_id
+            """)
+
+        if await self._run_history_pass("stats_backfill", process_chunk, finish, force, chunk_size, start):
+            await logger.ainfo("Stats backfill completed")
+
+    async def run_bankruptcy_backfill(self, force: bool = False, chunk_size: int = 50_000, starting_balance: int = 50):
+        """
+        Replays balances from event_history to count bankruptcies (balance dropping to <= 0)
+        and inserts bankruptcy events that are missing from the history.
+        Resumable: see _run_history_pass. Skipped if already completed, unless force is set.
+        """
+        async def process_chunk(db: aiosqlite.Connection, after: tuple, upper: tuple):
+            # Running balance per user, continuing from the state saved by previous chunks.
+            # A bankruptcy is the step where the balance goes from > 0 to <= 0.
+            async with db.execute("""
+                WITH running AS (
+                    SELECT
+                        e.user_id,
+                        e.ts,
+                        e.event_id,
+                        e.created_at,
+                        COALESCE(s.balance, ?) AS start_balance,
+                        COALESCE(s.balance, ?) + SUM(COALESCE(e.amount, 0)) OVER (
+                            PARTITION BY e.user_id ORDER BY e.ts, e.event_id ROWS UNBOUNDED PRECEDING
+                        ) AS balance
+                    FROM event_history e
+                    LEFT JOIN event_replay_state s ON s.user_id = e.user_id
+                    WHERE (e.ts, e.event_id) > (?, ?) AND (e.ts, e.event_id) <= (?, ?)
+                      AND e.user_id IS NOT NULL AND e.event_type != 'bankruptcy'
+                ),
+                steps AS (
+                    SELECT *, LAG(balance, 1, start_balance) OVER (
+                        PARTITION BY user_id ORDER BY ts, event_id
+                    ) AS prev_balance
+                    FROM running
+                )
+                SELECT
+                    user_id,
+                    ts,
+                    created_at,
+                    EXISTS (
+                        SELECT 1 FROM event_history b
+                        WHERE b.user_id = steps.user_id AND b.event_type = 'bankruptcy' AND b.ts = steps.ts
+                    ) AS logged
+                FROM steps
+                WHERE balance <= 0 AND prev_balance > 0
+            """, (starting_balance, starting_balance, *after, *upper)) as cursor:
+                bankruptcies = await cursor.fetchall()
+
+            # Carry balances over to the next chunk
+            await db.execute("""
+                INSERT INTO event_replay_state (user_id, balance)
+                SELECT e.user_id, COALESCE(s.balance, ?) + SUM(COALESCE(e.amount, 0))
+                FROM event_history e
+                LEFT JOIN event_replay_state s ON s.user_id = e.user_id
+                WHERE (e.ts, e.event_id) > (?, ?) AND (e.ts, e.event_id) <= (?, ?)
+                  AND e.user_id IS NOT NULL AND e.event_type != 'bankruptcy'
+                GROUP BY e.user_id
+                ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance
+            """, (starting_balance, *after, *upper))
+
+            counts = Counter(row["user_id"] for row in bankruptcies)
+            await db.executemany(
+                "UPDATE event_replay_state SET bankruptcy_count = bankruptcy_count + ? WHERE user_id = ?",
+                [(count, user_id) for user_id, count in counts.items()]
+            )
+
+            # Missing events get the timestamp of the event that caused the bankruptcy
+            missing = {
+                (row["user_id"], row["ts"]): row["created_at"]
+                for row in bankruptcies if not row["logged"]
+            }
+            await db.executemany(
+                "INSERT INTO event_history (event_id, user_id, event_type, amount, created_at, ts) VALUES (?, ?, 'bankruptcy', 0, ?, ?)",
+                [(str(uuid.uuid4()), user_id, created_at, ts) for (user_id, ts), created_at in missing.items()]
+            )
+            if missing:
+                await logger.ainfo("Backfilled bankruptcy events", count=len(missing))
+
+        async def start(db: aiosqlite.Connection):
+            # Balances and logged bankruptcies at the end of the archived history
+            await db.execute("""
+                INSERT INTO event_replay_state (user_id, balance, bankruptcy_count)
+                SELECT
+                    user_id,
+                    ? + SUM(CASE WHEN event_type != 'bankruptcy' THEN amount_sum ELSE 0 END),
+                    SUM(CASE WHEN event_type = 'bankruptcy' THEN event_count ELSE 0 END)
+                FROM event_archive_summary
+                WHERE user_id != 0
+                GROUP BY user_id
+                ON CONFLICT(user_id) DO UPDATE SET
+                    balance = excluded.balance,
+                    bankruptcy_count = excluded.bankruptcy_count
+            """, (starting_balance,))
+
+        async def finish(db: aiosqlite.Connection):
+            await db.execute("""
+                UPDATE users
+                SET bankruptcy_count = s.bankruptcy_count
+                FROM event_replay_state s
+                WHERE s.user_id = users.user_id AND s.bankruptcy_count > 0
+            """)
+
+        if await self._run_history_pass("bankruptcy_backfill", process_chunk, finish, force, chunk_size, start):
+            await logger.ainfo("Bankruptcy backfill completed")
+
+    async def reconcile_ledger(self, starting_balance: int = 50, chunk_size: int = 1000, full: bool = False) -> list[dict]:
+        """
+        Checks users.balance and game stats against event_history, chunk_size users per transaction.
+        Each user's replayed totals are saved with a watermark, so a rerun only reads new events.
+        A user starts from starting_balance plus the totals of their archived events;
+        if more of their events were archived since, the user is replayed again.
+        Returns divergent users (see Database.reconcile_ledger).
+        """
+        await self.flush_events()
+        if full:
+            async with self._write() as db:
+                await db.execute("DELETE FROM ledger_reconcile_state")
+                await db.commit()
+
+        divergent = []
+        checked = 0
+        last_user_id = None
+        while True:
+            # Holding the writer keeps balances and events consistent within the chunk
+            async with self._write() as db:
+                if last_user_id is None:
+                    query, params = "SELECT user_id FROM users ORDER BY user_id LIMIT ?", (chunk_size,)
+                else:
+                    query, params = "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_user_id, chunk_size)
+                async with db.execute(query, params) as cursor:
+                    user_ids = [row[0] for row in await cursor.fetchall()]
+                if not user_ids:
+                    break
+                first, last_user_id = user_ids[0], user_ids[-1]
+
+                await db.execute("""
+                    DELETE FROM ledger_reconcile_state
+                    WHERE user_id BETWEEN ? AND ?
+                      AND archived_events != COALESCE((
+                          SELECT SUM(a.event_count) FROM event_archive_summary a
+                          WHERE a.user_id = ledger_reconcile_state.user_id
+                      ), 0)
+                """, (first, last_user_id))
+                await db.execute("""
+                    INSERT OR IGNORE INTO ledger_reconcile_state
+                        (user_id, archived_events, balance, games_played, total_won, total_lost, bankruptcy_count)
+                    SELECT
+                        u.user_id,
+                        COALESCE(a.events, 0),
+                        ? + COALESCE(a.amount, 0),
+                        COALESCE(a.games, 0),
+                        COALESCE(a.won, 0),
+                        COALESCE(a.lost, 0),
+                        COALESCE(a.bankruptcies, 0)
+                    FROM users u
+                    LEFT JOIN (
+                        SELECT
+                            user_id,
+                            SUM(event_count) AS events,
+                            SUM(amount_sum) AS amount,
+                            SUM(CASE WHEN event_type IN ('win', 'loss') THEN event_count ELSE 0 END) AS games,
+                            SUM(CASE WHEN event_type IN ('win', 'loss') THEN positive_sum ELSE 0 END) AS won,
+                            SUM(CASE WHEN event_type IN ('win', 'loss') THEN negative_sum ELSE 0 END) AS lost,
+                            SUM(CASE WHEN event_type = 'bankruptcy' THEN event_count ELSE 0 END) AS bankruptcies
+                        FROM event_archive_summary
+                        WHERE user_id BETWEEN ? AND ?
+                        GROUP BY user_id
+                    ) a ON a.user_id = u.user_id
+                    WHERE u.user_id BETWEEN ? AND ?
+                """, (starting_balance, first, last_user_id, first, last_user_id))
+
+                # Fold settled events into the saved totals and move the watermarks
+                await db.execute(f"""
+                    WITH {RECONCILE_TOTALS_CTE}
+                    UPDATE ledger_reconcile_state SET
+                        balance = balance + t.amount,
+                        games_played = games_played + t.games,
+                        total_won = total_won + t.won,
+                        total_lost = total_lost + t.lost,
+                        bankruptcy_count = bankruptcy_count + t.bankruptcies,
+                        last_ts = t.last_ts,
+                        last_event_id = t.last_event_id,
+                        divergent_balance = CASE WHEN ledger_reconcile_state.divergent_event_id IS NULL
+                            THEN t.divergent_balance ELSE ledger_reconcile_state.divergent_balance END,
+                        divergent_event_id = COALESCE(ledger_reconcile_state.divergent_event_id, t.divergent_event_id)
+                    FROM totals t
+                    WHERE t.user_id = ledger_reconcile_state.user_id
+                """, (first, last_user_id, int(time.time()) - RECONCILE_LAG_SECONDS))
+
+                # Compare with the recent events on top
+                async with db.execute(f"""
+                    WITH {RECONCILE_TOTALS_CTE}
+                    SELECT
+                        s.user_id,
+                        u.nickname,
+                        u.balance,
+                        s.balance + COALESCE(t.amount, 0) AS expected_balance,
+                        u.games_played,
+                        s.games_played + COALESCE(t.games, 0) AS expected_games_played,
+                        u.total_won,
+                        s.total_won + COALESCE(t.won, 0) AS expected_total_won,
+                        u.total_lost,
+                        s.total_lost + COALESCE(t.lost, 0) AS expected_total_lost,
+                        u.bankruptcy_count,
+                        s.bankruptcy_count + COALESCE(t.bankruptcies, 0) AS expected_bankruptcy_count,
+                        COALESCE(s.divergent_event_id, t.divergent_event_id) AS divergent_event_id,
+                        CASE WHEN s.divergent_event_id IS NOT NULL THEN s.divergent_balance ELSE t.divergent_balance END AS divergent_balance
+                    FROM ledger_reconcile_state s
+                    JOIN users u ON u.user_id = s.user_id
+                    LEFT JOIN totals t ON t.user_id = s.user_id
+                    WHERE s.user_id BETWEEN ? AND ?
+                """, (first, last_user_id, 2 ** 63 - 1, first, last_user_id)) as cursor:
+                    rows = await cursor.fetchall()
+
+                event_ids = [row["divergent_event_id"] for row in rows if row["divergent_event_id"] is not None]
+                events = {}
+                if event_ids:
+                    placeholders = ", ".join("?" * len(event_ids))
+                    async with db.execute(
+                        f"SELECT event_id, ts, event_type, amount, bid, chat_id FROM event_history WHERE event_id IN ({placeholders})",
+                        event_ids
+                    ) as cursor:
+                        events = {row["event_id"]: dict(row) for row in await cursor.fetchall()}
+                await db.commit()
+
+            checked += len(user_ids)
+            divergent.extend(report for row in rows if (report := self._divergence(row, events)) is not None)
+
+        await logger.ainfo("Ledger reconciliation completed", users=checked, divergent=len(divergent))
+        return divergent
+
+    async def get_balance(self, user_id: int, default_balance: int = 0) -> int:
+        cached = self._cached_user(user_id)
+        if cached is not None:
+            return cached["balance"]
+        async with self._write() as db:
+            user = await self._load_user(db, user_id)
+            if user:
+                return user["balance"]
+
+            # Если пользователя нет, создаем его
+            async with db.execute(
+                "INSERT INTO users (user_id, balance, bid) VALUES (?, ?, 1) RETURNING balance, bid, state, nickname",
+                (user_id, default_balance)
+            ) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+            self._store_user(user_id, row)
+            return default_balance
+
+    async def update_balance(self, user_id: int, amount: int):
+        started = time.perf_counter()
+        async with self._write() as db:
+            async with db.execute(
+                "UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance", (amount, user_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+            if row:
+                self._update_cached_user(user_id, balance=row[0])
+            trace_db("update_balance", "users", "user_id amount", (user_id, amount), started, rows=int(row is not None))
+            
+    async def get_bid(self, user_id: int) -> int:
+        user = self._cached_user(user_id)
+        if user is None:
+            async with self._write() as db:
+                user = await self._load_user(db, user_id)
+        # Default bid is 1 if not set (though schema has default 1)
+        return user["bid"] if user and user["bid"] is not None else 1
+
+    async def update_bid(self, user_id: int, new_bid: int):
+        started = time.perf_counter()
+        async with self._write() as db:
+            cursor = await db.execute("UPDATE users SET bid = ? WHERE user_id = ?", (new_bid, user_id))
+            await db.commit()
+            self._update_cached_user(user_id, bid=new_bid)
+            trace_db("update_bid", "users", "user_id bid", (user_id, new_bid), started, cursor.rowcount)
+
+    async def get_user_by_nickname(self, nickname: str):
+        # Remove @ if present
+        nickname_lc = nickname.lstrip('@').lower()
+        user_id = self._nicknames.get(nickname_lc) if self._nicknames is not None else None
+        user = self._cached_user(user_id) if user_id is not None else None
+        if user is None:
+            # Cache misses are filled under the writer lock, like the profile cache,
+            # so that a concurrent handle change can't be overwritten with a stale owner
+            async with self._write() as db:
+                if user_id is None:
+                    async with db.execute("SELECT user_id FROM users WHERE nickname_lc = ?", (nickname_lc,)) as cursor:
+                        row = await cursor.fetchone()
+                    if row is None:
+                        return None
+                    user_id = row[0]
+                    self._cache_nickname(nickname_lc, user_id)
+                user = await self._load_user(db, user_id)
+            if user is None:
+                return None
+        return {"user_id": user_id, **user}
+
+    async def get_user(self, user_id: int):
+        async with self._read() as db:
+            async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_all_user_nicknames(self):
+        async with self._read() as db:
+            async with db.execute("SELECT user_id, nickname FROM users") as cursor:
+                rows = await cursor.fetchall()
+                return [(row[0], row[1]) for row in rows]
+
+    async def register_user(self, user_id: int, nickname: str):
+        started = time.perf_counter()
+        # Known user with the same nickname: nothing to write
+        cached = self._cached_user(user_id)
+        if cached is not None and cached["nickname"] == nickname:
+            return
+        async with self._write() as db:
+            nickname_lc = await self._claim_nickname(db, user_id, nickname) if nickname else None
+            # Always update nickname in case it changed
+            async with db.execute(
+                """INSERT INTO users (user_id, nickname, nickname_lc, balance, bid) VALUES (?, ?, ?, 50, 1)
+                   ON CONFLICT(user_id) DO UPDATE SET nickname = excluded.nickname, nickname_lc = excluded.nickname_lc
+                   RETURNING balance, bid, state, nickname""",
+                (user_id, nickname, nickname_lc)
+            ) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+            self._store_user(user_id, row)
+            if nickname_lc:
+                self._cache_nickname(nickname_lc, user_id)
+            trace_db("register_user", "users", "user_id nickname", (user_id, nickname), started, rows=1)
+
+    async def update_user_state(self, user_id: int, state: str):
+        started = time.perf_counter()
+        async with self._write() as db:
+            cursor = await db.execute("UPDATE users SET state = ? WHERE user_id = ?", (state, user_id))
+            await db.commit()
+            self._update_cached_user(user_id, state=state)
+            trace_db("update_state", "users", "user_id state", (user_id, state), started, cursor.rowcount)
+
+    async def add_event(self, event_id: str, user_id: int, event_type: str, amount: int, metadata: str = None, chat_id: int = None):
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        params = (event_id, user_id, event_type, amount, metadata, chat_id, now.strftime("%Y-%m-%d %H:%M:%S"), int(now.timestamp()))
+
+        if self.config.event_write_behind:
+            self._pending_events.append(params)
+            self._events_queued.set()
+            if len(self._pending_events) >= self.config.event_batch_size:
+                self._events_batch_full.set()
+            if self._event_flush_task is None or self._event_flush_task.done():
+                self._event_flush_task = asyncio.create_task(self._event_flush_loop())
+            # Durability bound: don't let unflushed events pile up indefinitely
+            if len(self._pending_events) >= self.config.event_max_pending:
+                await self.flush_events()
+            trace_db("queue_event", "event_history", "event_id user_id type amount chat_id", (event_id, user_id, event_type, amount, chat_id))
+            return
+
+        async with self._write() as db:
+            await db.execute(EVENT_INSERT_SQL, params)
+            await db.commit()
+            trace_db("add_event", "event_history", "event_id user_id type amount chat_id", (event_id, user_id, event_type, amount, chat_id), started, rows=1)
+
+    async def flush_events(self):
+        """Write all queued events in one transaction."""
+        if not self._pending_events:
+            return
+        async with self._write() as db:
+            batch, self._pending_events = self._pending_events, []
+            self._events_queued.clear()
+            self._events_batch_full.clear()
+            if not batch:
+                return
+            try:
+                await db.executemany(EVENT_INSERT_SQL, batch)
+                await db.commit()
+            except Exception:
+                # Put the batch back in front so that nothing is lost and order is kept
+                self._pending_events[:0] = batch
+                self._events_queued.set()
+                raise
+
+    async def _event_flush_loop(self):
+        interval = self.config.event_flush_interval_ms / 1000
+        while True:
+            await self._events_queued.wait()
+            # Give the batch some time to fill up, unless it is full already
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._events_batch_full.wait(), interval)
+            try:
+                await self.flush_events()
+            except Exception as e:
+                await logger.aerror("Failed to flush queued events", error=str(e), pending=len(self._pending_events))
+                await asyncio.sleep(interval)
+
+    async def settle_spin(
+            self,
+            user_id: int,
+            nickname: str | None,
+            chat_id: int,
+            dice_value: int,
+            multiplier: int = 1,
+            starting_balance: int = 50,
+            bid: int | None = None,
+    ) -> dict:
+        started = time.perf_counter()
+        score_change = get_score_change(dice_value)
+        async with self._write() as db:
+            cached = self._cached_user(user_id)
+            nickname_lc = None
+            if cached is None or (nickname is not None and nickname != cached["nickname"]):
+                nickname_lc = await self._claim_nickname(db, user_id, nickname) if nickname else None
+                # Keep the old nickname if the user has no username
+                async with db.execute(
+                    """INSERT INTO users (user_id, nickname, nickname_lc, balance, bid) VALUES (?, ?, ?, ?, 1)
+                       ON CONFLICT(user_id) DO UPDATE SET
+                           nickname = COALESCE(excluded.nickname, users.nickname),
+                           nickname_lc = COALESCE(excluded.nickname_lc, users.nickname_lc)
+                       RETURNING state, nickname""",
+                    (user_id, nickname, nickname_lc, starting_balance)
+                ) as cursor:
+                    profile = dict(await cursor.fetchone())
+            else:
+                # Known user, nickname unchanged: skip the upsert
+                profile = {"state": cached["state"], "nickname": cached["nickname"]}
+
+            # Guarded update: only applies if the user can afford the bid
+            async with db.execute(
+                """UPDATE users
+                   SET balance = balance + ? * COALESCE(?, bid, 1)
+                   WHERE user_id = ? AND balance > 0 AND balance >= COALESCE(?, bid, 1)
+                   RETURNING balance, COALESCE(bid, 1)""",
+                (score_change * multiplier, bid, user_id, bid)
+            ) as cursor:
+                row = await cursor.fetchone()
+
+            if row is None:
+                async with db.execute(
+                    "SELECT balance, COALESCE(bid, 1) FROM users WHERE user_id = ?", (user_id,)
+                ) as cursor:
+                    balance, user_bid = await cursor.fetchone()
+                await db.commit()
+                self._store_user(user_id, {**profile, "balance": balance, "bid": user_bid})
+                if nickname_lc:
+                    self._cache_nickname(nickname_lc, user_id)
+                status = "bankrupt" if balance <= 0 else "insufficient"
+                return {"status": status, "balance": balance, "bid": bid or user_bid, "change": 0}
+
+            new_balance, user_bid = row
+            stake = bid or user_bid
+            change = score_change * stake * multiplier
+            is_bankruptcy = new_balance <= 0
+
+            ts = int(time.time())
+            await db.execute(
+                """INSERT INTO event_history
+                   (event_id, user_id, event_type, amount, chat_id, dice_value, bid, base_change, multiplier, ts)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    str(uuid.uuid4()), user_id, 'win' if change > 0 else 'loss', change, chat_id,
+                    dice_value, stake, score_change, multiplier, ts
+                )
+            )
+            await db.execute("""
+                UPDATE users
+                SET games_played = games_played + 1,
+                    total_won = total_won + ?,
+                    total_lost = total_lost + ?,
+                    bankruptcy_count = bankruptcy_count + ?
+                WHERE user_id = ?
+            """, (max(change, 0), max(-change, 0), 1 if is_bankruptcy else 0, user_id))
+            if is_bankruptcy:
+                # Explicit bankruptcy event for daily stats
+                await db.execute(
+                    "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES (?, ?, 'bankruptcy', 0, ?, ?)",
+                    (str(uuid.uuid4()), user_id, chat_id, ts)
+                )
+            await self._bump_stats(db, user_id, chat_id, games=1, change=change, bid=stake, bankruptcies=int(is_bankruptcy))
+            await db.commit()
+            self._store_user(user_id, {**profile, "balance": new_balance, "bid": user_bid})
+            if nickname_lc:
+                self._cache_nickname(nickname_lc, user_id)
+            trace_db("settle_spin", "users", "user_id chat_id change balance", (user_id, chat_id, change, new_balance), started, rows=1)
+            return {"status": "ok", "balance": new_balance, "bid": stake, "change": change}
+
+    async def _bump_stats(
+            self,
+            db: aiosqlite.Connection,
+            user_id: int,
+            chat_id: int | None,
+            games: int = 0,
+            change: int = 0,
+            bid: int = 0,
+            given: int = 0,
+            bankruptcies: int = 0,
+    ):
+        """
+        Updates user_chat_stats and daily_user_stats.
+        Must be called inside the transaction that logs the corresponding event.
+        """
+        if chat_id is None:
+            return
+        won = max(change, 0)
+        lost = max(-change, 0)
+        await db.execute(
+            CHAT_STATS_UPSERT_SQL,
+            (user_id, chat_id, games, won, lost, bankruptcies, games)
+        )
+        await db.execute(
+            DAILY_STATS_UPSERT_SQL,
+            (
+                self.local_today().isoformat(), chat_id, user_id,
+                games, 1 if won > 0 else 0, won, lost, won, bid * games, given, bankruptcies
+            )
+        )
+
+    async def get_last_credit_event(self, user_id: int):
+        # Queued credit grants must be visible for the cooldown check
+        await self.flush_events()
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT created_at, ts FROM event_history WHERE user_id = ? AND event_type = 'credit_grant' ORDER BY ts DESC LIMIT 1",
+                (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def transfer_money(self, from_user_id: int, to_user_id: int, amount: int, event_id_out: str, event_id_in: str, chat_id: int = None):
+        started = time.perf_counter()
+        async with self._write() as db:
+            # Check balance
+            async with db.execute("SELECT balance FROM users WHERE user_id = ?", (from_user_id,)) as cursor:
+                row = await cursor.fetchone()
+                if not row or row[0] < amount:
+                    return False
+            
+            # Transaction
+            try:
+                ts = int(time.time())
+                await db.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount, from_user_id))
+                async with db.execute(
+                    "UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance", (amount, to_user_id)
+                ) as cursor:
+                    receiver = await cursor.fetchone()
+                
+                await db.execute(
+                    "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES (?, ?, 'transfer_out', ?, ?, ?)",
+                    (event_id_out, from_user_id, -amount, chat_id, ts)
+                )
+                await db.execute(
+                    "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES (?, ?, 'transfer_in', ?, ?, ?)",
+                    (event_id_in, to_user_id, amount, chat_id, ts)
+                )
+
+                # Check for bankruptcy for sender
+                # row[0] was old balance
+                new_balance = row[0] - amount
+                bankruptcies = 0
+                if new_balance <= 0:
+                    await db.execute(
+                        "INSERT INTO event_history (event_id, user_id, event_type, amount, chat_id, ts) VALUES (?, ?, 'bankruptcy', 0, ?, ?)",
+                        (str(uuid.uuid4()), from_user_id, chat_id, ts)
+                    )
+                    await db.execute(
+                        "UPDATE users SET bankruptcy_count = bankruptcy_count + 1 WHERE user_id = ?", 
+                        (from_user_id,)
+                    )
+                    bankruptcies = 1
+                await self._bump_stats(db, from_user_id, chat_id, given=amount, bankruptcies=bankruptcies)
+
+                await db.commit()
+                self._update_cached_user(from_user_id, balance=new_balance)
+                if receiver:
+                    self._update_cached_user(to_user_id, balance=receiver[0])
+                trace_db("transfer", "users", "from_user_id to_user_id amount chat_id", (from_user_id, to_user_id, amount, chat_id), started, rows=2)
+                return True
+            except Exception:
+                # aiosqlite context manager automatically rolls back on exception if not committed, 
+                # but we are inside a context manager for connect, not transaction. 
+                # However, without BEGIN TRANSACTION explicitly, sqlite is in auto-commit mode usually, 
+                # but aiosqlite might handle it. 
+                # Ideally we should use `await db.execute("BEGIN TRANSACTION")` but let's trust the context or simple sequential execution for now.
+                # Actually aiosqlite connect context commits at the end if no error.
+                # If we raise here, it might rollback. 
+                # Let's add explicit rollback just in case.
+                await db.rollback()
+                return False
+
+    async def create_credit_session(self, session_id: str, user_id: int):
+        async with self._write() as db:
+            await db.execute(
+                "INSERT INTO ai_credit_sessions (session_id, user_id, status) VALUES (?, ?, 'active')",
+                (session_id, user_id)
+            )
+            await db.commit()
+
+    async def update_session_status(self, session_id: str, status: str):
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE ai_credit_sessions SET status = ? WHERE session_id = ?",
+                (status, session_id)
+            )
+            await db.commit()
+
+    async def terminate_all_active_sessions(self, idle_timeout_minutes: int = 0):
+        """
+        Force close all active AI credit sessions on bot startup
+        (open sessions only live in memory, see CreditSessionRegistry).
+        The database has a single process, so the timeout doesn't matter.
+        """
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE ai_credit_sessions SET status = 'terminated', finished_at = CURRENT_TIMESTAMP WHERE status IN ('active', 'processing')"
+            )
+            await db.execute("UPDATE users SET state = 'IDLE' WHERE state = 'IN_DIALOGUE'")
+            await db.commit()
+            if self._users is not None:
+                self._users.clear()
+
+    async def close_credit_session(self, session_id: str, status: str, score: int, reward: int):
+        async with self._write() as db:
+            await db.execute(
+                """UPDATE ai_credit_sessions 
+                   SET status = ?, ai_score = ?, reward_amount = ?, finished_at = CURRENT_TIMESTAMP 
+                   WHERE session_id = ?""",
+                (status, score, reward, session_id)
+            )
+            await db.commit()
+
+    async def add_dialogue_message(self, session_id: str, role: str, content: str):
+        async with self._write() as db:
+            await db.execute(
+                "INSERT INTO ai_dialogue_messages (session_id, role, content) VALUES (?, ?, ?)",
+                (session_id, role, content)
+            )
+            await db.commit()
+
+    async def get_dialogue_history(self, session_id: str, limit: int = 10):
+        async with self._read() as db:
+            # We want the last N messages, but in chronological order
+            # (reads only N rows from the (session_id, message_id) index)
+            async with db.execute(
+                """SELECT role, content FROM (
+                       SELECT message_id, role, content FROM ai_dialogue_messages
+                       WHERE session_id = ? ORDER BY message_id DESC LIMIT ?
+                   ) ORDER BY message_id ASC""",
+                (session_id, limit)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def save_pending_actions(self, actions: list[tuple[str, str, int, int, str]]):
+        async with self._write() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO pending_actions (action_id, kind, chat_id, due_ts, payload) VALUES (?, ?, ?, ?, ?)",
+                actions
+            )
+            await db.commit()
+
+    async def delete_pending_actions(self, action_ids: list[str]):
+        async with self._write() as db:
+            await db.executemany(
+                "DELETE FROM pending_actions WHERE action_id = ?",
+                [(action_id,) for action_id in action_ids]
+            )
+            await db.commit()
+
+    async def get_pending_actions(self) -> list[dict]:
+        async with self._read() as db:
+            async with db.execute(
+                "SELECT action_id, kind, chat_id, due_ts, payload FROM pending_actions ORDER BY due_ts"
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def save_group_activity(self, chats: list[tuple[int, str]], memberships: list[tuple[int, int, int]]):
+        async with self._write() as db:
+            await db.executemany(
+                """INSERT INTO chats (chat_id, title, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                   ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at""",
+                chats
+            )
+            await db.executemany(
+                """INSERT INTO user_groups (user_id, chat_id, last_seen) VALUES (?, ?, datetime(?, 'unixepoch'))
+                   ON CONFLICT (user_id, chat_id) DO UPDATE SET last_seen = excluded.last_seen""",
+                memberships
+            )
+            await db.commit()
+
+    async def get_chat_titles(self) -> dict[int, str]:
+        async with self._read() as db:
+            async with db.execute("SELECT chat_id, title FROM chats") as cursor:
+                return {row["chat_id"]: row["title"] for row in await cursor.fetchall()}
+
+    async def get_daily_stats(self, start_ts: int, end_ts: int, chat_id: int = None):
+        """
+        Aggregates stats for all users within the given time range [start_ts, end_ts) (unix epoch).
+        Returns a list of dicts with user stats.
+        Daily reports read the daily_user_stats rollup instead (see get_daily_rollup).
+        """
+        await self.flush_events()
+        async with self._read() as db, self._attach_archives(db, start_ts, end_ts) as events:
+            # We aggregate by user_id
+            # We need:
+            # - total games (count of win/loss)
+            # - total won (sum of positive amounts in win/loss)
+            # - total lost (sum of abs negative amounts in win/loss)
+            # - bankruptcy count (count of bankruptcy events)
+            # - total given (sum of abs amounts in transfer_out)
+            # - max win (max positive amount in win/loss)
+            
+            # Note: SQLite doesn't have a simple pivot, so we use conditional aggregation.
+            query = f"""
+                SELECT 
+                    u.user_id,
+                    u.nickname,
+                    COUNT(CASE WHEN eh.event_type IN ('win', 'loss') THEN 1 END) as games_played,
+                    SUM(CASE WHEN eh.event_type IN ('win') AND eh.amount > 0 THEN eh.amount ELSE 0 END) as total_won,
+                    SUM(CASE WHEN eh.event_type IN ('loss') AND eh.amount < 0 THEN ABS(eh.amount) ELSE 0 END) as total_lost,
+                    SUM(CASE WHEN eh.event_type = 'bankruptcy' THEN 1 ELSE 0 END) as bankruptcy_count,
+                    SUM(CASE WHEN eh.event_type = 'transfer_out' THEN ABS(eh.amount) ELSE 0 END) as total_given,
+                    MAX(CASE WHEN eh.event_type IN ('win') THEN eh.amount ELSE 0 END) as max_win_amount,
+                    AVG(CASE WHEN eh.event_type IN ('win', 'loss') THEN eh.bid END) as avg_bid
+                FROM users u
+                JOIN {events} eh ON u.user_id = eh.user_id
+                WHERE eh.ts >= ? AND eh.ts < ?
+            """
+            
+            params = [start_ts, end_ts]
+            if chat_id:
+                query += " AND eh.chat_id = ?"
+                params.append(chat_id)
+                
+            query += " GROUP BY u.user_id, u.nickname"
+            
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def get_daily_rollup(self, local_date: date, chat_id: int = None):
+        """
+        Reads per-user stats for one day (in reports timezone) from the daily_user_stats rollup.
+        Returns a list of dicts with the same keys as get_daily_stats plus games_won.
+        """
+        query = """
+            SELECT
+                d.user_id,
+                u.nickname,
+                SUM(d.games_played) as games_played,
+                SUM(d.games_won) as games_won,
+                SUM(d.total_won) as total_won,
+                SUM(d.total_lost) as total_lost,
+                SUM(d.bankruptcy_count) as bankruptcy_count,
+                SUM(d.total_given) as total_given,
+                MAX(d.max_win_amount) as max_win_amount,
+                CAST(SUM(d.bid_sum) AS REAL) / NULLIF(SUM(d.games_played), 0) as avg_bid
+            FROM daily_user_stats d
+            JOIN users u ON u.user_id = d.user_id
+            WHERE d.local_date = ?
+        """
+        params = [local_date.isoformat()]
+        if chat_id:
+            query += " AND d.chat_id = ?"
+            params.append(chat_id)
+        query += " GROUP BY d.user_id, u.nickname"
+
+        async with self._read() as db:
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def rebuild_daily_stats(self, start_date: date, end_date: date) -> int:
+        """
+        Recomputes daily_user_stats from event_history for local dates in [start_date, end_date].
+        Archived months are read from the archive files.
+        Returns the number of processed days.
+        """
+        started = time.perf_counter()
+        await self.flush_events()
+        days = 0
+        day = start_date
+        while day <= end_date:
+            # Local day boundaries as unix timestamps
+            start_ts = int(self.report_timezone.localize(datetime.combine(day, datetime.min.time())).timestamp())
+            end_ts = int(self.report_timezone.localize(datetime.combine(day + timedelta(days=1), datetime.min.time())).timestamp())
+
+            async with self._write() as db, self._attach_archives(db, start_ts, end_ts) as events:
+                await db.execute("DELETE FROM daily_user_stats WHERE local_date = ?", (day.isoformat(),))
+                await db.execute(f"""
+                    INSERT INTO daily_user_stats
+                        (local_date, chat_id, user_id, games_played, games_won, total_won, total_lost,
+                         max_win_amount, bid_sum, total_given, bankruptcy_count)
+                    SELECT
+                        ?,
+                        chat_id,
+                        user_id,
+                        COUNT(CASE WHEN event_type IN ('win', 'loss') THEN 1 END),
+                        COUNT(CASE WHEN event_type = 'win' AND amount > 0 THEN 1 END),
+                        SUM(CASE WHEN event_type = 'win' AND amount > 0 THEN amount ELSE 0 END),
+                        SUM(CASE WHEN event_type = 'loss' AND amount < 0 THEN ABS(amount) ELSE 0 END),
+                        MAX(CASE WHEN event_type = 'win' THEN amount ELSE 0 END),
+                        SUM(CASE WHEN event_type IN ('win', 'loss') THEN COALESCE(bid, 0) ELSE 0 END),
+                        SUM(CASE WHEN event_type = 'transfer_out' THEN ABS(amount) ELSE 0 END),
+                        SUM(CASE WHEN event_type = 'bankruptcy' THEN 1 ELSE 0 END)
+                    FROM {events}
+                    WHERE ts >= ? AND ts < ?
+                      AND chat_id IS NOT NULL AND user_id IS NOT NULL
+                    GROUP BY chat_id, user_id
+                """, (day.isoformat(), start_ts, end_ts))
+                await db.commit()
+            days += 1
+            day += timedelta(days=1)
+        trace_db("rebuild_daily_stats", "daily_user_stats", "start_date end_date days", (start_date, end_date, days), started)
+        return days
+
+    async def archive_events(self) -> list[str]:
+        """
+        Moves events of closed months older than archive_keep_months from event_history
+        into archive/YYYY-MM.db files (months are in UTC). Per-month totals stay in
+        event_archive_summary. Returns the names of the archived months.
+        """
+        keep_months = self.config.archive_keep_months
+        if keep_months <= 0:
+            return []
+        await self.flush_events()
+
+        today = datetime.now(timezone.utc).date()
+        cutoff_ts = _month_ts(_add_months(date(today.year, today.month, 1), -keep_months))
+        async with self._read() as db:
+            # Don't move events from under a history pass that is still in progress
+            async with db.execute("SELECT MIN(last_ts) FROM maintenance_state WHERE completed_at IS NULL") as cursor:
+                row = await cursor.fetchone()
+                if row[0] is not None:
+                    cutoff_ts = min(cutoff_ts, row[0])
+            async with db.execute("SELECT MIN(ts) FROM event_history") as cursor:
+                row = await cursor.fetchone()
+                oldest_ts = row[0]
+        if oldest_ts is None:
+            return []
+
+        archived = []
+        oldest = datetime.fromtimestamp(oldest_ts, timezone.utc)
+        month = date(oldest.year, oldest.month, 1)
+        while _month_ts(_add_months(month, 1)) <= cutoff_ts:
+            name = month.strftime("%Y-%m")
+            moved = await self._archive_month(month, self._archive_dir() / f"{name}.db")
+            if moved:
+                archived.append(name)
+                await logger.ainfo("Archived events", month=name, events=moved)
+            month = _add_months(month, 1)
+        return archived
+
+    async def _archive_month(self, month: date, path: Path) -> int:
+        """Moves one month of events into its archive file, a day per transaction."""
+        started = time.perf_counter()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        month_name = month.strftime("%Y-%m")
+        month_end = _month_ts(_add_months(month, 1))
+        moved = 0
+        for start_ts in range(_month_ts(month), month_end, 86400):
+            end_ts = min(start_ts + 86400, month_end)
+            async with self._write() as db:
+                await db.execute("ATTACH DATABASE ? AS archive", (str(path),))
+                try:
+                    for statement in ARCHIVE_SCHEMA_SQL:
+                        await db.execute(statement)
+                    # The archive and the main database commit separately. Copy first, so that
+                    # a crash in between leaves the events in both files (a rerun skips the copies)
+                    await db.execute(
+                        f"INSERT OR IGNORE INTO archive.event_history ({EVENT_COLUMNS}) "
+                        f"SELECT {EVENT_COLUMNS} FROM main.event_history WHERE ts >= ? AND ts < ?",
+                        (start_ts, end_ts)
+                    )
+                    await db.commit()
+
+                    await db.execute("""
+                        INSERT INTO event_archive_summary
+                            (month, user_id, chat_id, event_type, event_count, amount_sum,
+                             positive_sum, negative_sum, bid_sum, first_ts, last_ts)
+                        SELECT
+                            ?,
+                            COALESCE(user_id, 0),
+                            COALESCE(chat_id, 0),
+                            event_type,
+                            COUNT(*),
+                            SUM(COALESCE(amount, 0)),
+                            SUM(CASE WHEN amount > 0 THEN amount ELSE 0 END),
+                            SUM(CASE WHEN amount < 0 THEN ABS(amount) ELSE 0 END),
+                            SUM(COALESCE(bid, 0)),
+                            MIN(ts),
+                            MAX(ts)
+                        FROM main.event_history
+                        WHERE ts >= ? AND ts < ?
+                        GROUP BY COALESCE(user_id, 0), COALESCE(chat_id, 0), event_type
+                        ON CONFLICT(month, user_id, chat_id, event_type) DO UPDATE SET
+                            event_count = event_count + excluded.event_count,
+                            amount_sum = amount_sum + excluded.amount_sum,
+                            positive_sum = positive_sum + excluded.positive_sum,
+                            negative_sum = negative_sum + excluded.negative_sum,
+                            bid_sum = bid_sum + excluded.bid_sum,
+                            first_ts = MIN(first_ts, excluded.first_ts),
+                            last_ts = MAX(last_ts, excluded.last_ts)
+                    """, (month_name, start_ts, end_ts))
+                    cursor = await db.execute(
+                        "DELETE FROM main.event_history WHERE ts >= ? AND ts < ?", (start_ts, end_ts)
+                    )
+                    moved += cursor.rowcount
+                    await db.commit()
+                finally:
+                    if db.in_transaction:
+                        await db.rollback()
+                    await db.execute("DETACH DATABASE archive")
+        if moved:
+            trace_db("archive_events", "event_history", "month", (month_name,), started, moved)
+        return moved
+
+    async def prune_dialogues(self) -> int:
+        """
+        Deletes dialogue messages of AI credit sessions that finished more than
+        dialogue_retention_days ago. Returns the number of deleted messages.
+        """
+        started = time.perf_counter()
+        retention_days = self.config.dialogue_retention_days
+        if retention_days <= 0:
+            return 0
+        async with self._write() as db:
+            cursor = await db.execute("""
+                DELETE FROM ai_dialogue_messages
+                WHERE session_id IN (
+                    SELECT session_id FROM ai_credit_sessions
+                    WHERE status NOT IN ('active', 'processing')
+                      AND finished_at < datetime('now', ?)
+                )
+            """, (f"-{int(retention_days)} days",))
+            await db.commit()
+            deleted = cursor.rowcount
+        if deleted:
+            trace_db("prune_dialogues", "ai_dialogue_messages", started=started, rows=deleted)
+        return deleted
+
+    async def get_top_users_in_group(self, chat_id: int, limit: int = 30):
+        async with self._read() as db:
+            async with db.execute(
+                """
+                SELECT 
+                    u.user_id, 
+                    u.nickname, 
+                    u.balance, 
+                    COALESCE(stats.games_played, 0) as games_played,
+                    COALESCE(stats.total_won, 0) as total_won,
+                    COALESCE(stats.total_lost, 0) as total_lost,
+                    COALESCE(stats.bankruptcy_count, 0) as bankruptcy_count
+                FROM user_groups ug
+                JOIN users u ON u.user_id = ug.user_id
+                LEFT JOIN user_chat_stats stats ON stats.user_id = ug.user_id AND stats.chat_id = ug.chat_id
+                WHERE ug.chat_id = ?
+                ORDER BY u.balance DESC
+                LIMIT ?
+                """,
+                (chat_id, limit)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
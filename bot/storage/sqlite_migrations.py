@@ -0,0 +1,413 @@
+"""
+Versioned schema migrations for the SQLite database.
+
+The schema version is stored in `PRAGMA user_version`. Each migration is an async
+function that receives the writer connection; its version is its position in
+MIGRATIONS (first one is version 1). To change the schema, append a new function
+to the list. Never edit or reorder migrations that have already been released.
+"""
+from typing import Awaitable, Callable
+
+import aiosqlite
+import structlog
+
+logger = structlog.get_logger()
+
+
+async def _get_columns(db: aiosqlite.Connection, table: str) -> set[str]:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+
+async def _add_missing_columns(db: aiosqlite.Connection, table: str, columns: dict[str, str]):
+    existing = await _get_columns(db, table)
+    for name, definition in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+async def _initial_schema(db: aiosqlite.Connection):
+    # 1. Users table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            nickname TEXT,
+            balance INTEGER NOT NULL DEFAULT 50,
+            bid INTEGER DEFAULT 1,
+            state TEXT DEFAULT 'IDLE',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            games_played INTEGER DEFAULT 0,
+            total_won INTEGER DEFAULT 0,
+            total_lost INTEGER DEFAULT 0,
+            bankruptcy_count INTEGER DEFAULT 0
+        )
+    """)
+
+    # 2. Event history table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS event_history (
+            event_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            event_type TEXT NOT NULL,
+            amount INTEGER DEFAULT 0,
+            metadata TEXT, -- JSON storage
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            chat_id INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # 3. AI Credit Sessions
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS ai_credit_sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT DEFAULT 'active', -- active, completed, rejected
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME,
+            ai_score INTEGER,
+            reward_amount INTEGER,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # 4. AI Dialogue Messages
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS ai_dialogue_messages (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            role TEXT NOT NULL, -- user, assistant
+            content TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(session_id) REFERENCES ai_credit_sessions(session_id)
+        )
+    """)
+
+    # 5. User Groups (for local leaderboards)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_groups (
+            user_id INTEGER,
+            chat_id INTEGER,
+            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, chat_id),
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        )
+    """)
+
+    # Databases created before versioning may lack columns that were added later.
+    # (users.created_at can't be added this way: SQLite forbids non-constant defaults in ALTER)
+    await _add_missing_columns(db, "users", {
+        "nickname": "TEXT",
+        "bid": "INTEGER DEFAULT 1",
+        "state": "TEXT DEFAULT 'IDLE'",
+        "games_played": "INTEGER DEFAULT 0",
+        "total_won": "INTEGER DEFAULT 0",
+        "total_lost": "INTEGER DEFAULT 0",
+        "bankruptcy_count": "INTEGER DEFAULT 0",
+    })
+    await _add_missing_columns(db, "event_history", {
+        "chat_id": "INTEGER",
+    })
+
+
+async def _reporting_indexes(db: aiosqlite.Connection):
+    # Leaderboard: per-chat aggregation by user (covering: includes amount)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_chat_user_type "
+        "ON event_history (chat_id, user_id, event_type, amount)"
+    )
+    # Last credit grant, per-user replays in backfills
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_user_type_time "
+        "ON event_history (user_id, event_type, created_at)"
+    )
+    # Daily reports: time range scans
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_time_chat "
+        "ON event_history (created_at, chat_id)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_groups_chat "
+        "ON user_groups (chat_id, user_id)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_credit_sessions_user_status "
+        "ON ai_credit_sessions (user_id, status)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_dialogue_session "
+        "ON ai_dialogue_messages (session_id, message_id)"
+    )
+
+
+async def _user_chat_stats(db: aiosqlite.Connection):
+    # Per-chat leaderboard stats, maintained by the write paths in the same
+    # transaction as the corresponding event_history rows
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_chat_stats (
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            total_won INTEGER NOT NULL DEFAULT 0,
+            total_lost INTEGER NOT NULL DEFAULT 0,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            last_played DATETIME,
+            PRIMARY KEY (user_id, chat_id)
+        ) WITHOUT ROWID
+    """)
+    # Seed from the existing history
+    await db.execute("""
+        INSERT OR REPLACE INTO user_chat_stats
+            (user_id, chat_id, games_played, total_won, total_lost, bankruptcy_count, last_played)
+        SELECT
+            user_id,
+            chat_id,
+            COUNT(CASE WHEN event_type IN ('win', 'loss') THEN 1 END),
+            SUM(CASE WHEN event_type = 'win' AND amount > 0 THEN amount ELSE 0 END),
+            SUM(CASE WHEN event_type = 'loss' AND amount < 0 THEN ABS(amount) ELSE 0 END),
+            SUM(CASE WHEN event_type = 'bankruptcy' THEN 1 ELSE 0 END),
+            MAX(CASE WHEN event_type IN ('win', 'loss') THEN created_at END)
+        FROM event_history
+        WHERE user_id IS NOT NULL AND chat_id IS NOT NULL
+        GROUP BY user_id, chat_id
+    """)
+
+
+async def _daily_user_stats(db: aiosqlite.Connection):
+    # Per-day rollup for daily reports. local_date is the date in the reports timezone,
+    # so it can't be seeded here: use `python -m bot.maintenance rebuild-daily-stats`
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            local_date TEXT NOT NULL, -- YYYY-MM-DD in reports timezone
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            games_won INTEGER NOT NULL DEFAULT 0,
+            total_won INTEGER NOT NULL DEFAULT 0,
+            total_lost INTEGER NOT NULL DEFAULT 0,
+            max_win_amount INTEGER NOT NULL DEFAULT 0,
+            bid_sum INTEGER NOT NULL DEFAULT 0,
+            total_given INTEGER NOT NULL DEFAULT 0,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (local_date, chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+
+async def _typed_event_columns(db: aiosqlite.Connection):
+    # Spin details and an integer timestamp as real columns instead of JSON metadata / text dates
+    await _add_missing_columns(db, "event_history", {
+        "dice_value": "INTEGER",
+        "bid": "INTEGER",
+        "base_change": "INTEGER",
+        "multiplier": "INTEGER",
+        "ts": "INTEGER",  # unix epoch, seconds
+    })
+    # created_at is CURRENT_TIMESTAMP, i.e. UTC
+    await db.execute("""
+        UPDATE event_history
+        SET ts = CAST(strftime('%s', created_at) AS INTEGER)
+        WHERE ts IS NULL AND created_at IS NOT NULL
+    """)
+    # Move spin metadata into columns; spin rows no longer need the JSON copy
+    await db.execute("""
+        UPDATE event_history
+        SET dice_value = json_extract(metadata, '$.dice_value'),
+            bid = json_extract(metadata, '$.bid'),
+            base_change = json_extract(metadata, '$.base_score_change'),
+            multiplier = json_extract(metadata, '$.super_jackpot_multiplier'),
+            metadata = NULL
+        WHERE event_type IN ('win', 'loss') AND metadata IS NOT NULL AND json_valid(metadata)
+    """)
+    # Time-based indexes now use ts
+    await db.execute("DROP INDEX IF EXISTS idx_events_user_type_time")
+    await db.execute("DROP INDEX IF EXISTS idx_events_time_chat")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_user_type_ts "
+        "ON event_history (user_id, event_type, ts)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_ts_chat "
+        "ON event_history (ts, chat_id)"
+    )
+
+
+async def _backfill_checkpoints(db: aiosqlite.Connection):
+    # Progress of resumable maintenance passes over event_history.
+    # The watermark is the (ts, event_id) of the last processed event.
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            name TEXT PRIMARY KEY,
+            last_ts INTEGER NOT NULL DEFAULT -1,
+            last_event_id TEXT NOT NULL DEFAULT '',
+            completed_at INTEGER
+        )
+    """)
+    # Per-user totals carried between chunks of the history replays
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS event_replay_state (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            total_won INTEGER NOT NULL DEFAULT 0,
+            total_lost INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Keyset pagination over the whole history
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_ts_id "
+        "ON event_history (ts, event_id)"
+    )
+
+
+async def _event_archive_summary(db: aiosqlite.Connection):
+    # Totals of events moved to the monthly archive files (see SqliteDatabase.archive_events).
+    # NULL user_id / chat_id are stored as 0
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS event_archive_summary (
+            month TEXT NOT NULL, -- YYYY-MM, UTC
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            event_count INTEGER NOT NULL DEFAULT 0,
+            amount_sum INTEGER NOT NULL DEFAULT 0,
+            positive_sum INTEGER NOT NULL DEFAULT 0,
+            negative_sum INTEGER NOT NULL DEFAULT 0,
+            bid_sum INTEGER NOT NULL DEFAULT 0,
+            first_ts INTEGER,
+            last_ts INTEGER,
+            PRIMARY KEY (month, user_id, chat_id, event_type)
+        ) WITHOUT ROWID
+    """)
+
+
+async def _nickname_index(db: aiosqlite.Connection):
+    # Normalized handle for /give lookups. Telegram usernames are ASCII and unique
+    # at any moment, but a handle can be given up and taken by someone else,
+    # so nickname_lc only belongs to its current owner (see SqliteDatabase._claim_nickname)
+    await _add_missing_columns(db, "users", {
+        "nickname_lc": "TEXT",
+    })
+    await db.execute("""
+        UPDATE users SET nickname_lc = lower(nickname)
+        WHERE nickname IS NOT NULL AND nickname != ''
+    """)
+    # Existing duplicates: the handle stays with the most recently seen user
+    await db.execute("""
+        WITH ranked AS (
+            SELECT
+                u.user_id,
+                ROW_NUMBER() OVER (
+                    PARTITION BY u.nickname_lc ORDER BY MAX(g.last_seen) DESC, u.user_id DESC
+                ) AS position
+            FROM users u
+            LEFT JOIN user_groups g ON g.user_id = u.user_id
+            WHERE u.nickname_lc IS NOT NULL
+            GROUP BY u.user_id
+        )
+        UPDATE users SET nickname_lc = NULL
+        WHERE user_id IN (SELECT user_id FROM ranked WHERE position > 1)
+    """)
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_nickname_lc "
+        "ON users (nickname_lc)"
+    )
+
+
+async def _ledger_reconcile_state(db: aiosqlite.Connection):
+    # Per-user balance and stats replayed from event_history by the ledger reconciliation
+    # (see SqliteDatabase.reconcile_ledger). last_ts / last_event_id is the user's watermark;
+    # archived_events is the number of the user's archived events the row was seeded with
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_reconcile_state (
+            user_id INTEGER PRIMARY KEY,
+            last_ts INTEGER NOT NULL DEFAULT -1,
+            last_event_id TEXT NOT NULL DEFAULT '',
+            archived_events INTEGER NOT NULL DEFAULT 0,
+            balance INTEGER NOT NULL,
+            games_played INTEGER NOT NULL DEFAULT 0,
+            total_won INTEGER NOT NULL DEFAULT 0,
+            total_lost INTEGER NOT NULL DEFAULT 0,
+            bankruptcy_count INTEGER NOT NULL DEFAULT 0,
+            divergent_event_id TEXT, -- first event the replayed balance can't explain
+            divergent_balance INTEGER -- replayed balance before that event
+        )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_archive_summary_user "
+        "ON event_archive_summary (user_id)"
+    )
+
+
+async def _pending_actions(db: aiosqlite.Connection):
+    # Delayed actions that must survive a restart (see DelayedActions), e.g. deleting a losing spin.
+    # due_ts is unix epoch; payload is JSON
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS pending_actions (
+            action_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            due_ts INTEGER NOT NULL,
+            payload TEXT NOT NULL
+        )
+    """)
+
+
+async def _chats(db: aiosqlite.Connection):
+    # Titles of the groups the bot has seen (were kept in groups.json)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+MIGRATIONS: list[Callable[[aiosqlite.Connection], Awaitable[None]]] = [
+    _initial_schema,
+    _reporting_indexes,
+    _user_chat_stats,
+    _daily_user_stats,
+    _typed_event_columns,
+    _backfill_checkpoints,
+    _event_archive_summary,
+    _nickname_index,
+    _ledger_reconcile_state,
+    _pending_actions,
+    _chats,
+]
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+        return row[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """
+    Applies pending migrations, each one in its own transaction.
+    Returns the number of applied migrations.
+    """
+    current = await get_schema_version(db)
+    pending = MIGRATIONS[current:]
+    if not pending:
+        return 0
+
+    for version, step in enumerate(pending, start=current + 1):
+        await db.execute("BEGIN")
+        try:
+            await step(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        await logger.ainfo("Applied DB migration", version=version, migration=step.__name__)
+
+    # Refresh planner statistics for the new schema/indexes
+    await db.execute("ANALYZE")
+    await db.commit()
+    return len(pending)
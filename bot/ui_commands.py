@@ -1,13 +1,20 @@
 from aiogram import Bot
 from aiogram.types import BotCommand, BotCommandScopeAllPrivateChats
-from fluent.runtime import FluentLocalization
 
+from bot.localization import Locale, Localizations
 
-async def set_bot_commands(bot: Bot, l10n: FluentLocalization):
-    commands = [
+
+def _commands(l10n: Locale) -> list[BotCommand]:
+    return [
             BotCommand(command="start", description=l10n.format_value("menu-start")),
             BotCommand(command="spin", description=l10n.format_value("menu-spin")),
             BotCommand(command="stop", description=l10n.format_value("menu-stop")),
             BotCommand(command="help", description=l10n.format_value("menu-help"))
         ]
-    await bot.set_my_commands(commands=commands, scope=BotCommandScopeAllPrivateChats())
+
+
+async def set_bot_commands(bot: Bot, locales: Localizations):
+    # Default commands, then the translated ones for users with each language
+    await bot.set_my_commands(commands=_commands(locales.default), scope=BotCommandScopeAllPrivateChats())
+    for code, l10n in locales.locales.items():
+        await bot.set_my_commands(commands=_commands(l10n), scope=BotCommandScopeAllPrivateChats(), language_code=code)
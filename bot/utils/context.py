@@ -1,12 +1,45 @@
+import time
 from contextvars import ContextVar
-from typing import List, Optional
+from typing import Any, List, Optional, Tuple
 
-# Context variable to track database actions within a request
-db_actions_ctx: ContextVar[Optional[List[str]]] = ContextVar("db_actions", default=None)
+# (operation, table, param names, param values, duration in seconds or None, rows affected or None)
+DbAction = Tuple[str, str, str, Tuple[Any, ...], Optional[float], Optional[int]]
 
-def add_db_action(action: str):
-    """Helper to add an action to the current context if it exists."""
+# Context variable to track database actions within a request.
+# None (no request, or tracing disabled) makes trace_db a no-op
+db_actions_ctx: ContextVar[Optional[List[DbAction]]] = ContextVar("db_actions", default=None)
+
+
+def trace_db(
+        operation: str,
+        table: str,
+        keys: str = "",
+        params: Tuple[Any, ...] = (),
+        started: Optional[float] = None,
+        rows: Optional[int] = None,
+):
+    """
+    Records a DB action in the current request, if it's traced.
+    keys names the params, space separated (a constant, so nothing is formatted here);
+    started is time.perf_counter() from before the action. Rendered by render_db_actions.
+    """
     actions = db_actions_ctx.get()
     if actions is not None:
-        actions.append(action)
+        duration = time.perf_counter() - started if started is not None else None
+        actions.append((operation, table, keys, params, duration, rows))
+
+
+def render_db_action(action: DbAction) -> str:
+    operation, table, keys, params, duration, rows = action
+    text = f"{operation} {table}"
+    if params:
+        text += " " + " ".join(f"{key}={value}" for key, value in zip(keys.split(), params))
+    if rows is not None:
+        text += f" rows={rows}"
+    if duration is not None:
+        text += f" {duration * 1000:.1f}ms"
+    return text
+
 
+def render_db_actions(actions: List[DbAction]) -> List[str]:
+    return [render_db_action(action) for action in actions]
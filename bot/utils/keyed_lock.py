@@ -0,0 +1,44 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+
+class _Entry:
+    __slots__ = ("lock", "holders")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        # Tasks holding or waiting for the lock
+        self.holders = 0
+
+
+class KeyedLock:
+    """
+    One asyncio.Lock per key, created on first use.
+    A key's lock is dropped as soon as no task holds or waits for it,
+    so memory is bounded by the number of keys in use at the same time.
+    """
+
+    def __init__(self):
+        self._entries: dict[Hashable, _Entry] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+        entry.holders += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.holders -= 1
+            if entry.holders == 0:
+                del self._entries[key]
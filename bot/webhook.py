@@ -0,0 +1,112 @@
+import asyncio
+import signal
+from typing import Any
+
+import structlog
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from bot.config_reader import WebhookConfig
+
+logger = structlog.get_logger()
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler that answers Telegram right away and processes updates in
+    background tasks, at most max_in_flight at a time. When all slots are taken,
+    the request waits for one, so Telegram slows down instead of the bot piling up tasks.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_in_flight: int, secret_token: str | None = None, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def _feed_update(self, bot: Bot, update: dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot, update, **self.data)
+            # A handler may answer with a method instead of calling it, see aiogram's "reply into webhook"
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot, result)
+        finally:
+            self._slots.release()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Forbidden", status=403)
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except ValueError:
+            return web.Response(body="Bad Request", status=400)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._feed_update(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self):
+        # Let running handlers finish. The bot session stays open for the
+        # dispatcher shutdown hooks (the outbound queue sends what's left) and is closed by run_webhook
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_app(dp: Dispatcher, bot: Bot, config: WebhookConfig) -> web.Application:
+    """
+    The aiohttp application with the webhook and health routes.
+    Dispatcher startup and shutdown hooks run with it; on startup the webhook is registered.
+    """
+    secret_token = config.secret_token.get_secret_value() if config.secret_token else None
+    handler = LimitedRequestHandler(dp, bot, config.max_in_flight, secret_token=secret_token)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "in_flight": handler.in_flight})
+
+    async def set_webhook(*args, **kwargs):
+        if not config.base_url:
+            await logger.awarning("webhook.base_url is empty, not registering the webhook")
+            return
+        await bot.set_webhook(
+            url=config.base_url.rstrip("/") + config.path,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=config.max_connections,
+            drop_pending_updates=config.drop_pending_updates,
+        )
+
+    app = web.Application()
+    app.router.add_get(config.health_path, health)
+    # The handler closes on shutdown before the dispatcher shutdown hooks (registered below) close the DB
+    handler.register(app, path=config.path)
+    setup_application(app, dp, bot=bot)
+    dp.startup.register(set_webhook)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, config: WebhookConfig):
+    """Serves updates over HTTP until SIGINT/SIGTERM."""
+    app = create_app(dp, bot, config)
+
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, config.host, config.port)
+        await site.start()
+        await logger.ainfo("Serving webhook", host=config.host, port=config.port, path=config.path)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
@@ -0,0 +1,58 @@
+"""Delayed deletions: buffered per chat and sent as one deleteMessages call."""
+import asyncio
+
+import pytest
+
+from bot.services import delayed_actions as delayed_actions_module
+from bot.services.delayed_actions import DELETE_BATCH_SIZE, DelayedActions
+
+FLUSH_WINDOW = 0.5
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls: list[tuple[int, list[int]]] = []
+
+    async def delete_messages(self, chat_id: int, message_ids: list[int]):
+        self.calls.append((chat_id, message_ids))
+        return True
+
+
+@pytest.fixture
+async def actions(db, monkeypatch):
+    monkeypatch.setattr(delayed_actions_module, "DELETE_FLUSH_WINDOW", FLUSH_WINDOW)
+    actions = DelayedActions(FakeBot(), db)
+    await actions.start()
+    yield actions
+    await actions.close()
+
+
+async def test_deletions_due_apart_share_one_call(actions):
+    # Due in different ticks, but within the flush window
+    actions.delete_message_later(-1, 1, 0.1)
+    actions.delete_message_later(-1, 2, 0.3)
+    actions.delete_message_later(-2, 3, 0.2)
+    await asyncio.sleep(0.35)
+    assert actions.bot.calls == []
+
+    await asyncio.sleep(FLUSH_WINDOW + 0.3)
+    assert sorted(actions.bot.calls) == [(-2, [3]), (-1, [1, 2])]
+    assert actions.pending == 0
+
+
+async def test_full_batch_is_sent_without_waiting(actions):
+    for message_id in range(DELETE_BATCH_SIZE + 1):
+        actions.delete_message_later(-1, message_id, 0.1)
+    await asyncio.sleep(0.4)
+    assert actions.bot.calls == [(-1, list(range(DELETE_BATCH_SIZE)))]
+
+    await asyncio.sleep(FLUSH_WINDOW + 0.3)
+    assert actions.bot.calls[1:] == [(-1, [DELETE_BATCH_SIZE])]
+
+
+async def test_close_sends_buffered_deletions(actions, db):
+    actions.delete_message_later(-1, 1, 0.1)
+    await asyncio.sleep(0.3)
+    await actions.close()
+    assert actions.bot.calls == [(-1, [1])]
+    assert await db.get_pending_actions() == []
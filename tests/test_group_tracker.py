@@ -0,0 +1,44 @@
+"""Group tracker: debounced (user, chat) writes and the size of their memory."""
+import time
+
+from bot.config_reader import GroupTrackingConfig
+from bot.services.group_tracker import GroupTracker
+
+CHAT_ID = -100
+WINDOW = 10 * 60
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def test_old_pairs_are_forgotten_on_flush(db, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    tracker = GroupTracker(db, GroupTrackingConfig(last_seen_granularity_minutes=WINDOW // 60))
+
+    tracker.seen(CHAT_ID, "chat", 1)
+    tracker.seen(CHAT_ID, "chat", 2)
+    await tracker.flush()
+    assert len(tracker._last_seen) == 2
+
+    # Within the window: user 1 isn't written again
+    clock.now += WINDOW // 2
+    tracker.seen(CHAT_ID, "chat", 1)
+    assert tracker._dirty_pairs == {}
+    tracker.seen(CHAT_ID, "chat", 3)
+    await tracker.flush()
+    assert len(tracker._last_seen) == 3
+
+    # Users 1 and 2 were last written a window ago
+    clock.now += WINDOW // 2
+    await tracker.flush()
+    assert set(tracker._last_seen) == {(3, CHAT_ID)}
+
+    # A forgotten pair is written on its next message, as it would be anyway
+    tracker.seen(CHAT_ID, "chat", 1)
+    assert tracker._dirty_pairs == {(1, CHAT_ID): int(clock.now)}
@@ -0,0 +1,311 @@
+"""Database backends: both have to pass every test here (see the db fixture)."""
+import asyncio
+import time
+import uuid
+
+import pytest
+
+from bot.dice_check import get_score_change
+
+CHAT_ID = -100
+STARTING_BALANCE = 50
+# Dice values: jackpot (+10), three of a kind (+7), two sevens (+5), a loss (-1)
+JACKPOT, THREE_BARS, TWO_SEVENS, LOSS = 64, 1, 16, 2
+
+
+async def schema_version(db) -> int:
+    from bot.storage.sqlite import SqliteDatabase
+    if isinstance(db, SqliteDatabase):
+        from bot.storage.sqlite_migrations import get_schema_version
+        async with db._write() as conn:
+            return await get_schema_version(conn)
+    from bot.storage.postgres_migrations import get_schema_version
+    async with db._connection() as conn:
+        return await get_schema_version(conn)
+
+
+async def age_events(db, seconds: int):
+    """Moves the whole event history into the past: Postgres history passes skip the latest events."""
+    from bot.storage.sqlite import SqliteDatabase
+    if isinstance(db, SqliteDatabase):
+        async with db._write() as conn:
+            await conn.execute("UPDATE event_history SET ts = ts - ?", (seconds,))
+            await conn.commit()
+        return
+    async with db._connection() as conn:
+        await conn.execute("UPDATE event_history SET ts = ts - $1", seconds)
+
+
+def migrations(db) -> list:
+    from bot.storage.sqlite import SqliteDatabase
+    if isinstance(db, SqliteDatabase):
+        from bot.storage.sqlite_migrations import MIGRATIONS
+    else:
+        from bot.storage.postgres_migrations import MIGRATIONS
+    return MIGRATIONS
+
+
+async def spin(db, user_id: int, dice_value: int, chat_id: int | None = CHAT_ID, multiplier: int = 1) -> dict:
+    return await db.settle_spin(user_id, f"user{user_id}", chat_id, dice_value, multiplier, STARTING_BALANCE)
+
+
+async def add_events(db, user_id: int, *amounts: int, chat_id: int = CHAT_ID):
+    """Logs win/loss events without touching the user's balance or stats."""
+    for i, amount in enumerate(amounts):
+        # History passes order events by (ts, event_id): keep the order within the same second
+        event_id = f"{user_id}-{i:04d}-{uuid.uuid4()}"
+        await db.add_event(event_id, user_id, "win" if amount > 0 else "loss", amount, chat_id=chat_id)
+    await db.flush_events()
+    await age_events(db, 3600)
+
+
+async def age_credit_session(db, session_id: str, seconds: int):
+    from bot.storage.sqlite import SqliteDatabase
+    if isinstance(db, SqliteDatabase):
+        async with db._write() as conn:
+            await conn.execute(
+                "UPDATE ai_credit_sessions SET started_at = datetime(started_at, ?) WHERE session_id = ?",
+                (f"-{seconds} seconds", session_id)
+            )
+            await conn.commit()
+        return
+    async with db._connection() as conn:
+        await conn.execute(
+            "UPDATE ai_credit_sessions SET started_at = started_at - make_interval(secs => $1) WHERE session_id = $2",
+            seconds, session_id
+        )
+        await conn.execute(
+            "UPDATE ai_dialogue_messages SET created_at = created_at - make_interval(secs => $1) WHERE session_id = $2",
+            seconds, session_id
+        )
+
+
+async def session_status(db, session_id: str) -> str:
+    from bot.storage.sqlite import SqliteDatabase
+    if isinstance(db, SqliteDatabase):
+        async with db._write() as conn:
+            async with conn.execute("SELECT status FROM ai_credit_sessions WHERE session_id = ?", (session_id,)) as cursor:
+                return (await cursor.fetchone())[0]
+    async with db._connection() as conn:
+        return await conn.fetchval("SELECT status FROM ai_credit_sessions WHERE session_id = $1", session_id)
+
+
+async def open_credit_session(db, user_id: int) -> str:
+    session_id = str(uuid.uuid4())
+    await db.register_user(user_id, f"user{user_id}")
+    await db.create_credit_session(session_id, user_id)
+    await db.update_user_state(user_id, "IN_DIALOGUE")
+    await db.add_dialogue_message(session_id, "assistant", "hello")
+    return session_id
+
+
+# Migrations
+
+async def test_migrations_reach_latest_version(db):
+    assert await schema_version(db) == len(migrations(db))
+
+
+async def test_migrations_rerun_is_a_noop(db):
+    await spin(db, 1, JACKPOT)
+    await db.create_tables()
+    assert await schema_version(db) == len(migrations(db))
+    assert (await db.get_user(1))["balance"] == STARTING_BALANCE + 10
+
+
+# settle_spin
+
+async def test_settle_spin_win_and_loss(db):
+    result = await spin(db, 1, JACKPOT)
+    assert result == {"status": "ok", "balance": STARTING_BALANCE + 10, "bid": 1, "change": 10}
+
+    result = await spin(db, 1, LOSS)
+    assert result == {"status": "ok", "balance": STARTING_BALANCE + 9, "bid": 1, "change": -1}
+
+    user = await db.get_user(1)
+    assert (user["games_played"], user["total_won"], user["total_lost"]) == (2, 10, 1)
+
+
+async def test_settle_spin_applies_bid_and_multiplier(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.update_bid(1, 5)
+    result = await spin(db, 1, THREE_BARS, multiplier=3)
+    assert result["change"] == 7 * 5 * 3
+    assert result["balance"] == STARTING_BALANCE + 105
+
+
+async def test_settle_spin_fixed_bid_ignores_user_bid(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.update_bid(1, STARTING_BALANCE + 1)
+    result = await db.settle_spin(1, "user1", None, THREE_BARS, starting_balance=STARTING_BALANCE, bid=1)
+    assert result == {"status": "ok", "balance": STARTING_BALANCE + 7, "bid": 1, "change": 7}
+    assert (await db.get_user(1))["bid"] == STARTING_BALANCE + 1
+
+
+async def test_settle_spin_rejects_insufficient_balance(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.update_bid(1, STARTING_BALANCE + 1)
+    result = await spin(db, 1, JACKPOT)
+    assert result == {"status": "insufficient", "balance": STARTING_BALANCE, "bid": STARTING_BALANCE + 1, "change": 0}
+    assert (await db.get_user(1))["games_played"] == 0
+
+
+async def test_settle_spin_bankruptcy(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.update_bid(1, STARTING_BALANCE)
+    result = await spin(db, 1, LOSS)
+    assert result["status"] == "ok"
+    assert result["balance"] == 0
+    assert (await db.get_user(1))["bankruptcy_count"] == 1
+
+    # A bankrupt user can't spin
+    result = await spin(db, 1, JACKPOT)
+    assert result["status"] == "bankrupt"
+    assert result["change"] == 0
+
+
+async def test_concurrent_spins_lose_no_updates(db):
+    dice = [JACKPOT, LOSS, THREE_BARS, LOSS, TWO_SEVENS] * 6
+    await asyncio.gather(*(spin(db, 1, value) for value in dice))
+    user = await db.get_user(1)
+    assert user["balance"] == STARTING_BALANCE + sum(get_score_change(value) for value in dice)
+    assert user["games_played"] == len(dice)
+
+
+async def test_private_spin_skips_chat_stats(db):
+    await spin(db, 1, JACKPOT, chat_id=None)
+    assert await db.get_daily_rollup(db.local_today()) == []
+    assert (await db.get_user(1))["games_played"] == 1
+
+
+# transfer_money
+
+async def test_transfer(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.get_balance(2, STARTING_BALANCE)
+    assert await db.transfer_money(1, 2, 20, str(uuid.uuid4()), str(uuid.uuid4()), CHAT_ID)
+    assert (await db.get_user(1))["balance"] == STARTING_BALANCE - 20
+    assert (await db.get_user(2))["balance"] == STARTING_BALANCE + 20
+
+
+async def test_transfer_rejects_insufficient_balance(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.get_balance(2, STARTING_BALANCE)
+    assert not await db.transfer_money(1, 2, STARTING_BALANCE + 1, str(uuid.uuid4()), str(uuid.uuid4()), CHAT_ID)
+    assert (await db.get_user(1))["balance"] == STARTING_BALANCE
+    assert (await db.get_user(2))["balance"] == STARTING_BALANCE
+
+
+async def test_transfer_of_whole_balance_is_a_bankruptcy(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.get_balance(2, STARTING_BALANCE)
+    assert await db.transfer_money(1, 2, STARTING_BALANCE, str(uuid.uuid4()), str(uuid.uuid4()), CHAT_ID)
+    assert (await db.get_user(1))["bankruptcy_count"] == 1
+
+
+async def test_opposite_concurrent_transfers_dont_deadlock(db):
+    await db.get_balance(1, STARTING_BALANCE)
+    await db.get_balance(2, STARTING_BALANCE)
+    transfers = [
+        db.transfer_money(sender, receiver, 1, str(uuid.uuid4()), str(uuid.uuid4()), CHAT_ID)
+        for _ in range(10) for sender, receiver in ((1, 2), (2, 1))
+    ]
+    results = await asyncio.wait_for(asyncio.gather(*transfers), timeout=30)
+    assert all(results)
+    balances = [(await db.get_user(user_id))["balance"] for user_id in (1, 2)]
+    assert balances == [STARTING_BALANCE, STARTING_BALANCE]
+
+
+# History passes
+
+async def test_stats_backfill(db):
+    await db.register_user(1, "user1")
+    await add_events(db, 1, 10, -1, -1, 7)
+    await db.run_stats_backfill(force=True)
+    user = await db.get_user(1)
+    assert (user["games_played"], user["total_won"], user["total_lost"]) == (4, 17, 2)
+
+
+async def test_bankruptcy_backfill_adds_missing_events(db):
+    await db.register_user(1, "user1")
+    await add_events(db, 1, -STARTING_BALANCE, 5, -5)
+    await db.run_bankruptcy_backfill(force=True, starting_balance=STARTING_BALANCE)
+    assert (await db.get_user(1))["bankruptcy_count"] == 2
+
+    # Rerun finds nothing new
+    await db.run_bankruptcy_backfill(force=True, starting_balance=STARTING_BALANCE)
+    assert (await db.get_user(1))["bankruptcy_count"] == 2
+
+
+async def test_reconcile_ledger(db):
+    for value in (JACKPOT, LOSS, LOSS):
+        await spin(db, 1, value)
+    assert await db.get_balance(2, STARTING_BALANCE) == STARTING_BALANCE
+    assert await db.reconcile_ledger(STARTING_BALANCE) == []
+
+    # A balance change without an event
+    await db.update_balance(1, 100)
+    divergent = await db.reconcile_ledger(STARTING_BALANCE)
+    assert [report["user_id"] for report in divergent] == [1]
+    assert divergent[0]["expected_balance"] == STARTING_BALANCE + 8
+
+
+# AI credit sessions
+
+async def test_terminate_sessions_left_by_a_dead_process(db):
+    session_id = await open_credit_session(db, 1)
+    await age_credit_session(db, session_id, 3600)
+    await db.terminate_all_active_sessions(idle_timeout_minutes=30)
+    assert (await db.get_user(1))["state"] == "IDLE"
+    assert await session_status(db, session_id) == "terminated"
+
+
+async def test_terminate_sessions_keeps_recent_ones_on_postgres(db):
+    from bot.storage.sqlite import SqliteDatabase
+    if isinstance(db, SqliteDatabase):
+        pytest.skip("SQLite has a single process and closes every session")
+    session_id = await open_credit_session(db, 1)
+    old_session_id = await open_credit_session(db, 2)
+    await age_credit_session(db, old_session_id, 3600)
+    # Idle for 60 minutes, but the user has a newer session
+    recent_session_id = await open_credit_session(db, 2)
+    await db.terminate_all_active_sessions(idle_timeout_minutes=30)
+    assert (await db.get_user(1))["state"] == "IN_DIALOGUE"
+    assert (await db.get_user(2))["state"] == "IN_DIALOGUE"
+    assert await session_status(db, session_id) == "active"
+    assert await session_status(db, old_session_id) == "terminated"
+    assert await session_status(db, recent_session_id) == "active"
+
+    # No timeout: sessions never expire, so none can be closed
+    await age_credit_session(db, recent_session_id, 3600)
+    await db.terminate_all_active_sessions(idle_timeout_minutes=0)
+    assert (await db.get_user(2))["state"] == "IN_DIALOGUE"
+
+
+# Daily rollup
+
+async def test_daily_rollup_matches_event_history(db):
+    for value in (JACKPOT, LOSS, THREE_BARS):
+        await spin(db, 1, value)
+    await spin(db, 2, LOSS)
+    await db.transfer_money(1, 2, 3, str(uuid.uuid4()), str(uuid.uuid4()), CHAT_ID)
+
+    today = db.local_today()
+    rollup = {row["user_id"]: row for row in await db.get_daily_rollup(today, CHAT_ID)}
+    assert (rollup[1]["games_played"], rollup[1]["games_won"], rollup[1]["total_won"]) == (3, 2, 17)
+    assert (rollup[1]["total_lost"], rollup[1]["total_given"], rollup[1]["max_win_amount"]) == (1, 3, 10)
+    assert rollup[2]["games_played"] == 1
+
+    now = int(time.time())
+    history = {row["user_id"]: row for row in await db.get_daily_stats(now - 3600, now + 3600, CHAT_ID)}
+    for user_id, row in rollup.items():
+        for key in ("games_played", "total_won", "total_lost", "total_given", "bankruptcy_count"):
+            assert row[key] == history[user_id][key], key
+
+
+async def test_rebuild_daily_stats_is_idempotent(db):
+    for value in (JACKPOT, LOSS):
+        await spin(db, 1, value)
+    today = db.local_today()
+    before = await db.get_daily_rollup(today, CHAT_ID)
+    assert await db.rebuild_daily_stats(today, today) == 1
+    assert await db.get_daily_rollup(today, CHAT_ID) == before
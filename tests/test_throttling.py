@@ -0,0 +1,79 @@
+"""Throttle storages: both have to pass every test here (see the storage fixture)."""
+import asyncio
+
+import fakeredis
+import pytest
+
+from bot.config_reader import ThrottleRule
+from bot.services.redis_throttling import RedisThrottleStorage
+from bot.services.throttling import MemoryThrottleStorage
+
+KEY = "spin"
+CHAT_ID = -100
+
+
+@pytest.fixture(params=["memory", "redis"])
+async def storage(request):
+    if request.param == "memory":
+        storage = MemoryThrottleStorage()
+    else:
+        storage = RedisThrottleStorage(fakeredis.FakeAsyncRedis(), "throttle")
+    yield storage
+    await storage.close()
+
+
+async def take(storage, rule: ThrottleRule, count: int, user_id: int | None = 1, chat_id: int = CHAT_ID) -> list[bool]:
+    return [await storage.allow(KEY, rule, user_id, chat_id) for _ in range(count)]
+
+
+async def test_burst(storage):
+    rule = ThrottleRule(user_per_second=0.1, user_burst=3)
+    assert await take(storage, rule, 4) == [True, True, True, False]
+
+
+async def test_refill_rate(storage):
+    rule = ThrottleRule(user_per_second=5, user_burst=1)
+    assert await take(storage, rule, 2) == [True, False]
+    # One token takes 0.2 s to come back
+    await asyncio.sleep(0.1)
+    assert await take(storage, rule, 1) == [False]
+    await asyncio.sleep(0.15)
+    assert await take(storage, rule, 2) == [True, False]
+
+
+async def test_users_have_separate_buckets(storage):
+    rule = ThrottleRule(user_per_second=0.1, user_burst=1)
+    assert await take(storage, rule, 2, user_id=1) == [True, False]
+    assert await take(storage, rule, 1, user_id=2) == [True]
+    # Same user in another chat: the user's bucket is shared
+    assert await take(storage, rule, 1, user_id=1, chat_id=CHAT_ID - 1) == [False]
+
+
+async def test_chat_bucket_is_shared_by_users(storage):
+    rule = ThrottleRule(user_per_second=0.1, user_burst=5, chat_per_second=0.1, chat_burst=2)
+    assert await take(storage, rule, 1, user_id=1) == [True]
+    assert await take(storage, rule, 1, user_id=2) == [True]
+    assert await take(storage, rule, 1, user_id=3) == [False]
+    # Other chats have their own bucket
+    assert await take(storage, rule, 1, user_id=3, chat_id=CHAT_ID - 1) == [True]
+
+
+async def test_chat_limit_doesnt_use_up_user_tokens(storage):
+    rule = ThrottleRule(user_per_second=0.1, user_burst=2, chat_per_second=0.1, chat_burst=1)
+    assert await take(storage, rule, 2, user_id=1) == [True, False]
+    # The rejected message took no token from user 1, who still has one in another chat
+    assert await take(storage, rule, 1, user_id=1, chat_id=CHAT_ID - 1) == [True]
+
+
+async def test_no_user_only_checks_chat(storage):
+    rule = ThrottleRule(user_per_second=0.1, user_burst=1, chat_per_second=0.1, chat_burst=2)
+    assert await take(storage, rule, 3, user_id=None) == [True, True, False]
+
+
+async def test_redis_error_fails_open():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    storage = RedisThrottleStorage(fakeredis.FakeAsyncRedis(server=server), "throttle")
+    rule = ThrottleRule(user_per_second=0.1, user_burst=1)
+    assert await take(storage, rule, 3) == [True, True, True]
+    await storage.close()
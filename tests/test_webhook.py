@@ -0,0 +1,114 @@
+"""Webhook server: secret check, bad requests, health route and the in-flight limit."""
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer
+
+from bot.config_reader import WebhookConfig
+from bot.webhook import create_app
+
+SECRET = "test-secret"
+HEADERS = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+
+def message_update(update_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "user1"},
+            "text": "hello",
+        },
+    }
+
+
+class BlockingHandler:
+    """Message handler that waits until released, counting how many run at once."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.running = 0
+        self.max_running = 0
+        self.handled = 0
+
+    async def handle(self, message: Message):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+        finally:
+            self.running -= 1
+            self.handled += 1
+
+
+@pytest.fixture
+def handler():
+    return BlockingHandler()
+
+
+@pytest.fixture
+async def client(handler):
+    dp = Dispatcher()
+    dp.message.register(handler.handle)
+    bot = Bot("42:TEST")
+    config = WebhookConfig(secret_token=SECRET, max_in_flight=2)
+    async with TestClient(TestServer(create_app(dp, bot, config))) as client:
+        yield client
+        handler.release.set()
+    await bot.session.close()
+
+
+async def test_wrong_secret_is_forbidden(client, handler):
+    response = await client.post("/webhook", json=message_update(1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert response.status == 403
+    response = await client.post("/webhook", json=message_update(1))
+    assert response.status == 403
+    assert handler.handled == 0
+
+
+async def test_bad_json_is_rejected(client, handler):
+    response = await client.post("/webhook", data="{not json", headers=HEADERS)
+    assert response.status == 400
+    assert handler.handled == 0
+
+
+async def test_health(client):
+    response = await client.get("/health")
+    assert response.status == 200
+    assert await response.json() == {"status": "ok", "in_flight": 0}
+
+
+async def test_update_is_answered_before_it_is_handled(client, handler):
+    response = await client.post("/webhook", json=message_update(1), headers=HEADERS)
+    assert response.status == 200
+    await asyncio.sleep(0.05)
+    assert handler.running == 1
+    assert (await (await client.get("/health")).json())["in_flight"] == 1
+
+    handler.release.set()
+    await asyncio.sleep(0.05)
+    assert handler.handled == 1
+    assert (await (await client.get("/health")).json())["in_flight"] == 0
+
+
+async def test_in_flight_limit(client, handler):
+    requests = [
+        asyncio.create_task(client.post("/webhook", json=message_update(update_id), headers=HEADERS))
+        for update_id in range(1, 6)
+    ]
+    await asyncio.sleep(0.1)
+    # Two updates are handled, the other requests wait for a free slot
+    assert handler.running == 2
+    assert sum(request.done() for request in requests) == 2
+    assert (await (await client.get("/health")).json())["in_flight"] == 2
+
+    handler.release.set()
+    responses = await asyncio.wait_for(asyncio.gather(*requests), timeout=5)
+    assert [response.status for response in responses] == [200] * 5
+    await asyncio.sleep(0.05)
+    assert handler.handled == 5
+    assert handler.max_running == 2